@@ -0,0 +1,389 @@
+"""Asyncio tier for the client API, served next to the Flask admin.
+
+    uvicorn async_api:application --host 0.0.0.0 --port 5000 --workers 4
+
+/api/verify, /api/heartbeat, /api/proxy/generate and /api/proxy/check-result are
+handled on the event loop here; every other path (admin pages, redeem, the batch
+endpoints, ...) goes to the Flask app in proxy_server unchanged. Upstream calls share
+one httpx.AsyncClient, so a worker can keep thousands of them outstanding instead of
+one per thread. The retry policy (UpstreamAttempts), the check-result hedger and the
+dispatch queue are proxy_server's own, so only the transport differs and both tiers
+share one upstream budget per worker. SQLite work runs on a small thread pool through
+the same helpers the Flask routes use, so replies, billing and idempotency behave
+exactly like the sync routes. Request validation, the ban check and
+rate limits are applied here too; the Flask profiler and traffic capture only see the
+requests passed through to Flask.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import cached_property
+
+import httpx
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+
+from proxy_server import (
+    DISPATCH_POLICY, DISPATCH_QUEUE_TIMEOUT, HEDGE_ENABLED, RATE_LIMIT_ENABLED, RATE_LIMITS, REQUEST_SCHEMAS,
+    DispatchTimeout, UpstreamAttempts, _answered, analytics, app, authorize_generation, banned_ips,
+    check_answered, check_failed, check_request, claim_idempotency_key, dispatcher as shared_dispatcher,
+    finish_idempotency_key, get_active_api_key, get_db, hedger, history_writer, key_usage, providers, rate_limit_store,
+    record_check_result, record_heartbeat, record_key_request, settle_generate_response, start_background_jobs,
+    verify_credentials,
+)
+
+# --- CONFIGURATION ---
+ASYNC_DB_THREADS = int(os.environ.get("ASYNC_DB_THREADS", "16"))              # threads running SQLite work
+ASYNC_WSGI_THREADS = int(os.environ.get("ASYNC_WSGI_THREADS", "32"))          # Flask requests served at once
+ASYNC_MAX_CONNECTIONS = int(os.environ.get("ASYNC_MAX_CONNECTIONS", "4000"))  # upstream connections per worker
+ASYNC_MAX_BODY = int(os.environ.get("ASYNC_MAX_BODY", str(1024 * 1024)))      # request body limit in bytes
+
+db_pool = ThreadPoolExecutor(max_workers=ASYNC_DB_THREADS, thread_name_prefix="async-db")
+
+async def run_db(fn, *args):
+    """Run a blocking SQLite helper off the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(db_pool, fn, *args)
+
+# --- DISPATCH QUEUE ---
+class AsyncFairDispatcher:
+    """Coroutine entry to proxy_server's FairDispatcher. The queue, in_flight count and capacity
+    are the shared ones, so the Flask routes (on the WSGI threads) and the async routes together
+    stay within one worker's upstream budget. Waiters park on an asyncio.Event that the
+    dispatcher sets, thread-safely, whenever a slot is taken or given back."""
+    def __init__(self, shared):
+        self.shared = shared
+        self.loop = None
+        self.changed = None
+        shared.listeners.append(self._wake)
+
+    def _wake(self):
+        # Called by the dispatcher from any thread, with its lock held
+        if self.loop is None:
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.changed.set)
+        except RuntimeError:  # the loop has closed
+            pass
+
+    @asynccontextmanager
+    async def slot(self, username, plan):
+        d = self.shared
+        if DISPATCH_POLICY == 'off':
+            yield
+            return
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop, self.changed = loop, asyncio.Event()
+        plan = (plan or 'Standard').lower()
+        if time.time() - d._capacity[1] > 30:
+            await run_db(d.capacity)
+        capacity = d._capacity[0]
+        t0 = time.time()
+        with d.cond:
+            ticket = d.enqueue(username, plan)
+        while True:
+            self.changed.clear()
+            with d.cond:
+                if d.admit(ticket, plan, t0, capacity):
+                    break
+            try:
+                await asyncio.wait_for(self.changed.wait(), t0 + DISPATCH_QUEUE_TIMEOUT - time.time())
+            except asyncio.TimeoutError:
+                pass
+        try:
+            yield
+        finally:
+            d.release()
+
+dispatcher = AsyncFairDispatcher(shared_dispatcher)
+
+# --- UPSTREAM ---
+client = None  # httpx.AsyncClient, opened at startup
+
+def never_sent(exc):
+    """httpx counterpart of request_never_sent: the connection was never established."""
+    return isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout))
+
+async def dispatch_generate(username, client_data, request_key):
+    """proxy_server.dispatch_generate on the event loop: the same UpstreamAttempts policy,
+    sent with httpx. Returns (provider, api_key, response, error)."""
+    attempts = UpstreamAttempts(username, client_data, request_key)
+    while await run_db(attempts.pick):
+        url, payload, headers, timeout = attempts.request()
+        try:
+            r = await client.post(url, json=payload, headers=headers, timeout=timeout)
+        except httpx.HTTPError as e:
+            retry = attempts.failed(e, never_sent(e), isinstance(e, httpx.TimeoutException))
+        else:
+            retry = attempts.answered(r)
+        delay = attempts.backoff() if retry else None
+        if delay is None:
+            break
+        await asyncio.sleep(delay)
+    return attempts.result()
+
+async def check_once(provider, real_key, task_id):
+    record_key_request(real_key)
+    t0 = time.time()
+    try:
+        r = await client.post(provider.check_url, json={"taskId": task_id}, headers=provider.headers(real_key),
+                              timeout=provider.check_timeout)
+    except httpx.HTTPError as e:
+        check_failed(provider, real_key, e)
+        raise
+    check_answered(provider, real_key, r, t0)
+    return r
+
+def _retrieve(task):
+    # The losing side of a hedge finishes on its own; read its exception so asyncio does not warn
+    if not task.cancelled():
+        task.exception()
+
+async def fetch_task_result(task_id, provider_name=None):
+    """proxy_server.fetch_task_result on the event loop, hedged with the same hedger when HEDGE_ENABLED."""
+    provider = providers.get(provider_name) or providers.default()
+    real_key = await run_db(get_active_api_key, None, provider.name) if provider else None
+    if not real_key:
+        return None
+    if not HEDGE_ENABLED:
+        return await check_once(provider, real_key, task_id)
+
+    hedger.count_check()
+    primary = asyncio.ensure_future(check_once(provider, real_key, task_id))
+    done, _ = await asyncio.wait([primary], timeout=hedger.delay(provider.name))
+    if done or not hedger.allow_hedge():
+        return await primary
+
+    hedge_key = await run_db(get_active_api_key, None, provider.name, (real_key,)) or real_key
+    hedge = asyncio.ensure_future(check_once(provider, hedge_key, task_id))
+    hedger.hedged(provider.name)
+    pending, winner = {primary, hedge}, None
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        winner = next((f for f in done if _answered(f)), None)
+        if winner:
+            break
+    for f in pending:
+        f.add_done_callback(_retrieve)
+    hedger.settled(provider.name, winner, hedge)
+    return await (winner or primary)
+
+# --- REQUESTS ---
+class Request:
+    def __init__(self, scope, body):
+        self.path = scope['path']
+        self.headers = {k.decode('latin1').lower(): v.decode('latin1') for k, v in scope['headers']}
+        self.body = body
+        forwarded = self.headers.get('x-forwarded-for')
+        self.ip = forwarded if forwarded else (scope.get('client') or ('',))[0]
+
+    @cached_property
+    def json(self):
+        try:
+            return json.loads(self.body or b'null')
+        except ValueError:
+            return None
+
+def rate_limit_identity(req, kind):
+    """proxy_server.rate_limit_identity for an async Request."""
+    if kind == "auth":
+        auth = req.headers.get("client-auth", "")
+        if auth:
+            return "a:" + hashlib.sha256(auth.encode()).hexdigest()[:24]
+    elif kind == "username":
+        body = req.json
+        username = body.get('username') if isinstance(body, dict) else None
+        if isinstance(username, str) and username:
+            return "u:" + username
+    return "ip:" + str(req.ip)
+
+def admit(req):
+    """security_guard + rate_limit_guard for the async routes, run on the DB pool.
+    Returns None to continue or a (body, status, headers) reply."""
+    if banned_ips.contains(req.ip):
+        return {"code": 403, "message": "Access Denied: IP Banned."}, 403, []
+    if not RATE_LIMIT_ENABLED:
+        return None
+    for policy in RATE_LIMITS.get(req.path) or ():
+        bucket = f"{req.path}|{rate_limit_identity(req, policy['key'])}"
+        try:
+            allowed, retry_after = rate_limit_store.take(bucket, policy['rate'], policy['burst'])
+        except Exception as e:
+            print(f"[RATELIMIT] Store unavailable, allowing request: {e}")
+            return None
+        if not allowed:
+            return ({"code": 429, "message": "Too Many Requests", "retry_after": retry_after}, 429,
+                    [("Retry-After", str(retry_after))])
+    return None
+
+# --- ROUTES ---
+async def verify(req):
+    d = req.json or {}
+    result = await run_db(verify_credentials, d.get('username'), d.get('api_key'), req.headers.get('if-none-match', ''))
+    return result, 200, [("Cache-Control", "no-store")] if result["valid"] else []
+
+async def heartbeat(req):
+    d = req.json or {}
+    await run_db(record_heartbeat, d.get('username'), d.get('api_key'))
+    return {"status": "ok"}, 200, []
+
+def _authorize(u_name, u_key, client_data):
+    conn = get_db()
+    try:
+        return authorize_generation(conn, u_name, u_key, client_data)
+    finally:
+        conn.close()
+
+def _settle(u_name, user, client_model, cost, provider, real_key, r, error):
+    conn = get_db()
+    try:
+        return settle_generate_response(conn, u_name, user, client_model, cost, provider, real_key, r, error)
+    finally:
+        conn.close()
+
+async def generate(req):
+    auth = req.headers.get("client-auth", "")
+    if ":" not in auth:
+        return {"code": -1}, 401, []
+    u_name, u_key = auth.split(":", 1)
+    client_data = req.json
+    if not isinstance(client_data, dict):
+        return {"code": -1, "message": "Invalid JSON body"}, 400, []
+    user, cost, refused = await run_db(_authorize, u_name, u_key, client_data)
+    if refused:
+        return refused[0], refused[1], []
+
+    idem_key = req.headers.get("idempotency-key")
+    if idem_key:
+        claimed = await run_db(claim_idempotency_key, u_name, idem_key)
+        if claimed == 'busy':
+            return {"code": -1, "message": "Request already in progress"}, 409, []
+        if claimed is not None:
+            return claimed[0], claimed[1], []
+
+    try:
+        async with dispatcher.slot(u_name, user['plan']):
+            provider, real_key, r, error = await dispatch_generate(u_name, client_data, idem_key or uuid.uuid4().hex)
+        body, status = await run_db(_settle, u_name, user, client_data.get('model', ''), cost, provider, real_key, r, error)
+    except DispatchTimeout:
+        print(f"[DISPATCH] {u_name} timed out waiting for an upstream slot")
+        body, status = {"code": -1, "message": "System Busy"}, 503
+    except Exception as e:
+        print(f"[ERROR] in async proxy_gen: {e}")
+        body, status = {"code": -1, "message": str(e)}, 500
+    if idem_key:
+        await run_db(finish_idempotency_key, u_name, idem_key, body, status)
+    return body, status, []
+
+def _load_task(task_id):
+    conn = get_db()
+    task = conn.execute("SELECT task_id, username, cost, status, model, provider FROM tasks WHERE task_id=?", (task_id,)).fetchone()
+    conn.close()
+    return task
+
+async def check_result(req):
+    try:
+        task_id = (req.json or {}).get('taskId')
+        if not task_id:
+            return {"code": -1, "message": "Missing taskId"}, 400, []
+        task = await run_db(_load_task, task_id)
+        r = await fetch_task_result(task_id, task['provider'] if task else None)
+        if r is None:
+            return {"code": -1, "message": "System Busy"}, 503, []
+        if r.status_code != 200:
+            return {"code": -1, "message": f"API Error: {r.status_code}"}, r.status_code, []
+        data = r.json()
+        if task:
+            data = await run_db(record_check_result, task, data)
+        return data, 200, []
+    except Exception as e:
+        print(f"[ERROR] in async proxy_chk: {e}")
+        return {"code": -1, "message": str(e)}, 500, []
+
+ROUTES = {
+    "/api/verify": verify,
+    "/api/heartbeat": heartbeat,
+    "/api/proxy/generate": generate,
+    "/api/proxy/check-result": check_result,
+}
+
+# --- ASGI APPLICATION ---
+class ConcurrentWsgiToAsgi(WsgiToAsgi):
+    """WsgiToAsgi with each request in its own ThreadSensitiveContext. asgiref otherwise runs every
+    WSGI call on one shared thread, so a slow admin page or batch request would hold up the rest
+    of the Flask routes; at most ASYNC_WSGI_THREADS requests run at once."""
+    def __init__(self, wsgi_application):
+        super().__init__(wsgi_application)
+        self.slots = asyncio.Semaphore(ASYNC_WSGI_THREADS)
+
+    async def __call__(self, scope, receive, send):
+        async with self.slots, ThreadSensitiveContext():
+            await super().__call__(scope, receive, send)
+
+async def send_json(send, body, status, headers=()):
+    payload = json.dumps(body, sort_keys=True, separators=(",", ":")).encode() + b"\n"
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode())]
+                           + [(k.lower().encode(), v.encode()) for k, v in headers]})
+    await send({"type": "http.response.body", "body": payload})
+
+class AsyncAPI:
+    def __init__(self, wsgi_app):
+        self.fallback = ConcurrentWsgiToAsgi(wsgi_app)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        handler = ROUTES.get(scope['path']) if scope['type'] == 'http' and scope['method'] == 'POST' else None
+        if handler is None:
+            return await self.fallback(scope, receive, send)
+
+        chunks, size = [], 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > ASYNC_MAX_BODY:
+                return await send_json(send, {"code": -1, "message": "Request body too large"}, 413)
+            chunks.append(chunk)
+            if not message.get('more_body'):
+                break
+        req = Request(scope, b''.join(chunks))
+        # Same schemas as the Flask validation_guard, checked on the loop before any DB work
+        schema = REQUEST_SCHEMAS.get(req.path)
+        if schema:
+            if size > schema['max_bytes']:
+                return await send_json(send, {"code": -1, "message": "Request body too large"}, 413)
+            refused = check_request(schema, req.headers.get('client-auth'), req.json)
+            if refused:
+                return await send_json(send, *refused)
+        refused = await run_db(admit, req)
+        if refused:
+            return await send_json(send, *refused)
+        await send_json(send, *(await handler(req)))
+
+    async def lifespan(self, receive, send):
+        global client
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                client = httpx.AsyncClient(limits=httpx.Limits(max_connections=ASYNC_MAX_CONNECTIONS,
+                                                               max_keepalive_connections=min(ASYNC_MAX_CONNECTIONS, 500)))
+                start_background_jobs()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await client.aclose()
+                db_pool.submit(analytics.flush).result()
+                db_pool.submit(key_usage.flush).result()
+                db_pool.submit(history_writer.flush).result()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+application = AsyncAPI(app)
@@ -0,0 +1,242 @@
+"""Replay traffic captured with CAPTURE_ENABLED=1 against a test instance.
+
+    python bench/replay.py captures/capture-*.jsonl --speed 1
+    python bench/replay.py captures/*.jsonl --speed 4 --db /tmp/bench.db --reuse-db --json replay.json
+    python bench/replay.py captures/*.jsonl --target http://127.0.0.1:5000 --users 1000
+
+Without --target it seeds (or reuses) a bench DB and starts the upstream stub and
+gunicorn exactly like run_bench.py. Requests are sent at their captured offsets
+divided by --speed. Hashed identities are mapped deterministically onto the seeded
+bench users/vouchers, and check-result calls for tasks created during the replay
+use the task ids the test instance actually returned. The report compares the
+replayed latency per endpoint with the latency recorded in production.
+"""
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+from run_bench import Recorder, compare, free_port, percentile, wait_ready  # noqa: E402
+from seed_db import bench_user, seed  # noqa: E402
+
+
+def load_capture(patterns):
+    records = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            with open(path) as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        try:
+                            records.append(json.loads(line))
+                        except ValueError:
+                            pass
+    records.sort(key=lambda r: r["ts"])
+    return records
+
+
+class Replayer:
+    def __init__(self, base_url, users, vouchers, recorder):
+        self.base = base_url
+        self.users = users
+        self.vouchers = vouchers
+        self.recorder = recorder
+        self.task_ids = {}  # captured task hash -> task id returned by the test instance
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def user_for(self, h):
+        return bench_user(int(h, 16) % self.users)
+
+    def task_for(self, h):
+        with self.lock:
+            tid = self.task_ids.get(h)
+        return tid or f"benchtask{int(h, 16) % 200000:08d}"
+
+    def rebuild(self, key, shape, user):
+        """Turn a captured body shape back into a concrete request body."""
+        if isinstance(shape, dict) and set(shape) == {"h"}:
+            h = shape["h"]
+            if key == "username":
+                return user[0] if user else self.user_for(h)[0]
+            if key == "api_key":
+                return user[1] if user else self.user_for(h)[1]
+            if key == "code":
+                return f"BENCH-{int(h, 16) % self.vouchers}"
+            if key in ("taskId", "taskIds"):
+                return self.task_for(h)
+            return h
+        if isinstance(shape, dict) and set(shape) == {"len"}:
+            return "a" * shape["len"]
+        if isinstance(shape, dict):
+            return {k: self.rebuild(k, v, user) for k, v in shape.items()}
+        if isinstance(shape, list):
+            return [self.rebuild(key, v, user) for v in shape]
+        return shape
+
+    def send(self, rec):
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        user = None
+        body = rec.get("body")
+        if rec.get("auth"):
+            user = self.user_for(rec["auth"])
+        elif isinstance(body, dict) and isinstance(body.get("username"), dict) and "h" in body["username"]:
+            user = self.user_for(body["username"]["h"])
+        headers = {"X-Forwarded-For": "10.9.%d.%d" % (int(rec["client"][:2], 16), int(rec["client"][2:4], 16))}
+        if user and rec.get("auth"):
+            headers["Client-Auth"] = f"{user[0]}:{user[1]}"
+        if rec.get("idempotency_key"):
+            headers["Idempotency-Key"] = f"replay-{rec['ts']}-{rec['client']}"
+        kwargs = {"headers": headers}
+        if body is not None:
+            kwargs["json"] = self.rebuild("", body, user)
+
+        endpoint = rec["path"].rsplit("/", 1)[-1] or rec["path"]
+        t0 = time.perf_counter()
+        try:
+            r = session.request(rec["method"], self.base + rec["path"], timeout=130, **kwargs)
+            status = r.status_code
+            if rec.get("task_ids") and status == 200:
+                data = r.json()
+                got = [(i.get("data") or {}).get("taskId") for i in (data.get("results") or [data])]
+                with self.lock:
+                    for h, tid in zip(rec["task_ids"], [t for t in got if t]):
+                        self.task_ids[h] = tid
+        except requests.RequestException as e:
+            status = type(e).__name__
+        self.recorder.add(endpoint, (time.perf_counter() - t0) * 1000, status)
+
+
+def replay(replayer, records, speed, concurrency):
+    """Send every record at its captured offset / speed. Returns (elapsed, worst lag in ms)."""
+    if not records:
+        return 0.0, 0.0
+    first = records[0]["ts"]
+    start = time.time()
+    max_lag = 0.0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for rec in records:
+            due = start + (rec["ts"] - first) / speed
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                max_lag = max(max_lag, -delay * 1000)
+            pool.submit(replayer.send, rec)
+    return time.time() - start, max_lag
+
+
+def captured_report(records):
+    by_ep = defaultdict(list)
+    for rec in records:
+        by_ep[rec["path"].rsplit("/", 1)[-1] or rec["path"]].append(rec["duration_ms"])
+    return {ep: {"count": len(v), "p50_ms": round(percentile(sorted(v), 50), 2), "p95_ms": round(percentile(sorted(v), 95), 2)}
+            for ep, v in sorted(by_ep.items())}
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("capture", nargs="+", help="capture-*.jsonl files or glob patterns")
+    ap.add_argument("--speed", type=float, default=1.0, help="rate multiplier (2 = twice the captured rate)")
+    ap.add_argument("--concurrency", type=int, default=64, help="max requests in flight")
+    ap.add_argument("--limit", type=int, default=None, help="replay only the first N records")
+    ap.add_argument("--target", help="existing instance to replay against (skips seeding and server start)")
+    ap.add_argument("--db", default=os.path.join(tempfile.gettempdir(), "proxy_bench.db"))
+    ap.add_argument("--reuse-db", action="store_true", help="skip seeding if --db exists")
+    ap.add_argument("--users", type=int, default=100_000)
+    ap.add_argument("--vouchers", type=int, default=5_000)
+    ap.add_argument("--workers", type=int, default=4, help="gunicorn workers")
+    ap.add_argument("--threads", type=int, default=8, help="gunicorn threads per worker")
+    ap.add_argument("--upstream-latency-ms", type=float, default=150)
+    ap.add_argument("--no-rate-limit", action="store_true", help="run the server with RATE_LIMIT_ENABLED=0")
+    ap.add_argument("--json", help="write the report to this file")
+    ap.add_argument("--baseline", help="previous --json report to compare against")
+    ap.add_argument("--max-regression", type=float, default=0.2, help="allowed p95 growth vs baseline")
+    args = ap.parse_args()
+
+    records = load_capture(args.capture)[:args.limit]
+    if not records:
+        raise SystemExit("no records found in the capture files")
+    span = records[-1]["ts"] - records[0]["ts"]
+    print(f"{len(records)} records over {span:.0f}s, replaying at x{args.speed} (~{span / args.speed:.0f}s)")
+
+    procs = []
+    try:
+        if args.target:
+            base = args.target.rstrip("/")
+        else:
+            db = os.path.abspath(args.db)
+            if not (args.reuse_db and os.path.exists(db)):
+                seed(db, args.users, 0, args.vouchers, 0, 8)
+            stub_port, app_port = free_port(), free_port()
+            procs.append(subprocess.Popen([
+                sys.executable, os.path.join(HERE, "upstream_stub.py"), "--port", str(stub_port),
+                "--latency-ms", str(args.upstream_latency_ms), "--complete-after", "5"],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+            env = dict(os.environ, DATABASE_PATH=db, UPSTREAM_BASE_URL=f"http://127.0.0.1:{stub_port}",
+                       RATELIMIT_DB_PATH=db + ".ratelimit", RATE_LIMIT_ENABLED="0" if args.no_rate_limit else "1",
+                       GUNICORN_THREADS=str(args.threads),
+                       CAPTURE_ENABLED="0")
+            procs.append(subprocess.Popen([
+                sys.executable, "-m", "gunicorn", "-w", str(args.workers), "-k", "gthread", "--threads", str(args.threads),
+                "-b", f"127.0.0.1:{app_port}", "--log-level", "warning", "proxy_server:app"],
+                cwd=ROOT, env=env, stdout=subprocess.DEVNULL))
+            wait_ready(f"http://127.0.0.1:{stub_port}/health")
+            base = f"http://127.0.0.1:{app_port}"
+        wait_ready(base + "/")
+
+        recorder = Recorder()
+        replayer = Replayer(base, args.users, args.vouchers, recorder)
+        elapsed, max_lag = replay(replayer, records, args.speed, args.concurrency)
+    finally:
+        for p in procs:
+            p.terminate()
+        for p in procs:
+            try:
+                p.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                p.kill()
+
+    report = recorder.report(elapsed)
+    original = captured_report(records)
+    print(f"\n{'endpoint':<18}{'count':>8}{'orig p50':>10}{'orig p95':>10}{'p50':>9}{'p95':>9}{'p99':>9}  statuses")
+    for ep, r in report.items():
+        o = original.get(ep, {})
+        print(f"{ep:<18}{r['count']:>8}{o.get('p50_ms', '-'):>10}{o.get('p95_ms', '-'):>10}"
+              f"{r['p50_ms']:>9}{r['p95_ms']:>9}{r['p99_ms']:>9}  {r['statuses']}")
+    total = sum(r["count"] for r in report.values())
+    print(f"total: {total} requests in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.1f} req/s), worst schedule lag {max_lag:.0f}ms")
+    if max_lag > 1000:
+        print("warning: the replayer fell behind the schedule, raise --concurrency or lower --speed")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": vars(args), "elapsed_s": round(elapsed, 2), "max_lag_ms": round(max_lag, 1),
+                       "captured": original, "endpoints": report}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures = compare(report, json.load(f), args.max_regression)
+        if failures:
+            print("\nREGRESSION:\n  " + "\n  ".join(failures))
+            sys.exit(1)
+        print("\nno p95 regression vs baseline")
+
+
+if __name__ == "__main__":
+    main()
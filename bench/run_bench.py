@@ -0,0 +1,262 @@
+"""Load test proxy_server under gunicorn against a seeded DB and a local upstream stub.
+
+    python bench/run_bench.py --duration 60 --concurrency 64
+    python bench/run_bench.py --db /tmp/bench.db --reuse-db --json out.json
+    python bench/run_bench.py --reuse-db --db /tmp/bench.db --baseline out.json --max-regression 0.15
+
+Reports throughput and p50/p95/p99 latency per endpoint. With --baseline the run
+fails (exit 1) if any endpoint's p95 got worse than the allowed regression.
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+from seed_db import bench_user, seed  # noqa: E402
+
+DEFAULT_MIX = "verify=30,heartbeat=35,generate=5,check-result=25,redeem=5"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return 0.0
+    k = min(len(sorted_vals) - 1, max(0, int(round(p / 100.0 * (len(sorted_vals) - 1)))))
+    return sorted_vals[k]
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    def add(self, endpoint, ms, status):
+        with self.lock:
+            self.latencies[endpoint].append(ms)
+            self.statuses[endpoint][status] += 1
+
+    def report(self, elapsed):
+        out = {}
+        for ep, vals in sorted(self.latencies.items()):
+            vals = sorted(vals)
+            out[ep] = {
+                "count": len(vals),
+                "rps": round(len(vals) / elapsed, 2),
+                "p50_ms": round(percentile(vals, 50), 2),
+                "p95_ms": round(percentile(vals, 95), 2),
+                "p99_ms": round(percentile(vals, 99), 2),
+                "statuses": dict(self.statuses[ep]),
+            }
+        return out
+
+
+class TrafficDriver:
+    def __init__(self, base_url, users, vouchers, mix, recorder):
+        self.base = base_url
+        self.users = users
+        self.vouchers = vouchers
+        self.mix = mix
+        self.recorder = recorder
+        self.task_ids = deque(maxlen=5000)
+
+    def call(self, session, endpoint):
+        i = random.randrange(self.users)
+        username, api_key = bench_user(i)
+        if endpoint == "verify":
+            req = ("POST", "/api/verify", {"json": {"username": username, "api_key": api_key}})
+        elif endpoint == "heartbeat":
+            req = ("POST", "/api/heartbeat", {"json": {"username": username, "api_key": api_key}})
+        elif endpoint == "redeem":
+            req = ("POST", "/api/redeem", {"json": {"username": username, "code": f"BENCH-{random.randrange(self.vouchers)}"}})
+        elif endpoint == "generate":
+            req = ("POST", "/api/proxy/generate", {
+                "json": {"model": random.choice(["sora-2", "sora-2-pro"]), "prompt": "a cat surfing a wave at sunset",
+                         "aspectRatio": random.choice(["16:9", "9:16"])},
+                "headers": {"Client-Auth": f"{username}:{api_key}"}})
+        else:
+            if self.task_ids:
+                tid, username, api_key = random.choice(self.task_ids)
+            else:
+                tid = f"benchtask{random.randrange(1000):08d}"
+            req = ("POST", "/api/proxy/check-result", {"json": {"taskId": tid},
+                                                       "headers": {"Client-Auth": f"{username}:{api_key}"}})
+
+        method, path, kwargs = req
+        # One client IP per bench user, as in a real fleet
+        kwargs.setdefault("headers", {})["X-Forwarded-For"] = f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}"
+        t0 = time.perf_counter()
+        try:
+            r = session.request(method, self.base + path, timeout=130, **kwargs)
+            status = r.status_code
+            if endpoint == "generate" and status == 200:
+                tid = (r.json().get("data") or {}).get("taskId")
+                if tid:
+                    self.task_ids.append((tid, username, api_key))
+        except requests.RequestException as e:
+            status = type(e).__name__
+        self.recorder.add(endpoint, (time.perf_counter() - t0) * 1000, status)
+
+    def worker(self, stop_at):
+        session = requests.Session()
+        names = list(self.mix)
+        weights = [self.mix[n] for n in names]
+        while time.time() < stop_at:
+            self.call(session, random.choices(names, weights)[0])
+
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight)
+    unknown = set(mix) - {"verify", "heartbeat", "generate", "check-result", "redeem"}
+    if unknown:
+        raise SystemExit(f"unknown endpoints in --mix: {', '.join(sorted(unknown))}")
+    return mix
+
+
+def compare(report, baseline, max_regression):
+    failures = []
+    for ep, cur in report.items():
+        base = baseline.get("endpoints", baseline).get(ep)
+        if not base or not base.get("p95_ms"):
+            continue
+        ratio = cur["p95_ms"] / base["p95_ms"]
+        if ratio > 1 + max_regression:
+            failures.append(f"{ep}: p95 {base['p95_ms']}ms -> {cur['p95_ms']}ms (+{(ratio - 1) * 100:.0f}%)")
+    return failures
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--db", default=os.path.join(tempfile.gettempdir(), "proxy_bench.db"))
+    ap.add_argument("--reuse-db", action="store_true", help="skip seeding if --db exists")
+    ap.add_argument("--users", type=int, default=100_000)
+    ap.add_argument("--logs", type=int, default=2_000_000)
+    ap.add_argument("--vouchers", type=int, default=5_000)
+    ap.add_argument("--tasks", type=int, default=200_000)
+    ap.add_argument("--workers", type=int, default=4, help="gunicorn workers")
+    ap.add_argument("--threads", type=int, default=8, help="gunicorn threads per worker")
+    ap.add_argument("--concurrency", type=int, default=32, help="client threads")
+    ap.add_argument("--duration", type=float, default=30)
+    ap.add_argument("--warmup", type=float, default=3)
+    ap.add_argument("--mix", default=DEFAULT_MIX)
+    ap.add_argument("--upstream-latency-ms", type=float, default=150)
+    ap.add_argument("--upstream-error-rate", type=float, default=0.0)
+    ap.add_argument("--upstream-429-rate", type=float, default=0.0)
+    ap.add_argument("--upstream-fail-rate", type=float, default=0.05)
+    ap.add_argument("--no-rate-limit", action="store_true", help="run the server with RATE_LIMIT_ENABLED=0")
+    ap.add_argument("--json", help="write the report to this file")
+    ap.add_argument("--baseline", help="previous --json report to compare against")
+    ap.add_argument("--max-regression", type=float, default=0.2, help="allowed p95 growth vs baseline")
+    args = ap.parse_args()
+
+    mix = parse_mix(args.mix)
+    db = os.path.abspath(args.db)
+    if not (args.reuse_db and os.path.exists(db)):
+        seed(db, args.users, args.logs, args.vouchers, args.tasks, 8)
+
+    stub_port, app_port = free_port(), free_port()
+    procs = []
+    try:
+        procs.append(subprocess.Popen([
+            sys.executable, os.path.join(HERE, "upstream_stub.py"), "--port", str(stub_port),
+            "--latency-ms", str(args.upstream_latency_ms), "--error-rate", str(args.upstream_error_rate),
+            "--rate-limit-rate", str(args.upstream_429_rate), "--fail-rate", str(args.upstream_fail_rate),
+            "--complete-after", "5"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        env = dict(os.environ, DATABASE_PATH=db, UPSTREAM_BASE_URL=f"http://127.0.0.1:{stub_port}",
+                   RATELIMIT_DB_PATH=db + ".ratelimit", RATE_LIMIT_ENABLED="0" if args.no_rate_limit else "1",
+                   GUNICORN_THREADS=str(args.threads))
+        procs.append(subprocess.Popen([
+            sys.executable, "-m", "gunicorn", "-w", str(args.workers), "-k", "gthread", "--threads", str(args.threads),
+            "-b", f"127.0.0.1:{app_port}", "--log-level", "warning", "proxy_server:app"],
+            cwd=ROOT, env=env, stdout=subprocess.DEVNULL))
+        wait_ready(f"http://127.0.0.1:{stub_port}/health")
+        wait_ready(f"http://127.0.0.1:{app_port}/")
+
+        base = f"http://127.0.0.1:{app_port}"
+        n_users = args.users
+        if args.reuse_db:
+            import sqlite3
+            conn = sqlite3.connect(db)
+            n_users = conn.execute("SELECT COUNT(*) FROM users WHERE username LIKE 'user%'").fetchone()[0]
+            conn.close()
+
+        if args.warmup > 0:
+            warm = TrafficDriver(base, n_users, args.vouchers, mix, Recorder())
+            _run(warm, args.concurrency, args.warmup)
+
+        recorder = Recorder()
+        driver = TrafficDriver(base, n_users, args.vouchers, mix, recorder)
+        elapsed = _run(driver, args.concurrency, args.duration)
+    finally:
+        for p in procs:
+            p.terminate()
+        for p in procs:
+            try:
+                p.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                p.kill()
+
+    report = recorder.report(elapsed)
+    total = sum(r["count"] for r in report.values())
+    print(f"\n{'endpoint':<14}{'count':>8}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}  statuses")
+    for ep, r in report.items():
+        print(f"{ep:<14}{r['count']:>8}{r['rps']:>9}{r['p50_ms']:>9}{r['p95_ms']:>9}{r['p99_ms']:>9}  {r['statuses']}")
+    print(f"total: {total} requests in {elapsed:.1f}s ({total / elapsed:.1f} req/s)")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": vars(args), "elapsed_s": round(elapsed, 2), "endpoints": report}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures = compare(report, json.load(f), args.max_regression)
+        if failures:
+            print("\nREGRESSION:\n  " + "\n  ".join(failures))
+            sys.exit(1)
+        print("\nno p95 regression vs baseline")
+
+
+def _run(driver, concurrency, duration):
+    stop_at = time.time() + duration
+    t0 = time.time()
+    threads = [threading.Thread(target=driver.worker, args=(stop_at,), daemon=True) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.time() - t0
+
+
+if __name__ == "__main__":
+    main()
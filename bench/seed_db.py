@@ -0,0 +1,133 @@
+"""Seed a users.db with realistic volumes for benchmarking.
+
+    python bench/seed_db.py /tmp/bench.db --users 100000 --logs 2000000 --vouchers 5000
+
+Bench users are named user000000..userNNNNNN with api_key SK-BENCH000000..,
+vouchers are BENCH-0..BENCH-N. The schema comes from proxy_server itself.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLANS = [("Mini", 0.35), ("Basic", 0.3), ("Standard", 0.25), ("Premium", 0.1)]
+CHUNK = 50000
+
+
+def bench_user(i):
+    return f"user{i:06d}", f"SK-BENCH{i:06d}"
+
+
+def init_schema(path):
+    """Create the schema by importing proxy_server against the target DB."""
+    os.environ["DATABASE_PATH"] = path
+    sys.path.insert(0, ROOT)
+    import proxy_server
+    proxy_server.init_and_migrate_db()
+
+
+def chunked(rows, size=CHUNK):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def seed(path, users, logs, vouchers, tasks, api_keys):
+    if os.path.exists(path):
+        os.remove(path)
+    init_schema(path)
+
+    rng = random.Random(42)
+    now = datetime.now()
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+
+    def stamp(days_back):
+        t = now - timedelta(seconds=rng.randint(0, int(days_back * 86400)))
+        return str(t), int(t.timestamp())
+
+    def day(offset_days):
+        d = (now + timedelta(days=offset_days)).replace(hour=0, minute=0, second=0, microsecond=0)
+        return d.strftime("%Y-%m-%d"), int(d.timestamp())
+
+    t0 = time.time()
+    plan_names = [p for p, _ in PLANS]
+    plan_weights = [w for _, w in PLANS]
+    user_rows = (
+        (*bench_user(i), 1_000_000, *day(rng.randint(30, 365)), 1, *day(-rng.randint(0, 365)),
+         rng.choices(plan_names, plan_weights)[0], *stamp(30))
+        for i in range(users)
+    )
+    for batch in chunked(user_rows):
+        conn.executemany("INSERT INTO users (username, api_key, credits, expiry_date, expiry_ts, is_active, created_at, created_ts, plan, "
+                         "last_seen, last_seen_ts, session_minutes) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)", batch)
+    conn.commit()
+    print(f"users: {users} in {time.time() - t0:.1f}s")
+
+    conn.executemany("INSERT INTO api_keys (key_value, label, is_active, error_count) VALUES (?, ?, 1, 0)",
+                     [(f"sk-bench-{i:03d}", f"bench-{i}") for i in range(api_keys)])
+
+    t0 = time.time()
+    voucher_rows = ((f"BENCH-{i}", rng.choice([50, 100, 200, 500]), 1_000_000, 0, *day(365), *stamp(90)) for i in range(vouchers))
+    for batch in chunked(voucher_rows):
+        conn.executemany("INSERT INTO vouchers (code, amount, max_uses, current_uses, expiry_date, expiry_ts, created_at, created_ts) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", batch)
+    conn.commit()
+    print(f"vouchers: {vouchers} in {time.time() - t0:.1f}s")
+
+    t0 = time.time()
+    task_rows = []
+    for i in range(tasks):
+        model = rng.choice(["sora-2", "sora-2-pro"])
+        task_rows.append((f"benchtask{i:08d}", bench_user(rng.randrange(users))[0], 35 if model.endswith("pro") else 25,
+                          rng.choices(["succeeded", "refunded", "pending"], [0.85, 0.1, 0.05])[0], *stamp(90), model))
+    for batch in chunked(task_rows):
+        conn.executemany("INSERT INTO tasks (task_id, username, cost, status, created_at, created_ts, model) VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+    conn.commit()
+    print(f"tasks: {tasks} in {time.time() - t0:.1f}s")
+
+    t0 = time.time()
+
+    def log_rows():
+        for _ in range(logs):
+            tid = task_rows[rng.randrange(len(task_rows))] if task_rows else None
+            if tid and rng.random() < 0.1:
+                yield (tid[1], f"Refund {tid[0]}", tid[2], *stamp(90), "Refunded", tid[0])
+            elif tid:
+                yield (tid[1], "generate", tid[2], *stamp(90), "Pending", tid[0])
+            else:
+                yield (bench_user(rng.randrange(users))[0], "generate", 25, *stamp(90), "Pending", "")
+
+    for batch in chunked(log_rows()):
+        conn.executemany("INSERT INTO logs (username, action, cost, timestamp, ts, status, task_id) VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+        conn.commit()
+    print(f"logs: {logs} in {time.time() - t0:.1f}s")
+
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("path")
+    ap.add_argument("--users", type=int, default=100_000)
+    ap.add_argument("--logs", type=int, default=2_000_000)
+    ap.add_argument("--vouchers", type=int, default=5_000)
+    ap.add_argument("--tasks", type=int, default=200_000)
+    ap.add_argument("--api-keys", type=int, default=8)
+    args = ap.parse_args()
+    seed(os.path.abspath(args.path), args.users, args.logs, args.vouchers, args.tasks, args.api_keys)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""Local fake of the freesoragenerator.com video API used by the benchmarks.
+
+Run standalone:
+    python bench/upstream_stub.py --port 5900 --latency-ms 200 --error-rate 0.02
+
+then point the proxy at it with UPSTREAM_BASE_URL=http://127.0.0.1:5900.
+"""
+import argparse
+import random
+import threading
+import time
+import uuid
+
+from flask import Flask, jsonify, request
+
+
+def create_stub_app(latency_ms=150, jitter_ms=50, check_latency_ms=40, error_rate=0.0,
+                    rate_limit_rate=0.0, fail_rate=0.05, complete_after=20.0, balance=None):
+    """Build the stub app.
+
+    error_rate       -> fraction of calls answered with HTTP 500
+    rate_limit_rate  -> fraction of calls answered with HTTP 429
+    fail_rate        -> fraction of accepted tasks that end in 'failed'
+    complete_after   -> seconds a task stays 'processing' before it is terminal
+    balance          -> credits per key; each accepted task costs 1 and an empty key gets HTTP 402
+    """
+    app = Flask("upstream_stub")
+    tasks = {}
+    idempotent = {}
+    spent = {}
+    lock = threading.Lock()
+
+    def simulate(base_ms):
+        delay = max(0.0, base_ms + random.uniform(-jitter_ms, jitter_ms)) / 1000.0
+        time.sleep(delay)
+        roll = random.random()
+        if roll < error_rate:
+            return jsonify({"code": -1, "message": "stub: internal error"}), 500
+        if roll < error_rate + rate_limit_rate:
+            return jsonify({"code": -1, "message": "stub: rate limited"}), 429
+        if not request.headers.get("Authorization", "").startswith("Bearer "):
+            return jsonify({"code": -1, "message": "stub: missing key"}), 401
+        return None
+
+    @app.route("/api/v1/video/sora-pro", methods=["POST"])
+    def generate():
+        err = simulate(latency_ms)
+        if err:
+            return err
+        body = request.get_json(silent=True) or {}
+        if not body.get("prompt"):
+            return jsonify({"code": 1001, "message": "prompt is required"}), 200
+        idem = request.headers.get("Idempotency-Key")
+        key = request.headers["Authorization"]
+        with lock:
+            if idem and idem in idempotent:
+                return jsonify({"code": 0, "message": "ok", "data": {"taskId": idempotent[idem]}})
+            if balance is not None and spent.get(key, 0) >= balance:
+                return jsonify({"code": -1, "message": "stub: insufficient balance"}), 402
+            spent[key] = spent.get(key, 0) + 1
+            tid = uuid.uuid4().hex
+            tasks[tid] = (time.time(), random.random() < fail_rate)
+            if idem:
+                idempotent[idem] = tid
+        return jsonify({"code": 0, "message": "ok", "data": {"taskId": tid}})
+
+    @app.route("/api/video-generations/check-result", methods=["POST"])
+    def check_result():
+        err = simulate(check_latency_ms)
+        if err:
+            return err
+        tid = (request.get_json(silent=True) or {}).get("taskId")
+        with lock:
+            task = tasks.get(tid)
+        if task is None:
+            return jsonify({"code": 404, "message": "task not found", "data": {"taskId": tid, "status": "failed"}})
+        created, will_fail = task
+        if time.time() - created < complete_after:
+            status = "processing"
+        else:
+            status = "failed" if will_fail else "succeeded"
+        data = {"taskId": tid, "status": status}
+        if status == "succeeded":
+            data["videoUrl"] = f"https://stub.invalid/videos/{tid}.mp4"
+        return jsonify({"code": 0, "message": "ok", "data": data})
+
+    @app.route("/api/v1/account/balance")
+    def account_balance():
+        err = simulate(check_latency_ms)
+        if err:
+            return err
+        left = None if balance is None else balance - spent.get(request.headers["Authorization"], 0)
+        return jsonify({"code": 0, "message": "ok", "data": {"balance": 1e9 if left is None else left}})
+
+    @app.route("/health")
+    def health():
+        return jsonify({"status": "ok", "tasks": len(tasks)})
+
+    return app
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=5900)
+    ap.add_argument("--latency-ms", type=float, default=150)
+    ap.add_argument("--jitter-ms", type=float, default=50)
+    ap.add_argument("--check-latency-ms", type=float, default=40)
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--rate-limit-rate", type=float, default=0.0)
+    ap.add_argument("--fail-rate", type=float, default=0.05)
+    ap.add_argument("--complete-after", type=float, default=20.0)
+    ap.add_argument("--balance", type=float, default=None, help="credits per key (default: unlimited)")
+    args = ap.parse_args()
+
+    app = create_stub_app(args.latency_ms, args.jitter_ms, args.check_latency_ms, args.error_rate,
+                          args.rate_limit_rate, args.fail_rate, args.complete_after, args.balance)
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""gunicorn settings for proxy_server.
+
+    gunicorn -c gunicorn.conf.py proxy_server:app
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker async_api:application
+
+The app is preloaded: the master imports proxy_server once, which runs
+init_and_migrate_db exactly once, and forks workers that are ready to serve
+without repeating the import, the schema check or the migrations. SQLite
+connections are never shared across the fork (see proxy_server.reset_after_fork),
+and background jobs and thread pools start in each worker on first use.
+
+The master prints proxy_server's [STARTUP] breakdown (imports, setup, db_init,
+routes); each worker logs how long it took from fork to accepting requests.
+"""
+import os
+import time
+
+CONFIG_LOADED = time.perf_counter()  # read before the app is preloaded
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", "1"))      # proxy_server sizes its dispatch slots from the same variable
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "150"))  # above UPSTREAM_DEADLINE, so slow generates are not killed
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+preload_app = True
+
+
+def when_ready(server):
+    server.log.info(f"[STARTUP] master ready in {(time.perf_counter() - CONFIG_LOADED) * 1000:.0f}ms (app preload included)")
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.perf_counter()
+
+
+def post_worker_init(worker):
+    worker.log.info(f"[STARTUP] worker {worker.pid} ready {(time.perf_counter() - worker.forked_at) * 1000:.0f}ms after fork")
@@ -1,49 +1,673 @@
 # --- START OF FILE admin_dashboard.py ---
+import time
+BOOT_STARTED = time.perf_counter()
 
-from flask import Flask, request, jsonify, render_template_string, redirect, url_for, session, send_file, abort
+from flask import Flask, request, jsonify, render_template, render_template_string, redirect, url_for, session, send_file, abort, g, has_request_context
+# Imported here, not lazily: under gunicorn's preload the master loads it once and every worker inherits it
 import requests
+import importlib
 import os
+import sys
 import sqlite3
 import uuid
-import time
 import random
 import string
 import json
+import csv
+import codecs
+import io
+import threading
+import socket
+import atexit
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+import hashlib
+import base64
+import math
+import re
+import gzip
+import shutil
+import heapq
+import itertools
+from contextlib import contextmanager
+from collections import Counter
 from datetime import datetime, timedelta
 from functools import wraps
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
+import click
+
+# --- STARTUP TIMING ---
+# Phases of the module import, printed once per process that imports it. Under
+# gunicorn.conf.py that is only the master; workers are forked ready to serve.
+startup_timings = {}
+_startup_last = BOOT_STARTED
+
+def startup_mark(phase):
+    global _startup_last
+    now = time.perf_counter()
+    startup_timings[phase] = round((now - _startup_last) * 1000, 1)
+    _startup_last = now
+
+class LazyModule:
+    """Stands in for a module that is only needed on some paths; imported on first attribute access."""
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            t0 = time.perf_counter()
+            self._module = importlib.import_module(self._name)
+            startup_timings[f"lazy_{self._name}"] = round((time.perf_counter() - t0) * 1000, 1)
+        return getattr(self._module, attr)
+
+# Profiling is opt-in, so most processes never need these
+cProfile = LazyModule("cProfile")
+pstats = LazyModule("pstats")
+
+startup_mark("imports")
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("FLASK_SECRET", "super_secret_admin_key_v6_fix")
 
 # --- CONFIGURATION ---
 DB_PATH = os.environ.get("DATABASE_PATH", "users.db")
+# "single": everything in DB_PATH. "split": append-only history (logs, rollups) lives in HISTORY_DB_PATH,
+# attached to every connection as schema "history"; move an existing DB over with `flask split-storage`.
+STORAGE_LAYOUT = os.environ.get("STORAGE_LAYOUT", "single")
+HISTORY_DB_PATH = os.environ.get("HISTORY_DB_PATH", os.path.splitext(DB_PATH)[0] + "_history.db")
+HISTORY_FLUSH_INTERVAL = float(os.environ.get("HISTORY_FLUSH_INTERVAL", "1"))  # split: seconds between log/usage appends
 ADMIN_PASSWORD = os.environ.get("ADMIN_PASSWORD", "admin123")
 ADMIN_LOGIN_PATH = os.environ.get("ADMIN_PATH", "secure_login")
+UPSTREAM_BASE_URL = os.environ.get("UPSTREAM_BASE_URL", "https://freesoragenerator.com").rstrip("/")
+UPSTREAM_PROVIDERS_FILE = os.environ.get("UPSTREAM_PROVIDERS_FILE", "")  # JSON provider registry (optional)
+MOCK_UPSTREAM_URL = os.environ.get("MOCK_UPSTREAM_URL", "http://127.0.0.1:5900")
+
+# Upstream Retry Config
+UPSTREAM_MAX_ATTEMPTS = int(os.environ.get("UPSTREAM_MAX_ATTEMPTS", "3"))
+UPSTREAM_BACKOFF_BASE = float(os.environ.get("UPSTREAM_BACKOFF_BASE", "0.5"))   # seconds
+UPSTREAM_BACKOFF_MAX = float(os.environ.get("UPSTREAM_BACKOFF_MAX", "8"))       # seconds
+UPSTREAM_DEADLINE = float(os.environ.get("UPSTREAM_DEADLINE", "120"))          # total budget per generate request
+IDEMPOTENCY_TTL = int(os.environ.get("IDEMPOTENCY_TTL", "86400"))              # how long Idempotency-Key replies are kept
+
+# Upstream Dispatch Config: generate calls wait in a per-worker fair queue for one of
+# (active api_keys x UPSTREAM_SLOTS_PER_KEY / WEB_CONCURRENCY) upstream slots
+DISPATCH_POLICY = os.environ.get("DISPATCH_POLICY", "wfq")   # wfq (weighted fair), strict (plan priority), fifo, off
+PLAN_WEIGHTS = json.loads(os.environ.get("PLAN_WEIGHTS", '{"premium": 8, "standard": 4, "basic": 2, "mini": 1}'))
+UPSTREAM_SLOTS_PER_KEY = int(os.environ.get("UPSTREAM_SLOTS_PER_KEY", "4"))
+WEB_CONCURRENCY = max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))  # gunicorn workers sharing the keys
+WORKER_THREADS = max(1, int(os.environ.get("GUNICORN_THREADS", "8")))  # request threads per worker, as in gunicorn.conf.py
+DISPATCH_QUEUE_TIMEOUT = float(os.environ.get("DISPATCH_QUEUE_TIMEOUT", "30"))  # seconds before a queued request gets 503
+
+# Hedged check-result: if the upstream has not answered within the HEDGE_PERCENTILE
+# latency, send a second request (another key when available) and use the first answer
+HEDGE_ENABLED = os.environ.get("HEDGE_ENABLED", "0") == "1"
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", "95"))
+HEDGE_DEFAULT_DELAY_MS = float(os.environ.get("HEDGE_DEFAULT_DELAY_MS", "1000"))  # until enough samples exist
+HEDGE_MIN_DELAY_MS = float(os.environ.get("HEDGE_MIN_DELAY_MS", "50"))
+HEDGE_BUDGET = float(os.environ.get("HEDGE_BUDGET", "0.05"))                      # max hedges per check
+
+# Settings / ban caches (per worker; other workers pick up changes within the TTL)
+SETTINGS_CACHE_TTL = float(os.environ.get("SETTINGS_CACHE_TTL", "5"))
+BAN_CACHE_TTL = float(os.environ.get("BAN_CACHE_TTL", "5"))
+
+# Stale-Task Reaper Config
+REAPER_ENABLED = os.environ.get("REAPER_ENABLED", "1") == "1"
+REAPER_INTERVAL = int(os.environ.get("REAPER_INTERVAL", "300"))          # seconds between runs
+REAPER_MIN_AGE = int(os.environ.get("REAPER_MIN_AGE", "1800"))           # only pending tasks older than this are checked
+REAPER_EXPIRE_AFTER = int(os.environ.get("REAPER_EXPIRE_AFTER", "86400"))  # still pending upstream after this -> expire + refund
+REAPER_BATCH = int(os.environ.get("REAPER_BATCH", "50"))
+REAPER_RATE = float(os.environ.get("REAPER_RATE", "5"))                  # upstream checks per second
+REAPER_CONCURRENCY = int(os.environ.get("REAPER_CONCURRENCY", "4"))
+
+# Upstream Key Usage Config: per-key totals are buffered per worker and added to api_keys periodically;
+# strained keys (throttled or nearly out of balance) are only used when no healthy key is left
+KEY_USAGE_FLUSH_INTERVAL = float(os.environ.get("KEY_USAGE_FLUSH_INTERVAL", "30"))  # seconds between api_keys writes
+KEY_THROTTLE_WINDOW = int(os.environ.get("KEY_THROTTLE_WINDOW", "300"))            # seconds covered by the 429 rate
+KEY_THROTTLE_LIMIT = float(os.environ.get("KEY_THROTTLE_LIMIT", "0.3"))            # 429 share that marks a key strained
+KEY_THROTTLE_MIN_REQUESTS = int(os.environ.get("KEY_THROTTLE_MIN_REQUESTS", "5"))  # calls in the window before it counts
+KEY_LOW_BALANCE = float(os.environ.get("KEY_LOW_BALANCE", "20"))                   # estimated upstream balance that marks a key strained
+KEY_BALANCE_INTERVAL = int(os.environ.get("KEY_BALANCE_INTERVAL", "600"))          # seconds between balance probes, 0 = off
+KEY_BALANCE_MAX_AGE = int(os.environ.get("KEY_BALANCE_MAX_AGE", "3600"))           # older readings (incl. "out of credit") are ignored
+
+# Counters Config
+COUNTERS_REPAIR_INTERVAL = int(os.environ.get("COUNTERS_REPAIR_INTERVAL", "3600"))  # seconds between recounts, 0 = off
+
+# Batch API Config
+BATCH_CHECK_MAX = int(os.environ.get("BATCH_CHECK_MAX", "50"))                  # taskIds per check-results call
+BATCH_CHECK_CONCURRENCY = int(os.environ.get("BATCH_CHECK_CONCURRENCY", "8"))   # upstream checks in flight per worker
+BATCH_GENERATE_MAX = int(os.environ.get("BATCH_GENERATE_MAX", "20"))            # items per generate-batch call
+
+# Request Validation Config: client API bodies are checked against REQUEST_SCHEMAS before any DB work
+API_MAX_BODY = int(os.environ.get("API_MAX_BODY", str(16 * 1024)))        # bytes, per-route limits in REQUEST_SCHEMAS
+PROMPT_MAX_CHARS = int(os.environ.get("PROMPT_MAX_CHARS", "8000"))
+
+# Task History Config
+TASK_HISTORY_PAGE = int(os.environ.get("TASK_HISTORY_PAGE", "20"))     # default page size of /api/tasks
+TASK_HISTORY_MAX = int(os.environ.get("TASK_HISTORY_MAX", "100"))      # largest page a client may ask for
+DASHBOARD_PAGE = int(os.environ.get("DASHBOARD_PAGE", "50"))           # users per page on /dashboard
+
+# Backup Config
+BACKUP_ENABLED = os.environ.get("BACKUP_ENABLED", "1") == "1"
+BACKUP_INTERVAL = int(os.environ.get("BACKUP_INTERVAL", "21600"))        # seconds between scheduled backups
+BACKUP_DIR = os.environ.get("BACKUP_DIR", os.path.join(os.path.dirname(DB_PATH) or ".", "backups"))
+BACKUP_KEEP = int(os.environ.get("BACKUP_KEEP", "14"))                   # compressed backups kept per database file
+BACKUP_PAGES = int(os.environ.get("BACKUP_PAGES", "256"))                # pages copied per backup step
+BACKUP_SLEEP = float(os.environ.get("BACKUP_SLEEP", "0.02"))             # pause between steps, lets writers in
+BACKUP_MAX_RESTARTS = int(os.environ.get("BACKUP_MAX_RESTARTS", "5"))    # then finish in a single step
+
+# Bulk Admin Config
+BULK_CHUNK_SIZE = int(os.environ.get("BULK_CHUNK_SIZE", "500"))          # rows per executemany transaction
+BULK_MAX_ERRORS = int(os.environ.get("BULK_MAX_ERRORS", "1000"))         # errors listed in the JSON report
+
+# Read Pool Config: admin pages and reports read through read-only connections (see get_read_db)
+READ_POOL_SIZE = int(os.environ.get("READ_POOL_SIZE", "4"))   # idle read-only connections kept per worker
+
+# Startup Config: with DB_INIT_ON_IMPORT=0 the schema check is left to `flask init-db` (release step)
+DB_INIT_ON_IMPORT = os.environ.get("DB_INIT_ON_IMPORT", "1") == "1"
+
+# Analytics Config
+ANALYTICS_FLUSH_INTERVAL = float(os.environ.get("ANALYTICS_FLUSH_INTERVAL", "5"))  # seconds between rollup flushes
 
 # Security Config
 MAX_SUSPICIOUS_ATTEMPTS = 5
 suspicious_tracker = {} 
 
+# Rate Limit Config
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "1") == "1"
+RATELIMIT_DB_PATH = os.environ.get("RATELIMIT_DB_PATH", os.path.join(os.path.dirname(DB_PATH) or ".", "ratelimit.db"))
+# Per-route token buckets: rate = tokens/second, burst = bucket size, key = username | auth | ip.
+# username/auth fall back to the client IP when the request carries no identity.
+RATE_LIMITS = {
+    "/api/proxy/check-result": [{"key": "auth", "rate": 2.0, "burst": 30}],
+    "/api/proxy/generate": [{"key": "auth", "rate": 1.0, "burst": 10}],
+    "/api/verify": [{"key": "username", "rate": 0.5, "burst": 10}],
+    "/api/redeem": [{"key": "username", "rate": 0.2, "burst": 5}, {"key": "ip", "rate": 1.0, "burst": 20}],
+    "/api/heartbeat": [{"key": "username", "rate": 0.2, "burst": 5}],
+    "/api/tasks": [{"key": "auth", "rate": 1.0, "burst": 20}],
+}
+RATE_LIMITS.update(json.loads(os.environ.get("RATE_LIMITS", "{}")))  # JSON override per route
+
+# Profiling Config (opt-in)
+PROFILE_ENABLED = os.environ.get("PROFILE_ENABLED", "0") == "1"
+PROFILE_SLOW_MS = float(os.environ.get("PROFILE_SLOW_MS", "500"))
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0.0"))
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL_MS", "5")) / 1000.0
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", "50"))
+
+# Traffic Capture Config (opt-in): sanitized request traces for bench/replay.py
+CAPTURE_ENABLED = os.environ.get("CAPTURE_ENABLED", "0") == "1"
+CAPTURE_DIR = os.environ.get("CAPTURE_DIR", "captures")
+CAPTURE_PATH_PREFIX = os.environ.get("CAPTURE_PATH_PREFIX", "/api/")
+CAPTURE_SAMPLE_RATE = float(os.environ.get("CAPTURE_SAMPLE_RATE", "1.0"))
+CAPTURE_MAX_BYTES = int(os.environ.get("CAPTURE_MAX_BYTES", str(50 * 1024 * 1024)))  # rotate after this size
+CAPTURE_KEEP = int(os.environ.get("CAPTURE_KEEP", "20"))                            # files kept
+CAPTURE_SALT = os.environ.get("CAPTURE_SALT", "")                                   # defaults to FLASK_SECRET
+
+# --- CONNECTIONS ---
+class DBConnection(sqlite3.Connection):
+    """get_db() connection. Split-layout history rows queued by history_write are handed to
+    history_writer only once the transaction commits, and dropped on rollback."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.history_rows = []
+
+    def commit(self):
+        super().commit()
+        if self.history_rows:
+            history_writer.add(self.history_rows)
+            self.history_rows = []
+
+    def rollback(self):
+        super().rollback()
+        self.history_rows = []
+
+# --- PROFILING ---
+# SQL is timed through a custom connection factory, only for requests being profiled.
+class ProfiledCursor(sqlite3.Cursor):
+    def execute(self, sql, params=()):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self.connection.sql_log.append((sql, (time.perf_counter() - t0) * 1000))
+
+    def executemany(self, sql, seq):
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(sql, seq)
+        finally:
+            self.connection.sql_log.append((f"[many] {sql}", (time.perf_counter() - t0) * 1000))
+
+class ProfiledConnection(DBConnection):
+    sql_log = None
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq):
+        return self.cursor().executemany(sql, seq)
+
+    def commit(self):
+        t0 = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            self.sql_log.append(("COMMIT", (time.perf_counter() - t0) * 1000))
+
+class StackSampler:
+    """Background thread that samples the stacks of threads serving profiled requests."""
+    def __init__(self, interval):
+        self.interval = interval
+        self.active = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def register(self, tid):
+        with self.lock:
+            self.active[tid] = Counter()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+                self.thread.start()
+
+    def unregister(self, tid):
+        with self.lock:
+            return self.active.pop(tid, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                for tid, counts in self.active.items():
+                    f = frames.get(tid)
+                    stack = []
+                    while f is not None and len(stack) < 64:
+                        stack.append(f"{os.path.basename(f.f_code.co_filename)}:{f.f_code.co_name}:{f.f_lineno}")
+                        f = f.f_back
+                    if stack:
+                        counts[";".join(reversed(stack))] += 1
+
+stack_sampler = StackSampler(PROFILE_SAMPLE_INTERVAL)
+
+def store_profile(record, profiler=None):
+    """Write a captured profile into the rotating PROFILE_DIR buffer."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    if profiler is not None:
+        profiler.dump_stats(os.path.join(PROFILE_DIR, name + ".prof"))
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(40)
+        record['cprofile_top'] = out.getvalue()
+    with open(os.path.join(PROFILE_DIR, name + ".json"), "w") as f:
+        json.dump(record, f, indent=1)
+
+    captured = sorted(n for n in os.listdir(PROFILE_DIR) if n.endswith(".json"))
+    for old in captured[:-PROFILE_KEEP] if PROFILE_KEEP > 0 else captured:
+        for ext in (".json", ".prof"):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, old[:-5] + ext))
+            except OSError:
+                pass
+
+@app.before_request
+def profile_start():
+    if not PROFILE_ENABLED:
+        return
+    sampled = random.random() < PROFILE_SAMPLE_RATE
+    g.profile = {'t0': time.perf_counter(), 'sql': [], 'sampled': sampled, 'profiler': None}
+    stack_sampler.register(threading.get_ident())
+    if sampled:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            g.profile['profiler'] = profiler
+        except ValueError:
+            pass  # Another profiler already active in this thread
+
+@app.after_request
+def profile_finish(response):
+    prof = g.pop('profile', None)
+    if prof is None:
+        return response
+    elapsed_ms = (time.perf_counter() - prof['t0']) * 1000
+    if prof['profiler'] is not None:
+        prof['profiler'].disable()
+    stacks = stack_sampler.unregister(threading.get_ident()) or Counter()
+
+    if prof['sampled'] or elapsed_ms >= PROFILE_SLOW_MS:
+        try:
+            store_profile({
+                "method": request.method, "path": request.path, "status": response.status_code,
+                "elapsed_ms": round(elapsed_ms, 2), "sampled": prof['sampled'],
+                "reason": "sampled" if prof['sampled'] else f"slow (>= {PROFILE_SLOW_MS}ms)",
+                "captured_at": str(datetime.now()),
+                "sql_count": len(prof['sql']),
+                "sql_ms": round(sum(ms for _, ms in prof['sql']), 2),
+                "sql": [{"sql": q, "ms": round(ms, 3)} for q, ms in prof['sql']],
+                "stack_samples": dict(stacks.most_common(200)),
+            }, prof['profiler'])
+        except Exception as e:
+            print(f"[PROFILE] Failed to store profile: {e}")
+    return response
+
+@app.teardown_request
+def profile_cleanup(exc=None):
+    if PROFILE_ENABLED:
+        stack_sampler.unregister(threading.get_ident())
+
+# --- TRAFFIC CAPTURE ---
+# One JSON line per request. Credentials and identifiers are replaced by salted hashes
+# (stable across workers, so a user's requests still line up), prompts by their length.
+CAPTURE_HASHED_FIELDS = {'username', 'api_key', 'code', 'taskId', 'taskIds'}
+CAPTURE_VERBATIM_FIELDS = {'model', 'aspectRatio', 'duration', 'resolution', 'nFrames'}
+CAPTURE_RESPONSE_PATHS = ('/api/proxy/generate', '/api/proxy/generate-batch')  # task ids are read back for replay
+
+def capture_hash(value):
+    salt = CAPTURE_SALT or app.secret_key
+    return hashlib.sha256(f"{salt}:{value}".encode()).hexdigest()[:16]
+
+def capture_shape(key, value):
+    """Sanitized copy of a JSON value that keeps its structure and sizes."""
+    if key in CAPTURE_HASHED_FIELDS and not isinstance(value, (dict, list)):
+        return {"h": capture_hash(value)}
+    if isinstance(value, dict):
+        return {k: capture_shape(k, v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [capture_shape(key, v) for v in value[:100]]
+    if isinstance(value, str) and key not in CAPTURE_VERBATIM_FIELDS:
+        return {"len": len(value)}
+    return value
+
+class TrafficCapture:
+    """WSGI middleware writing sanitized traces to rotating CAPTURE_DIR/capture-*.jsonl files."""
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.lock = threading.Lock()
+        self.file = None
+        self.pid = None
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if not path.startswith(CAPTURE_PATH_PREFIX) or random.random() >= CAPTURE_SAMPLE_RATE:
+            return self.wsgi_app(environ, start_response)
+        t0 = time.time()
+        body = b''
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        if 0 < length <= 1024 * 1024:
+            body = environ['wsgi.input'].read(length)
+            environ['wsgi.input'] = io.BytesIO(body)
+        captured = {}
+
+        def capture_start_response(status, headers, exc_info=None):
+            captured['status'] = int(status.split(' ', 1)[0])
+            return start_response(status, headers, exc_info) if exc_info else start_response(status, headers)
+
+        app_iter = self.wsgi_app(environ, capture_start_response)
+        try:
+            chunks = list(app_iter)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        try:
+            self.write(self.record(environ, path, body, chunks, captured.get('status'), t0))
+        except Exception as e:
+            print(f"[CAPTURE] Failed to record {path}: {e}")
+        return chunks
+
+    def record(self, environ, path, body, chunks, status, t0):
+        try:
+            payload = capture_shape('', json.loads(body)) if body else None
+        except ValueError:
+            payload = {"len": len(body)}
+        auth = environ.get('HTTP_CLIENT_AUTH', '')
+        client = (environ.get('HTTP_X_FORWARDED_FOR') or environ.get('REMOTE_ADDR') or '').split(',')[0].strip()
+        rec = {"ts": round(t0, 3), "method": environ.get('REQUEST_METHOD'), "path": path,
+               "status": status, "duration_ms": round((time.time() - t0) * 1000, 2),
+               "bytes_in": len(body), "bytes_out": sum(len(c) for c in chunks),
+               "client": capture_hash(client), "body": payload,
+               "auth": capture_hash(auth.split(':', 1)[0]) if ':' in auth else None,
+               "idempotency_key": bool(environ.get('HTTP_IDEMPOTENCY_KEY')),
+               "if_none_match": bool(environ.get('HTTP_IF_NONE_MATCH'))}
+        if path in CAPTURE_RESPONSE_PATHS and status == 200:
+            try:
+                resp = json.loads(b''.join(chunks))
+                items = resp.get('results') or [resp]
+                rec["task_ids"] = [capture_hash(i['data']['taskId']) for i in items if (i.get('data') or {}).get('taskId')]
+            except (ValueError, AttributeError, TypeError):
+                pass
+        return rec
+
+    def write(self, rec):
+        line = json.dumps(rec, separators=(',', ':')) + "\n"
+        with self.lock:
+            if self.file is None or self.pid != os.getpid() or self.file.tell() >= CAPTURE_MAX_BYTES:
+                self.rotate()
+            self.file.write(line)
+            self.file.flush()
+
+    def rotate(self):
+        if self.file is not None and self.pid == os.getpid():
+            self.file.close()
+        os.makedirs(CAPTURE_DIR, exist_ok=True)
+        self.pid = os.getpid()
+        name = f"capture-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{self.pid}.jsonl"
+        self.file = open(os.path.join(CAPTURE_DIR, name), "a")
+        files = sorted((os.path.join(CAPTURE_DIR, n) for n in os.listdir(CAPTURE_DIR) if n.startswith("capture-")), key=os.path.getmtime)
+        for old in files[:-CAPTURE_KEEP] if CAPTURE_KEEP > 0 else []:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+if CAPTURE_ENABLED:
+    app.wsgi_app = TrafficCapture(app.wsgi_app)
+
 # --- DATABASE SETUP & AUTO-REPAIR ---
+# Tables (and the view over them) that move to the history DB in the split layout. Billing state
+# (users, tasks, voucher_usage) stays in the main DB so a charge/refund commits in a single file.
+HISTORY_TABLES = ('logs', 'usage_daily', 'stats_hourly', 'stats_daily', 'active_users')
+HISTORY_VIEWS = ('user_daily_stats',)
+
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
+    if PROFILE_ENABLED and has_request_context() and 'profile' in g:
+        conn = sqlite3.connect(DB_PATH, factory=ProfiledConnection)
+        conn.sql_log = g.profile['sql']
+    else:
+        conn = sqlite3.connect(DB_PATH, factory=DBConnection)
     conn.row_factory = sqlite3.Row  # Allow accessing columns by name
+    if STORAGE_LAYOUT == 'split':
+        # Unqualified names fall through to attached schemas, so queries need no changes
+        conn.execute("ATTACH DATABASE ? AS history", (HISTORY_DB_PATH,))
     return conn
 
+# Read-only connections for admin pages and reports. They open the files with mode=ro and
+# PRAGMA query_only and run in autocommit, so every SELECT is its own short read transaction
+# that, under WAL, reads a snapshot without blocking the billing writes made through get_db().
+# Call sites that write use get_db(); read-only ones use get_read_db(). Both end with conn.close().
+class ReadConnection(sqlite3.Connection):
+    pool = None
+
+    def close(self):
+        if self.pool is None or not self.pool.release(self):
+            super().close()
+
+class ReadPool:
+    """Idle read-only connections kept for reuse in this process (at most size of them)."""
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def acquire(self):
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+        return conn or open_read_db(ReadConnection, self)
+
+    def release(self, conn):
+        """Keep conn for the next caller; False when the pool is full and it should really close."""
+        if conn.in_transaction:
+            conn.rollback()
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return True
+        return False
+
+    def reset(self):
+        # Connections opened before a fork belong to the parent; the child starts empty
+        self.lock = threading.Lock()
+        self.idle = []
+
+read_pool = ReadPool(READ_POOL_SIZE)
+
+def open_read_db(factory=ReadConnection, pool=None, sql_log=None):
+    conn = sqlite3.connect(f"file:{os.path.abspath(DB_PATH)}?mode=ro", uri=True, factory=factory,
+                           isolation_level=None, check_same_thread=False)
+    conn.pool = pool
+    if sql_log is not None:
+        conn.sql_log = sql_log  # before the first execute: ProfiledCursor appends to it
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA query_only = ON")
+    if STORAGE_LAYOUT == 'split':
+        conn.execute("ATTACH DATABASE ? AS history", (f"file:{os.path.abspath(HISTORY_DB_PATH)}?mode=ro",))
+    return conn
+
+def get_read_db():
+    """Read-only connection from read_pool; any write through it fails with 'readonly database'."""
+    if PROFILE_ENABLED and has_request_context() and 'profile' in g:
+        return open_read_db(ProfiledConnection, sql_log=g.profile['sql'])
+    return read_pool.acquire()
+
+def history_schema(conn):
+    """Schema prefix for creating history tables: 'history.' once the split layout is in place."""
+    if STORAGE_LAYOUT != 'split':
+        return ""
+    pending = conn.execute(f"SELECT name FROM main.sqlite_master WHERE type='table' AND name IN ({','.join('?' * len(HISTORY_TABLES))})",
+                           HISTORY_TABLES).fetchall()
+    if pending:
+        # Main still holds the history tables and would shadow the attached ones; keep using them until migrated
+        print(f"[STORAGE] STORAGE_LAYOUT=split but {', '.join(r[0] for r in pending)} still in {DB_PATH}; run `flask split-storage`")
+        return ""
+    return "history."
+
+# name -> query producing (dim, value) from the source tables; the triggers below keep the same numbers current
+COUNTER_SOURCES = {
+    'users_plan': "SELECT COALESCE(plan, ''), COUNT(*) FROM users GROUP BY 1",
+    'users_status': "SELECT COALESCE(CAST(is_active AS TEXT), ''), COUNT(*) FROM users GROUP BY 1",
+    'tasks_status': "SELECT COALESCE(status, ''), COUNT(*) FROM tasks GROUP BY 1",
+    'tasks_key': "SELECT api_key, COUNT(*) FROM tasks WHERE api_key IS NOT NULL GROUP BY 1",
+}
+
+def _counter_sql(name, dim, delta):
+    return f"""INSERT INTO counters (name, dim, value) VALUES ('{name}', {dim}, {delta})
+               ON CONFLICT(name, dim) DO UPDATE SET value = value + {delta};"""
+
+COUNTER_TRIGGERS = [
+    f"""CREATE TRIGGER IF NOT EXISTS trg_users_counters_ins AFTER INSERT ON users BEGIN
+        {_counter_sql('users_plan', "COALESCE(NEW.plan, '')", 1)}
+        {_counter_sql('users_status', "COALESCE(CAST(NEW.is_active AS TEXT), '')", 1)}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_users_counters_del AFTER DELETE ON users BEGIN
+        {_counter_sql('users_plan', "COALESCE(OLD.plan, '')", -1)}
+        {_counter_sql('users_status', "COALESCE(CAST(OLD.is_active AS TEXT), '')", -1)}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_users_counters_plan AFTER UPDATE OF plan ON users WHEN OLD.plan IS NOT NEW.plan BEGIN
+        {_counter_sql('users_plan', "COALESCE(OLD.plan, '')", -1)}
+        {_counter_sql('users_plan', "COALESCE(NEW.plan, '')", 1)}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_users_counters_status AFTER UPDATE OF is_active ON users WHEN OLD.is_active IS NOT NEW.is_active BEGIN
+        {_counter_sql('users_status', "COALESCE(CAST(OLD.is_active AS TEXT), '')", -1)}
+        {_counter_sql('users_status', "COALESCE(CAST(NEW.is_active AS TEXT), '')", 1)}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_tasks_counters_ins AFTER INSERT ON tasks BEGIN
+        {_counter_sql('tasks_status', "COALESCE(NEW.status, '')", 1)}
+        INSERT INTO counters (name, dim, value) SELECT 'tasks_key', NEW.api_key, 1 WHERE NEW.api_key IS NOT NULL
+            ON CONFLICT(name, dim) DO UPDATE SET value = value + 1;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_tasks_counters_del AFTER DELETE ON tasks BEGIN
+        {_counter_sql('tasks_status', "COALESCE(OLD.status, '')", -1)}
+        UPDATE counters SET value = value - 1 WHERE name = 'tasks_key' AND dim = OLD.api_key;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_tasks_counters_status AFTER UPDATE OF status ON tasks WHEN OLD.status IS NOT NEW.status BEGIN
+        {_counter_sql('tasks_status', "COALESCE(OLD.status, '')", -1)}
+        {_counter_sql('tasks_status', "COALESCE(NEW.status, '')", 1)}
+    END""",
+]
+
+def rebuild_counters(conn, fix=True):
+    """Recount every counter from the source tables. Returns {(name, dim): (stored, actual)} for the
+    counters that had drifted; with fix they are corrected in the caller's transaction.
+    Stored and actual values must come from one snapshot: call inside a transaction on conn."""
+    stored = {(r[0], r[1]): r[2] for r in conn.execute("SELECT name, dim, value FROM counters").fetchall()}
+    actual = {}
+    for name, sql in COUNTER_SOURCES.items():
+        for dim, value in conn.execute(sql).fetchall():
+            actual[(name, dim)] = value
+    drift = {k: (stored.get(k, 0), actual.get(k, 0)) for k in set(stored) | set(actual) if stored.get(k, 0) != actual.get(k, 0)}
+    if fix:
+        apply_counter_drift(conn, drift)
+    return drift
+
+def apply_counter_drift(conn, drift):
+    """Add each drifted counter's (actual - stored) difference. Adding rather than overwriting keeps
+    the trigger updates made since the snapshot the drift was measured on."""
+    if drift:
+        conn.executemany("INSERT INTO counters (name, dim, value) VALUES (?, ?, ?) ON CONFLICT(name, dim) DO UPDATE SET value = value + excluded.value",
+                         [(name, dim, actual - stored) for (name, dim), (stored, actual) in drift.items()])
+
+def get_counters(conn, name):
+    return {r[0]: r[1] for r in conn.execute("SELECT dim, value FROM counters WHERE name = ?", (name,)).fetchall()}
+
 def init_and_migrate_db():
     conn = get_db()
     c = conn.cursor()
+    H = history_schema(conn)
+    # WAL so readers (admin pages, reports, get_read_db) never block the writer
+    c.execute("PRAGMA main.journal_mode=WAL")
+    if STORAGE_LAYOUT == 'split':
+        # Each file has its own writer lock
+        c.execute("PRAGMA history.journal_mode=WAL")
     
     # 1. Create Base Tables if not exist
     c.execute('''CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS logs (id INTEGER PRIMARY KEY AUTOINCREMENT)''')
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {H}logs (id INTEGER PRIMARY KEY AUTOINCREMENT)''')
     c.execute('''CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)''')
     c.execute('''CREATE TABLE IF NOT EXISTS vouchers (code TEXT PRIMARY KEY)''')
     c.execute('''CREATE TABLE IF NOT EXISTS voucher_usage (id INTEGER PRIMARY KEY AUTOINCREMENT)''')
     c.execute('''CREATE TABLE IF NOT EXISTS tasks (task_id TEXT PRIMARY KEY)''')
     c.execute('''CREATE TABLE IF NOT EXISTS banned_ips (ip TEXT PRIMARY KEY)''')
     c.execute('''CREATE TABLE IF NOT EXISTS api_keys (key_value TEXT PRIMARY KEY)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS job_leases (name TEXT PRIMARY KEY, owner TEXT, expires_ts REAL)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS generation_requests (idem_key TEXT PRIMARY KEY, username TEXT, status TEXT,
+                 task_id TEXT, response TEXT, http_status INTEGER, created_ts INTEGER)''')
+    # Per-user, per-day usage counters maintained incrementally by the API (see record_usage)
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {H}usage_daily (username TEXT NOT NULL, day TEXT NOT NULL,
+                 generations INTEGER NOT NULL DEFAULT 0, credits_spent INTEGER NOT NULL DEFAULT 0,
+                 refunds INTEGER NOT NULL DEFAULT 0, credits_refunded INTEGER NOT NULL DEFAULT 0,
+                 session_minutes INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (username, day)) WITHOUT ROWID''')
+    c.execute(f'''CREATE INDEX IF NOT EXISTS {H}idx_usage_daily_day ON usage_daily (day)''')
+    # Global analytics rollups: one row per (bucket, metric, dimension), hourly and daily
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {H}stats_hourly (bucket TEXT NOT NULL, metric TEXT NOT NULL, dim TEXT NOT NULL DEFAULT '',
+                 value INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (bucket, metric, dim)) WITHOUT ROWID''')
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {H}stats_daily (bucket TEXT NOT NULL, metric TEXT NOT NULL, dim TEXT NOT NULL DEFAULT '',
+                 value INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (bucket, metric, dim)) WITHOUT ROWID''')
+    # Users already counted as active in the current hour/day (old buckets are pruned)
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {H}active_users (bucket TEXT NOT NULL, username TEXT NOT NULL,
+                 PRIMARY KEY (bucket, username)) WITHOUT ROWID''')
+    # users.daily_stats is superseded by this view derived from the rollups
+    c.execute(f'''CREATE VIEW IF NOT EXISTS {H}user_daily_stats AS
+                 SELECT username, json_group_object(day, json_object('generations', generations, 'credits_spent', credits_spent,
+                        'refunds', refunds, 'credits_refunded', credits_refunded, 'session_minutes', session_minutes)) AS daily_stats
+                 FROM usage_daily GROUP BY username''')
 
     # 2. Define Schema Requirements (Table, Column, Type, Default)
     required_columns = [
@@ -53,27 +677,35 @@ def init_and_migrate_db():
         ("users", "custom_limit", "INTEGER DEFAULT NULL"), ("users", "custom_cost_2", "INTEGER DEFAULT NULL"),
         ("users", "custom_cost_pro", "INTEGER DEFAULT NULL"), ("users", "assigned_api_key", "TEXT DEFAULT NULL"),
         ("users", "last_seen", "TEXT"), ("users", "session_minutes", "INTEGER DEFAULT 0"), ("users", "daily_stats", "TEXT DEFAULT '{}'"),
+        ("users", "expiry_ts", "INTEGER"), ("users", "created_ts", "INTEGER"), ("users", "last_seen_ts", "INTEGER"),
         
         # Logs - ADD task_id HERE
         ("logs", "username", "TEXT"), ("logs", "action", "TEXT"), ("logs", "cost", "INTEGER"), 
-        ("logs", "timestamp", "TEXT"), ("logs", "status", "TEXT"), ("logs", "task_id", "TEXT"),
+        ("logs", "timestamp", "TEXT"), ("logs", "status", "TEXT"), ("logs", "task_id", "TEXT"), ("logs", "ts", "INTEGER"),
         
         # Vouchers
         ("vouchers", "amount", "INTEGER"), ("vouchers", "max_uses", "INTEGER DEFAULT 1"), 
         ("vouchers", "current_uses", "INTEGER DEFAULT 0"), ("vouchers", "expiry_date", "TEXT"), ("vouchers", "created_at", "TEXT"),
+        ("vouchers", "expiry_ts", "INTEGER"), ("vouchers", "created_ts", "INTEGER"),
         
         # Voucher Usage
         ("voucher_usage", "code", "TEXT"), ("voucher_usage", "username", "TEXT"), ("voucher_usage", "used_at", "TEXT"),
+        ("voucher_usage", "used_ts", "INTEGER"),
         
         # Tasks
         ("tasks", "username", "TEXT"), ("tasks", "cost", "INTEGER"), ("tasks", "status", "TEXT"), 
-        ("tasks", "created_at", "TEXT"), ("tasks", "model", "TEXT"),
+        ("tasks", "created_at", "TEXT"), ("tasks", "model", "TEXT"), ("tasks", "provider", "TEXT"),
+        ("tasks", "result_json", "TEXT DEFAULT NULL"), ("tasks", "created_ts", "INTEGER"), ("tasks", "api_key", "TEXT DEFAULT NULL"),
         
         # Banned IPs
-        ("banned_ips", "reason", "TEXT"), ("banned_ips", "banned_at", "TEXT"),
+        ("banned_ips", "reason", "TEXT"), ("banned_ips", "banned_at", "TEXT"), ("banned_ips", "banned_ts", "INTEGER"),
         
         # API Keys
-        ("api_keys", "label", "TEXT"), ("api_keys", "is_active", "INTEGER DEFAULT 1"), ("api_keys", "error_count", "INTEGER DEFAULT 0")
+        ("api_keys", "label", "TEXT"), ("api_keys", "is_active", "INTEGER DEFAULT 1"), ("api_keys", "error_count", "INTEGER DEFAULT 0"),
+        ("api_keys", "provider", "TEXT DEFAULT NULL"), ("api_keys", "requests_total", "INTEGER DEFAULT 0"),
+        ("api_keys", "throttled_total", "INTEGER DEFAULT 0"), ("api_keys", "credits_used", "REAL DEFAULT 0"),
+        ("api_keys", "last_failure", "TEXT DEFAULT NULL"), ("api_keys", "last_failure_at", "TEXT DEFAULT NULL"),
+        ("api_keys", "balance", "REAL DEFAULT NULL"), ("api_keys", "balance_checked_ts", "REAL DEFAULT NULL")
     ]
 
     # 3. Check and Add Missing Columns (Safe Migration)
@@ -89,6 +721,26 @@ def init_and_migrate_db():
             except Exception as e:
                 print(f"Migration failed for {table}.{col}: {e}")
 
+    # Indexes for background scans
+    # task_id makes the reaper's keyset position unique; this replaces idx_tasks_status_created
+    c.execute("DROP INDEX IF EXISTS idx_tasks_status_created")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tasks_status_created_id ON tasks (status, created_at, task_id)")
+    # Epoch columns (*_ts) back time-range filters and retention deletes; see `flask backfill-timestamps`
+    c.execute(f"CREATE INDEX IF NOT EXISTS {H}idx_logs_ts ON logs (ts)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tasks_created_ts ON tasks (created_ts)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_expiry_ts ON users (expiry_ts)")
+    # Per-user task history, newest first (keyset pagination in /api/tasks)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tasks_user_created ON tasks (username, created_at, task_id)")
+
+    # Counters kept current by triggers, so dashboard totals are a primary-key read
+    c.execute('''CREATE TABLE IF NOT EXISTS counters (name TEXT NOT NULL, dim TEXT NOT NULL DEFAULT '',
+                 value INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (name, dim)) WITHOUT ROWID''')
+    fresh_counters = c.execute("SELECT 1 FROM counters LIMIT 1").fetchone() is None
+    for sql in COUNTER_TRIGGERS:
+        c.execute(sql)
+    if fresh_counters:
+        rebuild_counters(conn)
+
     # 4. Insert Default Settings
     defaults = {
         'cost_sora_2': '25', 'cost_sora_2_pro': '35',
@@ -106,23 +758,196 @@ def init_and_migrate_db():
     conn.commit()
     conn.close()
 
-# Run Auto-Repair on Start
-init_and_migrate_db()
+# Run Auto-Repair on Start (once per importing process: the master under gunicorn.conf.py)
+startup_mark("setup")
+if DB_INIT_ON_IMPORT:
+    init_and_migrate_db()
+    startup_mark("db_init")
 
 # --- HELPER FUNCTIONS ---
+class SettingsCache:
+    """All settings loaded in one query and reused for SETTINGS_CACHE_TTL seconds.
+    Values derived from a snapshot (response blocks, ETags) are computed once per snapshot."""
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.values = {}
+        self.derived = {}
+        self.loaded_at = 0
+
+    def snapshot(self):
+        if time.time() - self.loaded_at > self.ttl:
+            conn = get_db()
+            values = {row['key']: row['value'] for row in conn.execute("SELECT key, value FROM settings").fetchall()}
+            conn.close()
+            with self.lock:
+                self.values, self.derived, self.loaded_at = values, {}, time.time()
+        return self.values
+
+    def get(self, key, default=None):
+        value = self.snapshot().get(key)
+        return default if value is None else value
+
+    def derive(self, name, fn):
+        values = self.snapshot()
+        with self.lock:
+            if name not in self.derived:
+                self.derived[name] = fn(values)
+            return self.derived[name]
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded_at = 0
+
+settings_cache = SettingsCache(SETTINGS_CACHE_TTL)
+
+def now_stamp():
+    """(text, epoch) for the current time: the text column keeps its old format, *_ts gets the integer."""
+    now = datetime.now()
+    return str(now), int(now.timestamp())
+
+def date_epoch(value):
+    """Epoch of local midnight starting a YYYY-MM-DD date (what expiry_date means), None if unset or invalid."""
+    try:
+        return int(datetime.strptime(value, "%Y-%m-%d").timestamp())
+    except (TypeError, ValueError):
+        return None
+
 def get_setting(key, default=None):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT value FROM settings WHERE key=?", (key,))
-    row = c.fetchone()
-    conn.close()
-    return row['value'] if row else default
+    return settings_cache.get(key, default)
+
+def payload_etag(payload):
+    return '"' + hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()[:20] + '"'
+
+USAGE_COLUMNS = ('generations', 'credits_spent', 'refunds', 'credits_refunded', 'session_minutes')
+
+# --- HISTORY WRITES ---
+class HistoryWriter:
+    """Split layout: logs/usage_daily rows of committed transactions, appended to the history
+    file every HISTORY_FLUSH_INTERVAL seconds by the history-flush job in a transaction of
+    their own, so billing only takes the main file's write lock."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rows = []
+
+    def add(self, rows):
+        with self.lock:
+            self.rows.extend(rows)
+
+    def flush(self):
+        with self.lock:
+            rows, self.rows = self.rows, []
+        if not rows:
+            return
+        try:
+            conn = get_db()
+            for sql, params in rows:
+                conn.execute(sql, params)
+            conn.commit()
+            conn.close()
+        except sqlite3.Error as e:
+            print(f"[HISTORY] Flush failed, keeping {len(rows)} rows for next time: {e}")
+            with self.lock:
+                self.rows[:0] = rows
+
+history_writer = HistoryWriter()
+atexit.register(history_writer.flush)
+
+def history_write(conn, sql, params):
+    """Write a logs/usage_daily row with conn's transaction.
+
+    Single layout: executed now, so it commits atomically with the billing change. Split
+    layout: queued on the connection and appended by history_writer after the commit; a crash
+    in between can lose the row, never the credit change it describes."""
+    if STORAGE_LAYOUT == 'split':
+        conn.history_rows.append((sql, params))
+    else:
+        conn.execute(sql, params)
+
+def record_log(conn, username, action, cost, status, task_id=None, stamp=None):
+    timestamp, ts = stamp or now_stamp()
+    history_write(conn, "INSERT INTO logs (username, action, cost, timestamp, ts, status, task_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                  (username, action, cost, timestamp, ts, status, task_id))
+
+def record_usage(conn, username, day=None, **deltas):
+    """Add deltas to a user's usage_daily row, with the caller's transaction (see history_write)."""
+    day = day or datetime.now().strftime("%Y-%m-%d")
+    values = [int(deltas.get(col, 0)) for col in USAGE_COLUMNS]
+    history_write(conn, f"""INSERT INTO usage_daily (username, day, {', '.join(USAGE_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?)
+                     ON CONFLICT(username, day) DO UPDATE SET {', '.join(f'{col} = {col} + excluded.{col}' for col in USAGE_COLUMNS)}""",
+                  (username, day, *values))
+
+# --- ANALYTICS ROLLUPS ---
+class StatsBuffer:
+    """Collects analytics counters in memory and flushes them to stats_hourly/stats_daily
+    in one transaction every ANALYTICS_FLUSH_INTERVAL seconds from the analytics-flush job.
+    add() never writes: it usually runs inside a billing transaction that holds the write lock."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        self.active = set()
+        self.seen = set()
+        self.next_prune = 0
+
+    def add(self, metric, dim='', value=1):
+        hour = datetime.now().strftime("%Y-%m-%d %H")
+        with self.lock:
+            self.counts[(hour, metric, dim or '')] += value
+
+    def mark_active(self, username):
+        if not username:
+            return
+        hour = datetime.now().strftime("%Y-%m-%d %H")
+        with self.lock:
+            if (hour, username) in self.seen:
+                return
+            self.seen.add((hour, username))
+            self.active.add((hour, username))
+
+    def flush(self):
+        with self.lock:
+            counts, active = self.counts, self.active
+            self.counts, self.active = Counter(), set()
+            current_hour = datetime.now().strftime("%Y-%m-%d %H")
+            self.seen = {x for x in self.seen if x[0] == current_hour}
+        if not counts and not active:
+            return
+        hourly, daily = Counter(), Counter()
+        for (hour, metric, dim), v in counts.items():
+            hourly[(hour, metric, dim)] += v
+            daily[(hour[:10], metric, dim)] += v
+        try:
+            conn = get_db()
+            for hour, username in active:
+                # Distinct counts cannot be summed, so hour and day are deduplicated separately
+                if conn.execute("INSERT OR IGNORE INTO active_users (bucket, username) VALUES (?, ?)", (hour, username)).rowcount:
+                    hourly[(hour, 'active_users', '')] += 1
+                if conn.execute("INSERT OR IGNORE INTO active_users (bucket, username) VALUES (?, ?)", (hour[:10], username)).rowcount:
+                    daily[(hour[:10], 'active_users', '')] += 1
+            for table, rows in (('stats_hourly', hourly), ('stats_daily', daily)):
+                conn.executemany(f"""INSERT INTO {table} (bucket, metric, dim, value) VALUES (?, ?, ?, ?)
+                                     ON CONFLICT(bucket, metric, dim) DO UPDATE SET value = value + excluded.value""",
+                                 [(*k, v) for k, v in rows.items()])
+            if time.time() >= self.next_prune:
+                self.next_prune = time.time() + 3600
+                conn.execute("DELETE FROM active_users WHERE bucket < ?", ((datetime.now() - timedelta(days=2)).strftime("%Y-%m-%d"),))
+            conn.commit()
+            conn.close()
+        except sqlite3.Error as e:
+            print(f"[ANALYTICS] Flush failed, keeping counters for next time: {e}")
+            with self.lock:
+                self.counts.update(counts)
+                self.active |= active
+
+analytics = StatsBuffer()
+atexit.register(analytics.flush)
 
 def set_setting(key, value):
     conn = get_db()
     conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, str(value)))
     conn.commit()
     conn.close()
+    settings_cache.invalidate()
 
 def generate_voucher_code(amount):
     chars = string.ascii_uppercase + string.digits
@@ -133,25 +958,950 @@ def get_client_ip():
         return request.headers.getlist("X-Forwarded-For")[0]
     return request.remote_addr
 
-def get_active_api_key(username=None):
+# --- UPSTREAM KEY USAGE ---
+# Replies that mean the key itself is out of credit upstream
+QUOTA_MESSAGE_RE = re.compile(r"insufficient|quota|balance|out of credits", re.I)
+
+class KeyUsageTracker:
+    """Per-key upstream usage seen by this worker.
+
+    Request, failure, 429 and credit totals are buffered and added to the api_keys row
+    every KEY_USAGE_FLUSH_INTERVAL seconds by the key-usage-flush job (never by the
+    caller, which may be inside a billing transaction). The rolling 429 rate and the credits spent
+    since the last balance probe stay in memory; get_active_api_key uses them to move
+    strained keys to the back before they start failing generations."""
+    def __init__(self, window):
+        self.window = window
+        self.lock = threading.Lock()
+        self.pending = {}        # key -> Counter of totals not written yet
+        self.last_failure = {}   # key -> (reason, stamp) not written yet
+        self.exhausted = set()   # keys the upstream reported out of credit, balance 0 not written yet
+        self.calls = {}          # key -> deque of call times inside the window
+        self.throttles = {}      # key -> deque of 429 times inside the window
+        self.spent = Counter()   # credits used since the balance probe we last saw
+        self.probe_seen = {}     # key -> balance_checked_ts the spend is counted from
+
+    def _add(self, key, **deltas):
+        self.pending.setdefault(key, Counter()).update(deltas)
+
+    def _trim(self, q, now):
+        while q and q[0] < now - self.window:
+            q.popleft()
+
+    def request(self, key):
+        now = time.time()
+        with self.lock:
+            self._add(key, requests=1)
+            q = self.calls.setdefault(key, deque())
+            q.append(now)
+            self._trim(q, now)
+
+    def failure(self, key, reason, throttled=False, exhausted=False):
+        now = time.time()
+        with self.lock:
+            self._add(key, failures=1, throttled=int(throttled))
+            self.last_failure[key] = (reason[:200], now_stamp()[0])
+            if throttled:
+                q = self.throttles.setdefault(key, deque())
+                q.append(now)
+                self._trim(q, now)
+            if exhausted:
+                self.exhausted.add(key)
+
+    def rejected(self, key, message):
+        """A 200 reply refusing the task; only quota messages say something about the key."""
+        if key and message and QUOTA_MESSAGE_RE.search(str(message)):
+            self.failure(key, str(message), exhausted=True)
+
+    def success(self, key, credits):
+        with self.lock:
+            self._add(key, credits=credits)
+            self.spent[key] += credits
+
+    def throttle_rate(self, key):
+        """(share of calls answered 429, calls) over the last KEY_THROTTLE_WINDOW seconds."""
+        now = time.time()
+        with self.lock:
+            calls, throttles = self.calls.get(key, ()), self.throttles.get(key, ())
+            for q in (calls, throttles):
+                if q:
+                    self._trim(q, now)
+            return (len(throttles) / len(calls) if calls else 0.0), len(calls)
+
+    def estimated_balance(self, key, balance, checked_ts):
+        """The last probed balance minus what this worker has spent on the key since;
+        None when there is no reading or it is older than KEY_BALANCE_MAX_AGE."""
+        if balance is None or checked_ts is None or time.time() - checked_ts > KEY_BALANCE_MAX_AGE:
+            return None
+        with self.lock:
+            if self.probe_seen.get(key) != checked_ts:
+                self.probe_seen[key] = checked_ts
+                self.spent[key] = 0
+            return max(0.0, balance - self.spent[key])
+
+    def strained(self, row):
+        if row['key_value'] in self.exhausted:
+            return True
+        rate, calls = self.throttle_rate(row['key_value'])
+        if calls >= KEY_THROTTLE_MIN_REQUESTS and rate >= KEY_THROTTLE_LIMIT:
+            return True
+        left = self.estimated_balance(row['key_value'], row['balance'], row['balance_checked_ts'])
+        return left is not None and left < KEY_LOW_BALANCE
+
+    def pick(self, rows):
+        """Random healthy key; when every key is strained, the one with the most balance left."""
+        if not rows:
+            return None
+        healthy = [r for r in rows if not self.strained(r)]
+        if healthy:
+            return random.choice(healthy)['key_value']
+        rows = random.sample(rows, len(rows))
+        left = lambda r: self.estimated_balance(r['key_value'], r['balance'], r['balance_checked_ts'])
+        return max(rows, key=lambda r: float('inf') if left(r) is None else left(r))['key_value']
+
+    def flush(self):
+        with self.lock:
+            pending, failures, exhausted = self.pending, self.last_failure, self.exhausted
+            self.pending, self.last_failure, self.exhausted = {}, {}, set()
+        if not pending and not exhausted:
+            return
+        try:
+            conn = get_db()
+            conn.executemany("""UPDATE api_keys SET requests_total = requests_total + ?, error_count = error_count + ?,
+                                throttled_total = throttled_total + ?, credits_used = credits_used + ? WHERE key_value=?""",
+                             [(c['requests'], c['failures'], c['throttled'], c['credits'], k) for k, c in pending.items()])
+            conn.executemany("UPDATE api_keys SET last_failure=?, last_failure_at=? WHERE key_value=?",
+                             [(reason, at, k) for k, (reason, at) in failures.items()])
+            # Other workers see the key as empty until the next probe says otherwise
+            conn.executemany("UPDATE api_keys SET balance=0, balance_checked_ts=? WHERE key_value=?",
+                             [(time.time(), k) for k in exhausted])
+            conn.commit()
+            conn.close()
+        except sqlite3.Error as e:
+            print(f"[KEYS] Usage flush failed, keeping totals for next time: {e}")
+            with self.lock:
+                for k, c in pending.items():
+                    self._add(k, **c)
+                for k, v in failures.items():
+                    self.last_failure.setdefault(k, v)
+                self.exhausted |= exhausted
+
+    def status(self, rows):
+        """Live per-key view for the admin page: rolling 429 rate and estimated balance."""
+        out = {}
+        for r in rows:
+            rate, calls = self.throttle_rate(r['key_value'])
+            out[r['key_value']] = {
+                "window_calls": calls, "throttle_rate": round(rate, 3),
+                "estimated_balance": self.estimated_balance(r['key_value'], r['balance'], r['balance_checked_ts']),
+                "strained": self.strained(r),
+            }
+        return out
+
+key_usage = KeyUsageTracker(KEY_THROTTLE_WINDOW)
+atexit.register(key_usage.flush)
+
+def get_active_api_key(username=None, provider=None, exclude=()):
+    """Pick an upstream key. Keys with provider NULL are usable for every provider.
+    A user's assigned key is pinned; pool keys listed in exclude are skipped, and
+    strained keys are only picked when no healthy one is left (see KeyUsageTracker)."""
     conn = get_db()
     if username:
-        user = conn.execute("SELECT assigned_api_key FROM users WHERE username=?", (username,)).fetchone()
+        user = conn.execute("""SELECT u.assigned_api_key FROM users u LEFT JOIN api_keys k ON k.key_value = u.assigned_api_key
+                               WHERE u.username=? AND (? IS NULL OR k.provider IS NULL OR k.provider = ?)""",
+                            (username, provider, provider)).fetchone()
         if user and user['assigned_api_key']:
             conn.close()
             return user['assigned_api_key']
-    keys = conn.execute("SELECT key_value FROM api_keys WHERE is_active=1 ORDER BY RANDOM() LIMIT 1").fetchone()
+    exclude = list(exclude)
+    keys = conn.execute(f"""SELECT key_value, balance, balance_checked_ts FROM api_keys
+                            WHERE is_active=1 AND (? IS NULL OR provider IS NULL OR provider = ?)
+                            AND key_value NOT IN ({','.join('?' * len(exclude))})""",
+                        (provider, provider, *exclude)).fetchall()
+    conn.close()
+    return key_usage.pick(keys)
+
+# --- UPSTREAM PROVIDERS ---
+# Each upstream declares its endpoints, how a client request is translated and what it costs us.
+# Override the defaults with UPSTREAM_PROVIDERS_FILE (same shape as below); the file is re-read when it changes.
+DEFAULT_PROVIDER_CONFIG = {
+    "policy": "priority",  # priority | latency | cost
+    "routes": {},          # optional explicit order per client model, e.g. {"sora-2-pro": ["freesora", "mock"]}
+    "providers": [
+        {
+            "name": "freesora", "base_url": UPSTREAM_BASE_URL, "enabled": True, "priority": 0,
+            "generate_path": "/api/v1/video/sora-pro", "check_path": "/api/video-generations/check-result",
+            "models": {
+                "sora-2": {"api_model": "sora-2-text-to-video", "nFrames": "10", "cost": 1.0},
+                "sora-2-pro": {"api_model": "sora-2-text-to-video", "nFrames": "15", "cost": 1.0}
+            },
+            "default_model": "sora-2",
+            "aspect_ratios": {"9:16": "portrait", "default": "landscape"},
+            "extra_payload": {"removeWatermark": True},
+            "headers": {"User-Agent": "Mozilla/5.0"},
+            "timeout": 120, "check_timeout": 60
+        },
+        {
+            "name": "mock", "base_url": MOCK_UPSTREAM_URL, "enabled": False, "priority": 100,
+            "generate_path": "/api/v1/video/sora-pro", "check_path": "/api/video-generations/check-result",
+            "models": {
+                "sora-2": {"api_model": "sora-2-text-to-video", "nFrames": "10", "cost": 0.0},
+                "sora-2-pro": {"api_model": "sora-2-text-to-video", "nFrames": "15", "cost": 0.0}
+            },
+            "default_model": "sora-2",
+            "aspect_ratios": {"9:16": "portrait", "default": "landscape"},
+            "extra_payload": {"removeWatermark": True},
+            "idempotency_header": "Idempotency-Key",
+            "balance_path": "/api/v1/account/balance", "balance_field": "data.balance",
+            "timeout": 30, "check_timeout": 10
+        }
+    ]
+}
+PROVIDER_FAILURE_THRESHOLD = 3   # consecutive failures before a provider is benched
+PROVIDER_COOLDOWN = 30           # seconds a benched provider is skipped
+
+class UpstreamProvider:
+    def __init__(self, cfg):
+        self.name = cfg['name']
+        self.base_url = cfg['base_url'].rstrip('/')
+        self.enabled = cfg.get('enabled', True)
+        self.priority = cfg.get('priority', 0)
+        self.generate_url = self.base_url + cfg['generate_path']
+        self.check_url = self.base_url + cfg['check_path']
+        self.models = cfg.get('models', {})
+        self.default_model = cfg.get('default_model')
+        self.aspect_ratios = cfg.get('aspect_ratios', {})
+        self.extra_payload = cfg.get('extra_payload', {})
+        self.extra_headers = cfg.get('headers', {})
+        self.timeout = cfg.get('timeout', 120)
+        self.check_timeout = cfg.get('check_timeout', 60)
+        # Header the upstream uses to de-duplicate submissions; only then are ambiguous failures retried
+        self.idempotency_header = cfg.get('idempotency_header')
+        # Optional GET endpoint reporting the key's remaining credit, read from balance_field (dotted path)
+        self.balance_url = self.base_url + cfg['balance_path'] if cfg.get('balance_path') else None
+        self.balance_field = cfg.get('balance_field', 'data.balance')
+        # Live health, kept per process
+        self.latency_ms = None
+        self.consecutive_failures = 0
+        self.benched_until = 0
+
+    def supports(self, client_model):
+        return client_model in self.models or self.default_model in self.models
+
+    def cost(self, client_model):
+        return self.models.get(client_model, self.models.get(self.default_model, {})).get('cost', 1.0)
+
+    def translate(self, client_data):
+        """Build the upstream generate payload from the client's request body."""
+        client_model = client_data.get('model', '')
+        spec = self.models.get(client_model) or self.models.get(self.default_model, {})
+        aspect = client_data.get('aspectRatio', '16:9')
+        payload = {
+            "model": spec.get('api_model', client_model),
+            "prompt": client_data.get('prompt', ''),
+            "aspectRatio": self.aspect_ratios.get(aspect, self.aspect_ratios.get('default', aspect)),
+        }
+        payload.update(self.extra_payload)
+        if spec.get('nFrames'):
+            payload["nFrames"] = spec['nFrames']
+        return payload
+
+    def headers(self, api_key):
+        h = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+        h.update(self.extra_headers)
+        return h
+
+    def is_available(self):
+        return self.enabled and time.time() >= self.benched_until
+
+    def record(self, ok, elapsed_ms=None):
+        if elapsed_ms is not None:
+            self.latency_ms = elapsed_ms if self.latency_ms is None else 0.8 * self.latency_ms + 0.2 * elapsed_ms
+        if ok:
+            self.consecutive_failures = 0
+            self.benched_until = 0
+        else:
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= PROVIDER_FAILURE_THRESHOLD:
+                self.benched_until = time.time() + PROVIDER_COOLDOWN
+                print(f"[PROVIDER] {self.name} benched for {PROVIDER_COOLDOWN}s after {self.consecutive_failures} failures")
+
+class ProviderRegistry:
+    def __init__(self, path=""):
+        self.path = path
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.providers = {}
+        self.policy = "priority"
+        self.routes = {}
+        self._load(DEFAULT_PROVIDER_CONFIG)
+        self.reload_if_changed()
+
+    def _load(self, cfg):
+        old = self.providers
+        providers = {}
+        for pc in cfg.get('providers', []):
+            p = UpstreamProvider(pc)
+            if p.name in old:  # keep live health across reloads
+                p.latency_ms, p.consecutive_failures, p.benched_until = old[p.name].latency_ms, old[p.name].consecutive_failures, old[p.name].benched_until
+            providers[p.name] = p
+        self.providers = providers
+        self.policy = os.environ.get("UPSTREAM_POLICY") or cfg.get('policy', 'priority')
+        self.routes = cfg.get('routes', {})
+
+    def reload_if_changed(self):
+        if not self.path:
+            return
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime == self.mtime:
+            return
+        with self.lock:
+            try:
+                with open(self.path) as f:
+                    self._load(json.load(f))
+                self.mtime = mtime
+                print(f"[PROVIDER] Loaded {len(self.providers)} providers from {self.path} (policy={self.policy})")
+            except (OSError, ValueError, KeyError) as e:
+                print(f"[PROVIDER] Failed to load {self.path}: {e}")
+
+    def get(self, name):
+        self.reload_if_changed()
+        return self.providers.get(name) if name else None
+
+    def default(self):
+        self.reload_if_changed()
+        enabled = sorted((p for p in self.providers.values() if p.enabled), key=lambda p: p.priority)
+        return enabled[0] if enabled else None
+
+    def route(self, client_model):
+        """Ordered failover list of providers able to serve client_model."""
+        self.reload_if_changed()
+        if client_model in self.routes:
+            candidates = [self.providers[n] for n in self.routes[client_model] if n in self.providers]
+        else:
+            candidates = [p for p in self.providers.values() if p.supports(client_model)]
+        candidates = [p for p in candidates if p.enabled]
+        if client_model not in self.routes:
+            if self.policy == "latency":
+                # Unmeasured providers sort first so they get a latency sample
+                candidates.sort(key=lambda p: (p.latency_ms is not None, p.latency_ms or 0, p.priority))
+            elif self.policy == "cost":
+                candidates.sort(key=lambda p: (p.cost(client_model), p.priority))
+            else:
+                candidates.sort(key=lambda p: p.priority)
+        # Benched providers stay as a last resort
+        return [p for p in candidates if p.is_available()] + [p for p in candidates if not p.is_available()]
+
+providers = ProviderRegistry(UPSTREAM_PROVIDERS_FILE)
+
+def request_never_sent(exc):
+    """True when a requests error happened before the upstream could have received the call."""
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(exc, requests.exceptions.ConnectionError):
+        reason = getattr(exc.args[0], 'reason', None) if exc.args else None
+        return type(reason).__name__ in ('NewConnectionError', 'NameResolutionError')
+    return False
+
+# --- UPSTREAM RETRY POLICY ---
+# Statuses after which the upstream has certainly not created a task, split by what to fail over:
+KEY_RETRY_STATUSES = (401, 402, 403, 429)  # problem with this key -> next key, same provider
+PROVIDER_RETRY_STATUSES = (502, 503)       # upstream unavailable -> next provider
+# The task may or may not exist upstream: retried only when the provider de-duplicates submissions
+AMBIGUOUS_STATUSES = (500, 504)
+
+def backoff_delay(attempt, retry_after=None):
+    """Full-jitter exponential backoff, honouring Retry-After when the upstream sends one."""
+    delay = random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * (2 ** attempt)))
+    if retry_after:
+        try:
+            delay = max(delay, min(float(retry_after), UPSTREAM_BACKOFF_MAX))
+        except ValueError:
+            pass
+    return delay
+
+def record_key_request(api_key):
+    analytics.add('upstream_requests', api_key)
+    key_usage.request(api_key)
+
+def record_key_failure(api_key, reason, status=None):
+    print(f"[UPSTREAM] Key {api_key[:15]}... failed: {reason}")
+    analytics.add('upstream_failures', api_key)
+    key_usage.failure(api_key, reason, throttled=status == 429, exhausted=status == 402)
+
+class UpstreamAttempts:
+    """The retry policy of one generate submission, without the transport.
+
+    dispatch_generate and async_api.dispatch_generate drive it the same way: pick() chooses
+    the provider/key pair for the next attempt (a DB read), request() gives the call to send
+    with their own HTTP client, answered()/failed() classify the outcome and return True to
+    try again after backoff(), and result() is what the caller returns."""
+    def __init__(self, username, client_data, request_key):
+        self.username = username
+        self.client_data = client_data
+        self.request_key = request_key
+        self.candidates = providers.route(client_data.get('model', ''))
+        self.deadline = time.time() + UPSTREAM_DEADLINE
+        self.tried_keys = set()
+        self.pi = 0
+        self.attempt = 0
+        self.provider, self.api_key, self.response = None, None, None
+        self.error = ("System Busy", 503) if self.candidates else ("Model not available", 503)
+        self.retry_after = None
+        self.sent_at = None
+
+    def pick(self):
+        """Choose the provider/key for the next attempt; False when nothing can be sent."""
+        if not self.candidates:
+            return False
+        # Prefer a provider/key pair we have not tried yet, then fall back to reusing keys
+        self.provider, self.api_key = None, None
+        for offset in range(len(self.candidates)):
+            p = self.candidates[(self.pi + offset) % len(self.candidates)]
+            k = get_active_api_key(self.username, p.name, exclude=self.tried_keys)
+            if k:
+                self.provider, self.api_key, self.pi = p, k, self.pi + offset
+                break
+        if not self.api_key:
+            self.provider = self.candidates[self.pi % len(self.candidates)]
+            self.api_key = get_active_api_key(self.username, self.provider.name)
+        return bool(self.api_key) and self.deadline - time.time() >= 1
+
+    def request(self):
+        """(url, payload, headers, timeout) of the attempt pick() chose; counts it as sent."""
+        headers = self.provider.headers(self.api_key)
+        if self.provider.idempotency_header:
+            headers[self.provider.idempotency_header] = self.request_key
+        self.retry_after = None
+        record_key_request(self.api_key)
+        self.sent_at = time.time()
+        return (self.provider.generate_url, self.provider.translate(self.client_data), headers,
+                min(self.provider.timeout, self.deadline - self.sent_at))
+
+    def answered(self, r):
+        """An HTTP answer (requests or httpx response); True to retry, False to pass it on."""
+        self.provider.record(r.status_code < 500, (time.time() - self.sent_at) * 1000)
+        if r.status_code in KEY_RETRY_STATUSES or r.status_code in PROVIDER_RETRY_STATUSES:
+            record_key_failure(self.api_key, f"HTTP {r.status_code}", r.status_code)
+            self.tried_keys.add(self.api_key)
+            self.retry_after = r.headers.get("Retry-After")
+            if r.status_code in PROVIDER_RETRY_STATUSES:
+                self.pi += 1
+        elif r.status_code in AMBIGUOUS_STATUSES and self.provider.idempotency_header:
+            record_key_failure(self.api_key, f"HTTP {r.status_code}", r.status_code)
+        else:
+            self.response = r
+            return False
+        self.error = (f"API Error: {r.status_code}", r.status_code)
+        return True
+
+    def failed(self, exc, never_sent, timed_out):
+        """A transport error; True to retry."""
+        self.provider.record(False)
+        record_key_failure(self.api_key, type(exc).__name__)
+        self.tried_keys.add(self.api_key)
+        if never_sent:
+            self.error = ("System Busy", 503)
+            self.pi += 1
+        elif self.provider.idempotency_header:
+            self.error = ("Request timeout", 504) if timed_out else (str(exc), 502)
+        else:
+            # The upstream may have accepted the task; retrying could bill the user twice
+            self.error = ("Request timeout", 504) if timed_out else (str(exc), 500)
+            return False
+        return True
+
+    def backoff(self):
+        """Seconds to wait before the next attempt, or None when none is left inside the deadline."""
+        self.attempt += 1
+        if self.attempt >= UPSTREAM_MAX_ATTEMPTS:
+            return None
+        delay = backoff_delay(self.attempt - 1, self.retry_after)
+        if time.time() + delay + 1 >= self.deadline:
+            return None
+        print(f"[UPSTREAM] Retrying in {delay:.2f}s ({self.error[0]})")
+        return delay
+
+    def result(self):
+        """(provider, api_key, response, error), as returned by dispatch_generate."""
+        return self.provider, self.api_key, self.response, None if self.response is not None else self.error
+
+def dispatch_generate(username, client_data, request_key):
+    """Submit one generation upstream under the retry policy.
+
+    Tries providers in routing order and rotates through active keys, with jittered
+    backoff between attempts, all inside UPSTREAM_DEADLINE. Returns
+    (provider, api_key, response, error); response is None when no attempt produced
+    an answer to pass on, and error is then a (message, http_status) tuple.
+    """
+    attempts = UpstreamAttempts(username, client_data, request_key)
+    while attempts.pick():
+        url, api_payload, headers, timeout = attempts.request()
+        print(f"[DEBUG] API Call #{attempts.attempt + 1} to: {attempts.provider.name} {url}")
+        print(f"[DEBUG] API Payload: {api_payload}")
+        print(f"[DEBUG] Using API Key: {attempts.api_key[:15]}...")
+        try:
+            r = requests.post(url, json=api_payload, headers=headers, timeout=timeout)
+        except requests.exceptions.RequestException as e:
+            retry = attempts.failed(e, request_never_sent(e), isinstance(e, requests.exceptions.Timeout))
+        else:
+            retry = attempts.answered(r)
+        delay = attempts.backoff() if retry else None
+        if delay is None:
+            break
+        time.sleep(delay)
+    return attempts.result()
+
+def claim_idempotency_key(username, idem_key):
+    """Reserve a client Idempotency-Key before dispatching.
+
+    Returns None once claimed, a stored (body, status) to replay, or 'busy' while
+    another request with the same key is still in flight.
+    """
+    key = f"{username}:{idem_key}"
+    now = int(time.time())
+    conn = get_db()
+    try:
+        conn.execute("DELETE FROM generation_requests WHERE idem_key=? AND (created_ts < ? OR (status='in_flight' AND created_ts < ?))",
+                     (key, now - IDEMPOTENCY_TTL, now - int(UPSTREAM_DEADLINE) - 30))
+        cur = conn.execute("INSERT OR IGNORE INTO generation_requests (idem_key, username, status, created_ts) VALUES (?, ?, 'in_flight', ?)",
+                           (key, username, now))
+        conn.commit()
+        if cur.rowcount == 1:
+            return None
+        row = conn.execute("SELECT status, response, http_status FROM generation_requests WHERE idem_key=?", (key,)).fetchone()
+    finally:
+        conn.close()
+    if row and row['status'] == 'done':
+        return json.loads(row['response']), row['http_status']
+    return 'busy'
+
+def finish_idempotency_key(username, idem_key, body, status):
+    """Keep the reply when a task was created; otherwise release the key so the client can retry."""
+    key = f"{username}:{idem_key}"
+    conn = get_db()
+    if status == 200:
+        conn.execute("UPDATE generation_requests SET status='done', task_id=?, response=?, http_status=? WHERE idem_key=?",
+                     ((body.get('data') or {}).get('taskId'), json.dumps(body), status, key))
+    else:
+        conn.execute("DELETE FROM generation_requests WHERE idem_key=?", (key,))
+    conn.commit()
     conn.close()
-    return keys['key_value'] if keys else None
+
+# --- UPSTREAM DISPATCH QUEUE ---
+class DispatchTimeout(Exception):
+    pass
+
+class FairDispatcher:
+    """Gates upstream generate calls so the key pool is shared by plan instead of arrival order.
+
+    Waiters sit in a heap ordered by a tag. With "wfq" each user is a flow whose tags
+    advance by 1/weight per request (self-clocked fair queueing), so a Premium user
+    gets PLAN_WEIGHTS times a Mini user's share but a Mini burst still moves. "strict"
+    serves the highest weight first, "fifo" is arrival order and "off" disables gating.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.waiting = []
+        self.in_flight = 0
+        self.finish = {}
+        self.vtime = 0.0
+        self.seq = itertools.count()
+        self._capacity = (1, 0)
+        self.stats = {}
+        self.listeners = []  # called on every change, for waiters not parked on self.cond (async_api)
+
+    def capacity(self):
+        value, loaded_at = self._capacity
+        if time.time() - loaded_at > 30:
+            conn = get_db()
+            keys = conn.execute("SELECT COUNT(*) FROM api_keys WHERE is_active=1").fetchone()[0]
+            conn.close()
+            value = max(1, math.ceil(keys * UPSTREAM_SLOTS_PER_KEY / WEB_CONCURRENCY))
+            self._capacity = (value, time.time())
+        return value
+
+    def _tag(self, username, weight):
+        if DISPATCH_POLICY == 'strict':
+            return -weight
+        if DISPATCH_POLICY == 'fifo':
+            return 0
+        if len(self.finish) > 10000:
+            self.finish = {u: f for u, f in self.finish.items() if f > self.vtime}
+        tag = max(self.vtime, self.finish.get(username, 0)) + 1.0 / weight
+        self.finish[username] = tag
+        return tag
+
+    def _record(self, plan, waited_ms, timed_out=False):
+        st = self.stats.setdefault(plan, {"dispatched": 0, "timeouts": 0, "wait_ms_total": 0, "wait_ms_max": 0})
+        if timed_out:
+            st["timeouts"] += 1
+            return
+        st["dispatched"] += 1
+        st["wait_ms_total"] += waited_ms
+        st["wait_ms_max"] = max(st["wait_ms_max"], waited_ms)
+
+    def _notify(self):
+        self.cond.notify_all()
+        for listener in self.listeners:
+            listener()
+
+    def enqueue(self, username, plan):
+        """Queue a request; call with self.cond held. Returns the ticket to pass to admit()."""
+        ticket = (self._tag(username, max(float(PLAN_WEIGHTS.get(plan, 1)), 0.01)), next(self.seq))
+        heapq.heappush(self.waiting, ticket)
+        return ticket
+
+    def admit(self, ticket, plan, t0, capacity):
+        """Take a slot if ticket is first in line and one is free; call with self.cond held.
+        Returns False to keep waiting, raises DispatchTimeout once DISPATCH_QUEUE_TIMEOUT has passed."""
+        if self.waiting[0] == ticket and self.in_flight < capacity:
+            heapq.heappop(self.waiting)
+            self.in_flight += 1
+            if DISPATCH_POLICY == 'wfq':
+                self.vtime = ticket[0]
+            self._record(plan, int((time.time() - t0) * 1000))
+            # The next waiter may fit in a free slot too
+            self._notify()
+            return True
+        if time.time() - t0 >= DISPATCH_QUEUE_TIMEOUT:
+            self.waiting.remove(ticket)
+            heapq.heapify(self.waiting)
+            self._record(plan, 0, timed_out=True)
+            self._notify()
+            raise DispatchTimeout()
+        return False
+
+    def release(self):
+        with self.cond:
+            self.in_flight -= 1
+            self._notify()
+
+    @contextmanager
+    def slot(self, username, plan):
+        if DISPATCH_POLICY == 'off':
+            yield
+            return
+        plan = (plan or 'Standard').lower()
+        capacity = self.capacity()
+        t0 = time.time()
+        with self.cond:
+            ticket = self.enqueue(username, plan)
+            while not self.admit(ticket, plan, t0, capacity):
+                self.cond.wait(t0 + DISPATCH_QUEUE_TIMEOUT - time.time())
+        try:
+            yield
+        finally:
+            self.release()
+
+    def status(self):
+        with self.cond:
+            return {"policy": DISPATCH_POLICY, "capacity": self._capacity[0], "in_flight": self.in_flight,
+                    "queued": len(self.waiting), "weights": PLAN_WEIGHTS,
+                    "plans": {p: dict(st, wait_ms_avg=round(st["wait_ms_total"] / st["dispatched"], 1) if st["dispatched"] else 0)
+                              for p, st in self.stats.items()}}
+
+dispatcher = FairDispatcher()
+
+# --- TASK RESULTS ---
+TERMINAL_TASK_STATUSES = ('succeeded', 'refunded')
+
+class CheckHedger:
+    """Tracks recent check-result latencies per provider and decides when to hedge.
+
+    The hedge delay is the HEDGE_PERCENTILE of the last 500 successful checks, and
+    hedges are only sent while they stay under HEDGE_BUDGET of all checks (counts
+    decay so an old quiet period cannot be spent in one burst)."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.checks = 0
+        self.hedges = 0
+        self.stats = Counter()
+        # Room for a primary and a hedge from every thread that can issue a check (request threads,
+        # the check-results fan-out, the reaper), so checks do not queue behind one another here
+        callers = WORKER_THREADS + BATCH_CHECK_CONCURRENCY + REAPER_CONCURRENCY
+        self.pool = ThreadPoolExecutor(max_workers=2 * callers, thread_name_prefix="hedge")
+
+    def observe(self, provider_name, ms):
+        with self.lock:
+            self.samples.setdefault(provider_name, deque(maxlen=500)).append(ms)
+
+    def delay(self, provider_name):
+        with self.lock:
+            samples = sorted(self.samples.get(provider_name, ()))
+        if len(samples) < 20:
+            return HEDGE_DEFAULT_DELAY_MS / 1000.0
+        ms = samples[min(len(samples) - 1, int(len(samples) * HEDGE_PERCENTILE / 100.0))]
+        return max(ms, HEDGE_MIN_DELAY_MS) / 1000.0
+
+    def count_check(self):
+        with self.lock:
+            self.checks += 1
+            if self.checks >= 2000:
+                self.checks, self.hedges = self.checks // 2, self.hedges // 2
+
+    def allow_hedge(self):
+        with self.lock:
+            if self.hedges + 1 > HEDGE_BUDGET * self.checks:
+                self.stats["budget_skipped"] += 1
+                return False
+            self.hedges += 1
+            return True
+
+    def hedged(self, provider_name):
+        with self.lock:
+            self.stats["hedged"] += 1
+        analytics.add('hedged_checks', provider_name)
+
+    def settled(self, provider_name, winner, hedge):
+        """Count how a hedged check ended; winner is None when neither side answered usefully."""
+        outcome = 'hedge_wins' if winner is hedge else 'primary_wins' if winner else 'both_failed'
+        with self.lock:
+            self.stats[outcome] += 1
+        if winner is hedge:
+            analytics.add('hedge_wins', provider_name)
+
+    def status(self):
+        delays = {name: round(self.delay(name) * 1000, 1) for name in list(self.samples)}
+        with self.lock:
+            return dict(self.stats, enabled=HEDGE_ENABLED, percentile=HEDGE_PERCENTILE, budget=HEDGE_BUDGET,
+                        checks=self.checks, hedges=self.hedges, delays_ms=delays)
+
+hedger = CheckHedger()
+
+# Bookkeeping around one check-result call, shared with async_api.check_once
+def check_failed(provider, real_key, exc):
+    provider.record(False)
+    record_key_failure(real_key, type(exc).__name__)
+
+def check_answered(provider, real_key, r, t0):
+    ms = (time.time() - t0) * 1000
+    provider.record(r.status_code < 500, ms)
+    if r.status_code >= 500 or r.status_code == 429:
+        record_key_failure(real_key, f"HTTP {r.status_code}", r.status_code)
+    else:
+        hedger.observe(provider.name, ms)
+
+def _check_once(provider, real_key, task_id):
+    print(f"[DEBUG] Check via {provider.name} using API Key: {real_key[:15]}...")
+    record_key_request(real_key)
+    t0 = time.time()
+    try:
+        r = requests.post(provider.check_url, 
+                          json={"taskId": task_id}, 
+                          headers=provider.headers(real_key), 
+                          timeout=provider.check_timeout)
+    except requests.exceptions.RequestException as e:
+        check_failed(provider, real_key, e)
+        raise
+    check_answered(provider, real_key, r, t0)
+    return r
+
+def _answered(future):
+    """A finished check that is worth returning (not an exception or a 5xx/429)."""
+    if future.exception() is not None:
+        return False
+    r = future.result()
+    return r.status_code < 500 and r.status_code != 429
+
+def fetch_task_result(task_id, provider_name=None):
+    """Ask the provider that created the task for its status. Returns the response, or None without a key.
+
+    With HEDGE_ENABLED a slow check is hedged: check-result is read-only, so a second
+    request is safe and whichever usable answer arrives first wins."""
+    provider = providers.get(provider_name) or providers.default()
+    real_key = get_active_api_key(provider=provider.name) if provider else None
+    if not real_key:
+        return None
+    if not HEDGE_ENABLED:
+        return _check_once(provider, real_key, task_id)
+
+    hedger.count_check()
+    started = threading.Event()
+    def primary_check():
+        started.set()
+        return _check_once(provider, real_key, task_id)
+    primary = hedger.pool.submit(primary_check)
+    # The hedge delay counts from when the primary is sent, not from when it was queued
+    started.wait()
+    done, _ = wait([primary], timeout=hedger.delay(provider.name))
+    if done or not hedger.allow_hedge():
+        return primary.result()
+
+    hedge_key = get_active_api_key(provider=provider.name, exclude=(real_key,)) or real_key
+    hedge = hedger.pool.submit(_check_once, provider, hedge_key, task_id)
+    hedger.hedged(provider.name)
+    pending = {primary, hedge}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        winner = next((f for f in done if _answered(f)), None)
+        if winner:
+            break
+    else:
+        winner = None
+    hedger.settled(provider.name, winner, hedge)
+    # Neither answered usefully: report the primary's error or status like an unhedged call
+    return (winner or primary).result()
+
+def check_task_upstream(task):
+    """Fetch one task's upstream result for the pooled callers. Returns (task, body, error)."""
+    try:
+        r = fetch_task_result(task['task_id'], task['provider'])
+    except requests.exceptions.RequestException as e:
+        return task, None, str(e)
+    if r is None:
+        return task, None, "no api key"
+    if r.status_code != 200:
+        return task, None, f"HTTP {r.status_code}"
+    try:
+        return task, r.json(), None
+    except ValueError:
+        return task, None, "bad json"
+
+def settle_task(conn, task, upstream_status, note=None, result=None):
+    """Apply an upstream status to a task exactly once, inside the caller's transaction.
+
+    The status change is a conditional UPDATE from 'pending' only, so concurrent proxy_chk
+    calls and the reaper can settle the same task without double refunds, and a stale
+    answer cannot refund a delivered task or mark a refunded one succeeded. result (the
+    upstream 'data' object) is kept in tasks.result_json so settled tasks can be answered
+    locally. Returns 'refunded', 'succeeded' or None when nothing changed.
+    """
+    task_id = task['task_id']
+    result_json = json.dumps(result) if result is not None else None
+    if upstream_status in ('failed', 'expired'):
+        if conn.execute("UPDATE tasks SET status = 'refunded', result_json = COALESCE(?, result_json) WHERE task_id = ? AND status = 'pending'",
+                        (result_json, task_id)).rowcount != 1:
+            return None
+        conn.execute("UPDATE users SET credits = credits + ? WHERE username = ?", (task['cost'], task['username']))
+        record_log(conn, task['username'], f"Refund {task_id}" + (f" ({note})" if note else ""), task['cost'], 'Refunded', task_id)
+        record_usage(conn, task['username'], refunds=1, credits_refunded=task['cost'])
+        analytics.add('refunds', task['model'])
+        analytics.add('credits_refunded', task['model'], task['cost'])
+        return 'refunded'
+    if upstream_status == 'succeeded':
+        if conn.execute("UPDATE tasks SET status = 'succeeded', result_json = COALESCE(?, result_json) WHERE task_id = ? AND status = 'pending'",
+                        (result_json, task_id)).rowcount != 1:
+            return None
+        record_log(conn, task['username'], f"Success {task_id}", task['cost'], 'Success', task_id)
+        return 'succeeded'
+    return None
+
+# --- REQUEST VALIDATION ---
+# Declarative shapes of the client API requests. validation_guard runs before the ban check,
+# the rate limits and the handlers, so garbage is refused with a 400 (401 for a malformed
+# Client-Auth, 413 for an oversized body) without touching SQLite or the upstream.
+# Only the listed fields are checked; unknown fields are left alone.
+def field(kind, required=False, max_len=None, pattern=None, each=None):
+    """Compile one field rule into a check(name, value) returning an error message or None.
+    each: field rules every element of a list field (an object) must pass."""
+    regex = re.compile(pattern) if pattern else None
+    def check(name, value):
+        if value is None or (required and value in ('', [])):
+            return f"Missing {name}" if required else None
+        if not isinstance(value, kind):
+            return f"Invalid {name}"
+        if max_len is not None and len(value) > max_len:
+            return f"{name} too long"
+        if regex and not regex.fullmatch(value):
+            return f"Invalid {name}"
+        for i, item in enumerate(value if each else ()):
+            if not isinstance(item, dict):
+                return f"Invalid {name}"
+            for sub, sub_check in each.items():
+                error = sub_check(f"{name}[{i}].{sub}", item.get(sub))
+                if error:
+                    return error
+        return None
+    return check
+
+CREDENTIAL_FIELDS = {"username": field(str, True, 128), "api_key": field(str, True, 256)}
+GENERATE_FIELDS = {"model": field(str, max_len=64), "prompt": field(str, max_len=PROMPT_MAX_CHARS),
+                   "aspectRatio": field(str, max_len=16, pattern=r"[\w:.]+")}
+
+REQUEST_SCHEMAS = {
+    "/api/verify": {"body": CREDENTIAL_FIELDS, "max_bytes": 4096},
+    "/api/heartbeat": {"body": CREDENTIAL_FIELDS, "max_bytes": 4096},
+    "/api/redeem": {"body": {"username": field(str, True, 128), "code": field(str, True, 64)}, "max_bytes": 4096},
+    "/api/proxy/generate": {"auth": True, "body": GENERATE_FIELDS},
+    "/api/proxy/generate-batch": {"auth": True, "body": {"items": field(list, True, each=GENERATE_FIELDS)},
+                                  "max_bytes": API_MAX_BODY * BATCH_GENERATE_MAX},
+    "/api/proxy/check-result": {"body": {"taskId": field(str, True, 128)}, "max_bytes": 4096},
+    "/api/proxy/check-results": {"auth": True, "body": {"taskIds": field(list, True)}},
+    "/api/tasks": {"auth": True, "method": "GET"},
+}
+for _schema in REQUEST_SCHEMAS.values():
+    _schema.setdefault("method", "POST")
+    _schema.setdefault("max_bytes", API_MAX_BODY)
+    _schema["checks"] = list(_schema.get("body", {}).items())
+
+def check_request(schema, auth, body):
+    """Validate one request against its schema (shared with the async tier).
+    body is the parsed JSON, or None when it is missing or not valid JSON.
+    Returns None or an (error_body, status) reply."""
+    if schema.get("auth"):
+        user, sep, key = (auth or "").partition(":")
+        if not sep or not user or not key or len(auth) > 512:
+            return {"code": -1}, 401
+    if "body" not in schema:
+        return None
+    if not isinstance(body, dict):
+        return {"code": -1, "message": "Invalid JSON body"}, 400
+    for name, check in schema["checks"]:
+        error = check(name, body.get(name))
+        if error:
+            return {"code": -1, "message": error}, 400
+    return None
+
+@app.before_request
+def validation_guard():
+    schema = REQUEST_SCHEMAS.get(request.path)
+    if schema is None or request.method != schema["method"]:
+        return
+    body = None
+    if "body" in schema:
+        # A chunked body without Content-Length is cut at the limit instead of raising, so allow
+        # one byte more and refuse anything longer than max_bytes either way
+        request.max_content_length = schema["max_bytes"] + 1
+        try:
+            if len(request.get_data()) > schema["max_bytes"]:
+                raise RequestEntityTooLarge()
+            body = request.get_json(silent=True)
+        except RequestEntityTooLarge:
+            return jsonify({"code": -1, "message": "Request body too large"}), 413
+    refused = check_request(schema, request.headers.get("Client-Auth"), body)
+    if refused:
+        return jsonify(refused[0]), refused[1]
 
 # --- SECURITY ---
+class BannedIPCache:
+    """Set of banned IPs refreshed every BAN_CACHE_TTL seconds, so the per-request ban check skips SQLite."""
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.ips = frozenset()
+        self.loaded_at = 0
+
+    def contains(self, ip):
+        if time.time() - self.loaded_at > self.ttl:
+            conn = get_db()
+            self.ips = frozenset(row['ip'] for row in conn.execute("SELECT ip FROM banned_ips").fetchall())
+            conn.close()
+            self.loaded_at = time.time()
+        return ip in self.ips
+
+    def add(self, ip):
+        self.ips = self.ips | {ip}
+
+banned_ips = BannedIPCache(BAN_CACHE_TTL)
+
 @app.before_request
 def security_guard():
     ip = get_client_ip()
-    conn = get_db()
-    is_banned = conn.execute("SELECT 1 FROM banned_ips WHERE ip=?", (ip,)).fetchone()
-    conn.close()
-    if is_banned: 
+    if banned_ips.contains(ip): 
         return jsonify({"code": 403, "message": "Access Denied: IP Banned."}), 403
     
     if 'logged_in' in session: 
@@ -167,16 +1917,680 @@ def security_guard():
     if current_count >= MAX_SUSPICIOUS_ATTEMPTS:
         try:
             conn = get_db()
-            conn.execute("INSERT OR IGNORE INTO banned_ips (ip, reason, banned_at) VALUES (?, ?, ?)", 
-                        (ip, f"Excessive scanning: {request.path}", str(datetime.now())))
+            conn.execute("INSERT OR IGNORE INTO banned_ips (ip, reason, banned_at, banned_ts) VALUES (?, ?, ?, ?)", 
+                        (ip, f"Excessive scanning: {request.path}", *now_stamp()))
             conn.commit()
             conn.close()
+            banned_ips.add(ip)
         except: 
             pass
         return jsonify({"code": 403, "message": "Access Denied"}), 403
     
     return "Not Found", 404
 
+# --- RATE LIMITING ---
+# Token buckets live in their own SQLite file so every gunicorn worker shares them
+# without adding writes to users.db. Kept apart from the ban logic above on purpose:
+# throttled clients get 429 + Retry-After, never a ban.
+class TokenBucketStore:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.next_cleanup = 0
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("""CREATE TABLE IF NOT EXISTS buckets (bucket TEXT PRIMARY KEY, tokens REAL NOT NULL,
+                            updated_at REAL NOT NULL, allowed INTEGER NOT NULL DEFAULT 1)""")
+            self.local.conn = conn
+        return conn
+
+    def take(self, bucket, rate, burst):
+        """Take one token. Returns (allowed, retry_after_seconds)."""
+        now = time.time()
+        conn = self._conn()
+        # Refill, check and spend in one atomic statement
+        row = conn.execute("""
+            INSERT INTO buckets (bucket, tokens, updated_at, allowed) VALUES (:b, :burst - 1, :now, 1)
+            ON CONFLICT(bucket) DO UPDATE SET
+                allowed = (min(:burst, tokens + (:now - updated_at) * :rate) >= 1),
+                tokens = min(:burst, tokens + (:now - updated_at) * :rate)
+                         - (min(:burst, tokens + (:now - updated_at) * :rate) >= 1),
+                updated_at = :now
+            RETURNING tokens, allowed""", {"b": bucket, "burst": float(burst), "rate": float(rate), "now": now}).fetchone()
+        if now >= self.next_cleanup:
+            self.next_cleanup = now + 300
+            conn.execute("DELETE FROM buckets WHERE updated_at < ?", (now - 3600,))
+        tokens, allowed = row
+        if allowed:
+            return True, 0
+        return False, max(1, math.ceil((1 - tokens) / rate))
+
+rate_limit_store = TokenBucketStore(RATELIMIT_DB_PATH)
+
+def rate_limit_identity(kind):
+    if kind == "auth":
+        auth = request.headers.get("Client-Auth", "")
+        if auth:
+            return "a:" + hashlib.sha256(auth.encode()).hexdigest()[:24]
+    elif kind == "username":
+        body = request.get_json(silent=True)
+        username = body.get('username') if isinstance(body, dict) else None
+        if isinstance(username, str) and username:
+            return "u:" + username
+    return "ip:" + str(get_client_ip())
+
+@app.before_request
+def rate_limit_guard():
+    if not RATE_LIMIT_ENABLED:
+        return
+    policies = RATE_LIMITS.get(request.path)
+    if not policies:
+        return
+    for policy in policies:
+        bucket = f"{request.path}|{rate_limit_identity(policy['key'])}"
+        try:
+            allowed, retry_after = rate_limit_store.take(bucket, policy['rate'], policy['burst'])
+        except sqlite3.Error as e:
+            print(f"[RATELIMIT] Store unavailable, allowing request: {e}")
+            return
+        if not allowed:
+            resp = jsonify({"code": 429, "message": "Too Many Requests", "retry_after": retry_after})
+            resp.headers['Retry-After'] = str(retry_after)
+            return resp, 429
+
+# --- BACKGROUND JOBS ---
+# Every gunicorn worker runs the job threads; a lease row in job_leases makes sure only
+# one of them actually does the work per interval.
+JOB_OWNER = f"{socket.gethostname()}:{os.getpid()}"
+background_jobs = []
+jobs_started_pid = None
+
+def acquire_lease(name, ttl):
+    now = time.time()
+    conn = get_db()
+    cur = conn.execute("""INSERT INTO job_leases (name, owner, expires_ts) VALUES (?, ?, ?)
+                          ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_ts = excluded.expires_ts
+                          WHERE job_leases.expires_ts < ? OR job_leases.owner = excluded.owner""",
+                       (name, JOB_OWNER, now + ttl, now))
+    conn.commit()
+    conn.close()
+    return cur.rowcount == 1
+
+def background_job(name, interval, enabled=True, per_worker=False):
+    """Register fn to run every interval seconds in one worker at a time
+    (per_worker: in every worker, without the lease, for per-process state)."""
+    def register(fn):
+        if enabled:
+            background_jobs.append((name, interval, fn, per_worker))
+        return fn
+    return register
+
+def _job_loop(name, interval, fn, per_worker):
+    time.sleep(random.uniform(0, min(interval, 30)))
+    while True:
+        try:
+            if per_worker or acquire_lease(name, interval * 2):
+                fn()
+        except Exception as e:
+            print(f"[JOB] {name} failed: {e}")
+        time.sleep(interval)
+
+@app.before_request
+def start_background_jobs():
+    global JOB_OWNER, jobs_started_pid
+    if jobs_started_pid == os.getpid():
+        return
+    # Threads do not survive a fork, so (re)start them in each worker process
+    jobs_started_pid = os.getpid()
+    JOB_OWNER = f"{socket.gethostname()}:{os.getpid()}"
+    for name, interval, fn, per_worker in background_jobs:
+        threading.Thread(target=_job_loop, args=(name, interval, fn, per_worker), name=f"job-{name}", daemon=True).start()
+
+# In-memory buffers are flushed from their own thread, never by the request that adds to them
+background_job("analytics-flush", max(ANALYTICS_FLUSH_INTERVAL, 1), per_worker=True)(analytics.flush)
+background_job("key-usage-flush", max(KEY_USAGE_FLUSH_INTERVAL, 1), per_worker=True)(key_usage.flush)
+background_job("history-flush", max(HISTORY_FLUSH_INTERVAL, 0.1), enabled=STORAGE_LAYOUT == 'split',
+               per_worker=True)(history_writer.flush)
+
+# --- STALE-TASK REAPER ---
+reaper_stats = {"runs": 0, "running": False, "last_started": None, "last_finished": None, "last_duration_s": None,
+                "checked": 0, "refunded": 0, "succeeded": 0, "expired": 0, "still_pending": 0, "errors": 0,
+                "current_run": {}}
+reaper_lock = threading.Lock()
+
+def _reap_check(task):
+    task, body, error = check_task_upstream(task)
+    return task, (body.get('data') or {}) if body else None, error
+
+def reap_stale_tasks(limit=None):
+    """Check pending tasks older than REAPER_MIN_AGE upstream, in rate-limited batches,
+    and settle them in one transaction per batch. Safe to run next to proxy_chk."""
+    if not reaper_lock.acquire(blocking=False):
+        return reaper_stats
+    started = time.time()
+    run = {"checked": 0, "refunded": 0, "succeeded": 0, "expired": 0, "still_pending": 0, "errors": 0}
+    reaper_stats.update(running=True, last_started=str(datetime.now()), current_run=run)
+    try:
+        cutoff = str(datetime.now() - timedelta(seconds=REAPER_MIN_AGE))
+        expire_before = str(datetime.now() - timedelta(seconds=REAPER_EXPIRE_AFTER))
+        after = ("", "")
+        pool = ThreadPoolExecutor(max_workers=REAPER_CONCURRENCY)
+        try:
+            while limit is None or run["checked"] < limit:
+                conn = get_db()
+                # Keyset walk over idx_tasks_status_created_id so tasks that stay pending are not re-read;
+                # task_id breaks created_at ties, so tasks sharing the boundary timestamp are not skipped
+                batch = conn.execute("""SELECT task_id, username, cost, status, model, provider, created_at FROM tasks
+                                        WHERE status = 'pending' AND created_at < ? AND (created_at, task_id) > (?, ?)
+                                        ORDER BY created_at, task_id LIMIT ?""", (cutoff, *after, REAPER_BATCH)).fetchall()
+                conn.close()
+                if not batch:
+                    break
+                after = (batch[-1]['created_at'], batch[-1]['task_id'])
+
+                batch_started = time.time()
+                results = list(pool.map(_reap_check, batch))
+
+                conn = get_db()
+                for task, info, error in results:
+                    run["checked"] += 1
+                    if error:
+                        run["errors"] += 1
+                        continue
+                    status = info.get('status')
+                    if status in ('failed', 'succeeded'):
+                        outcome = settle_task(conn, task, status, result=info)
+                        if outcome:
+                            run[outcome] += 1
+                    elif task['created_at'] < expire_before:
+                        if settle_task(conn, task, 'expired', note="expired"):
+                            run["expired"] += 1
+                    else:
+                        run["still_pending"] += 1
+                conn.commit()
+                conn.close()
+
+                # Keep the upstream call rate at REAPER_RATE per second
+                pause = len(batch) / REAPER_RATE - (time.time() - batch_started)
+                if pause > 0:
+                    time.sleep(pause)
+        finally:
+            pool.shutdown(wait=False)
+
+        conn = get_db()
+        conn.execute("DELETE FROM generation_requests WHERE created_ts < ?", (int(time.time()) - IDEMPOTENCY_TTL,))
+        conn.commit()
+        conn.close()
+    finally:
+        for k, v in run.items():
+            reaper_stats[k] += v
+        reaper_stats.update(runs=reaper_stats["runs"] + 1, running=False, last_finished=str(datetime.now()),
+                            last_duration_s=round(time.time() - started, 2))
+        reaper_lock.release()
+    print(f"[REAPER] {run}")
+    return reaper_stats
+
+background_job("reaper", REAPER_INTERVAL, enabled=REAPER_ENABLED)(reap_stale_tasks)
+
+# --- COUNTER REPAIR ---
+def repair_counters():
+    """Recount the trigger-maintained counters and correct any drift (restored backups, manual edits)."""
+    # The GROUP BY scans run in a read snapshot, so writers are never blocked by the recount
+    conn = get_read_db()
+    conn.execute("BEGIN")
+    drift = rebuild_counters(conn, fix=False)
+    conn.rollback()
+    conn.close()
+    if drift:
+        conn = get_db()
+        apply_counter_drift(conn, drift)
+        conn.commit()
+        conn.close()
+        print(f"[COUNTERS] Repaired {len(drift)} counters: " + ", ".join(f"{n}[{d}] {s}->{a}" for (n, d), (s, a) in sorted(drift.items())[:20]))
+    return drift
+
+background_job("counters", COUNTERS_REPAIR_INTERVAL, enabled=COUNTERS_REPAIR_INTERVAL > 0)(repair_counters)
+
+# --- KEY BALANCE PROBE ---
+def probe_key_balance(provider, api_key):
+    r = requests.get(provider.balance_url, headers=provider.headers(api_key), timeout=provider.check_timeout)
+    r.raise_for_status()
+    value = r.json()
+    for part in provider.balance_field.split('.'):
+        value = value[part]
+    return float(value)
+
+def probe_key_balances():
+    """Store the remaining upstream balance of every active key whose provider has a balance endpoint.
+    Runs every KEY_BALANCE_INTERVAL seconds, so the readings double as a cache for all workers."""
+    key_usage.flush()
+    conn = get_db()
+    keys = conn.execute("SELECT key_value, label, provider FROM api_keys WHERE is_active=1").fetchall()
+    conn.close()
+    providers.reload_if_changed()
+    fallback = next((p for p in sorted(providers.providers.values(), key=lambda p: p.priority)
+                     if p.enabled and p.balance_url), None)
+    readings, low = [], []
+    for k in keys:
+        provider = providers.get(k['provider']) if k['provider'] else fallback
+        if not provider or not provider.balance_url:
+            continue
+        try:
+            balance = probe_key_balance(provider, k['key_value'])
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as e:
+            print(f"[KEYS] Balance probe for {k['label'] or k['key_value'][:15]} failed: {type(e).__name__}")
+            continue
+        readings.append((balance, time.time(), k['key_value']))
+        if balance < KEY_LOW_BALANCE:
+            low.append(f"{k['label'] or k['key_value'][:15]}={balance:g}")
+    if readings:
+        conn = get_db()
+        conn.executemany("UPDATE api_keys SET balance=?, balance_checked_ts=? WHERE key_value=?", readings)
+        conn.commit()
+        conn.close()
+    if low:
+        print(f"[KEYS] Low upstream balance: {', '.join(low)}")
+    return len(readings)
+
+background_job("key-balance", KEY_BALANCE_INTERVAL, enabled=KEY_BALANCE_INTERVAL > 0)(probe_key_balances)
+
+# --- BACKUPS ---
+# Each database file is copied with the online backup API into a snapshot, checked, and
+# gzipped into BACKUP_DIR with a sha256sum-compatible .sha256 file next to it. The latest
+# uncompressed copy is kept as a read-only snapshot for heavy reports (see get_snapshot_db).
+backup_stats = {"runs": 0, "running": False, "last_started": None, "last_finished": None,
+                "last_duration_s": None, "last_error": None, "last_files": []}
+backup_lock = threading.Lock()
+
+class BackupRestarted(Exception):
+    pass
+
+def backup_sources():
+    sources = [DB_PATH]
+    if STORAGE_LAYOUT == 'split':
+        sources.append(HISTORY_DB_PATH)
+    return sources
+
+def snapshot_path(db_path):
+    return os.path.join(BACKUP_DIR, "snapshot-" + os.path.basename(db_path))
+
+def online_copy(src_path, dst_path):
+    """Copy src_path to dst_path in BACKUP_PAGES steps with BACKUP_SLEEP pauses.
+
+    A write from another connection makes SQLite restart the copy; after
+    BACKUP_MAX_RESTARTS the rest is copied in one step so busy databases still finish."""
+    src = sqlite3.connect(src_path)
+    dst = sqlite3.connect(dst_path)
+    state = {"remaining": None, "restarts": 0}
+
+    def progress(status, remaining, total):
+        # Each step lowers remaining, so no progress means SQLite started over
+        if state["remaining"] is not None and remaining >= state["remaining"]:
+            state["restarts"] += 1
+            if state["restarts"] > BACKUP_MAX_RESTARTS:
+                raise BackupRestarted()
+        state["remaining"] = remaining
+        time.sleep(BACKUP_SLEEP)
+
+    try:
+        try:
+            src.backup(dst, pages=BACKUP_PAGES, progress=progress)
+        except BackupRestarted:
+            src.backup(dst)
+        # Snapshots are opened read-only, which needs a rollback journal rather than WAL
+        dst.execute("PRAGMA journal_mode=DELETE")
+        check = dst.execute("PRAGMA quick_check").fetchone()[0]
+        if check != "ok":
+            raise sqlite3.DatabaseError(f"quick_check on backup of {src_path}: {check}")
+    finally:
+        dst.close()
+        src.close()
+    return state["restarts"]
+
+def compress_file(src_path, dst_path):
+    """gzip src_path into dst_path and return the sha256 of the compressed bytes."""
+    digest = hashlib.sha256()
+
+    class HashingWriter(io.RawIOBase):
+        def __init__(self, raw):
+            self.raw = raw
+        def writable(self):
+            return True
+        def write(self, b):
+            digest.update(b)
+            return self.raw.write(b)
+
+    with open(dst_path, "wb") as raw, open(src_path, "rb") as src:
+        with gzip.GzipFile(filename=os.path.basename(src_path), mode="wb", fileobj=HashingWriter(raw), compresslevel=6) as gz:
+            shutil.copyfileobj(src, gz, 1024 * 1024)
+    return digest.hexdigest()
+
+def rotate_backups(stem):
+    names = sorted(n for n in os.listdir(BACKUP_DIR) if n.startswith(stem + "-") and n.endswith(".db.gz"))
+    for n in names[:-BACKUP_KEEP] if BACKUP_KEEP > 0 else []:
+        for path in (n, n + ".sha256"):
+            try:
+                os.remove(os.path.join(BACKUP_DIR, path))
+            except OSError:
+                pass
+
+def run_backup():
+    """Back up every database file and refresh the read-only snapshots."""
+    if not backup_lock.acquire(blocking=False):
+        return backup_stats
+    started = time.time()
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    backup_stats.update(running=True, last_started=str(datetime.now()), last_error=None)
+    files = []
+    try:
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        for db_path in backup_sources():
+            stem = os.path.splitext(os.path.basename(db_path))[0]
+            tmp = os.path.join(BACKUP_DIR, f".{stem}-{stamp}.db.tmp")
+            name = f"{stem}-{stamp}.db.gz"
+            try:
+                restarts = online_copy(db_path, tmp)
+                sha = compress_file(tmp, os.path.join(BACKUP_DIR, name))
+                with open(os.path.join(BACKUP_DIR, name + ".sha256"), "w") as f:
+                    f.write(f"{sha}  {name}\n")
+                os.replace(tmp, snapshot_path(db_path))
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            rotate_backups(stem)
+            files.append({"name": name, "sha256": sha, "restarts": restarts,
+                          "size": os.path.getsize(os.path.join(BACKUP_DIR, name))})
+        print(f"[BACKUP] {', '.join(f['name'] for f in files)} in {time.time() - started:.1f}s")
+    except Exception as e:
+        backup_stats["last_error"] = str(e)
+        print(f"[BACKUP] Failed: {e}")
+        raise
+    finally:
+        backup_stats.update(runs=backup_stats["runs"] + 1, running=False, last_finished=str(datetime.now()),
+                            last_duration_s=round(time.time() - started, 2), last_files=files)
+        backup_lock.release()
+    return backup_stats
+
+def list_backups():
+    backups = []
+    if os.path.isdir(BACKUP_DIR):
+        for n in sorted(os.listdir(BACKUP_DIR), reverse=True):
+            if not n.endswith(".db.gz"):
+                continue
+            path = os.path.join(BACKUP_DIR, n)
+            try:
+                with open(path + ".sha256") as f:
+                    sha = f.read().split()[0]
+            except (OSError, IndexError):
+                sha = ""
+            backups.append({"name": n, "size": os.path.getsize(path), "sha256": sha,
+                            "created": str(datetime.fromtimestamp(os.path.getmtime(path)))[:19]})
+    return backups
+
+def get_snapshot_db():
+    """Read-only connection to the latest backup snapshot, or None if no backup has run yet."""
+    path = snapshot_path(DB_PATH)
+    if not os.path.exists(path):
+        return None
+    conn = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True)
+    conn.row_factory = sqlite3.Row
+    history = snapshot_path(HISTORY_DB_PATH)
+    if STORAGE_LAYOUT == 'split' and os.path.exists(history):
+        conn.execute("ATTACH DATABASE ? AS history", (f"file:{os.path.abspath(history)}?mode=ro",))
+    return conn
+
+background_job("backup", BACKUP_INTERVAL, enabled=BACKUP_ENABLED)(run_backup)
+
+# --- BULK ADMIN ---
+PLANS = ('Mini', 'Basic', 'Standard', 'Premium')
+USER_STATUSES = {'active': 1, 'suspended': 2, 'banned': 0}
+# Client-Auth is "username:api_key", so usernames cannot contain a colon
+USERNAME_RE = re.compile(r'^[^\s:]{1,64}$')
+
+class BulkReport:
+    """Per-row outcome of a bulk operation. The JSON summary lists up to BULK_MAX_ERRORS errors;
+    the CSV report (keep_rows) has one line per input row."""
+    def __init__(self, operation, dry_run, keep_rows=False):
+        self.operation = operation
+        self.dry_run = dry_run
+        self.keep_rows = keep_rows
+        self.counts = Counter()
+        self.errors = []
+        self.sample = []
+        self.rows = []
+        self.t0 = time.time()
+
+    def ok(self, line, username, **values):
+        self.counts['valid'] += 1
+        if len(self.sample) < 20:
+            self.sample.append({'line': line, 'username': username, **values})
+        if self.keep_rows:
+            self.rows.append({'line': line, 'username': username, 'result': 'ok', 'error': '', **values})
+
+    def error(self, line, username, message):
+        self.counts['errors'] += 1
+        if len(self.errors) < BULK_MAX_ERRORS:
+            self.errors.append({'line': line, 'username': username, 'error': message})
+        if self.keep_rows:
+            self.rows.append({'line': line, 'username': username, 'result': 'error', 'error': message})
+
+    def applied(self, n):
+        self.counts['applied'] += n
+
+    def summary(self):
+        return {"operation": self.operation, "dry_run": self.dry_run,
+                "rows": self.counts['valid'] + self.counts['errors'], "valid": self.counts['valid'],
+                "applied": self.counts['applied'], "errors_total": self.counts['errors'], "errors": self.errors,
+                "sample": self.sample, "duration_s": round(time.time() - self.t0, 2)}
+
+    def csv(self):
+        cols = ['line', 'username', 'result', 'error']
+        cols += [k for k in (self.rows[0] if self.rows else {}) if k not in cols]
+        out = io.StringIO()
+        writer = csv.DictWriter(out, cols, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(self.rows)
+        return out.getvalue()
+
+def chunked(iterable, size):
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+def read_csv_rows(lines):
+    """(line number, row) for each CSV record, with lower-cased header names and stripped values.
+    `lines` is any iterable of text lines, so uploads are parsed as they are read."""
+    reader = csv.DictReader(lines)
+    for row in reader:
+        yield reader.line_num, {k.strip().lower(): (v or '').strip() for k, v in row.items() if isinstance(k, str)}
+
+def normalize_plan(value):
+    return next((p for p in PLANS if p.lower() == (value or '').strip().lower()), None)
+
+def bulk_import_users(rows, defaults, report):
+    """Create users from CSV rows (username[, credits, plan, expiry, api_key, assigned_key]).
+    Missing columns fall back to `defaults`; existing usernames are reported, never overwritten."""
+    seen = set()
+    conn = get_db()
+    for chunk in chunked(rows, BULK_CHUNK_SIZE):
+        parsed = []
+        for line, row in chunk:
+            username = row.get('username', '')
+            if not USERNAME_RE.match(username):
+                report.error(line, username, 'invalid username (1-64 chars, no spaces or ":")')
+                continue
+            if username in seen:
+                report.error(line, username, 'duplicate username in file')
+                continue
+            seen.add(username)
+            try:
+                credits = int(row.get('credits') or defaults['credits'])
+            except ValueError:
+                report.error(line, username, 'credits must be an integer')
+                continue
+            plan = normalize_plan(row.get('plan') or defaults['plan'])
+            if not plan:
+                report.error(line, username, f"plan must be one of {', '.join(PLANS)}")
+                continue
+            expiry = row.get('expiry') or row.get('expiry_date') or defaults['expiry']
+            expiry_ts = date_epoch(expiry)
+            if expiry_ts is None:
+                report.error(line, username, 'expiry must be YYYY-MM-DD')
+                continue
+            api_key = row.get('api_key') or "SK-" + str(uuid.uuid4())[:12].upper()
+            parsed.append((line, username, api_key, credits, expiry, expiry_ts, plan, row.get('assigned_key') or None))
+        if not parsed:
+            continue
+        names = [p[1] for p in parsed]
+        existing = {r[0] for r in conn.execute(f"SELECT username FROM users WHERE username IN ({','.join('?' * len(names))})", names)}
+        created, today = int(time.time()), datetime.now().strftime("%Y-%m-%d")
+        values = []
+        for line, username, api_key, credits, expiry, expiry_ts, plan, assigned in parsed:
+            if username in existing:
+                report.error(line, username, 'user already exists')
+                continue
+            report.ok(line, username, api_key=api_key, plan=plan, credits=credits, expiry=expiry)
+            values.append((username, api_key, credits, expiry, expiry_ts, today, created, plan, assigned))
+        if values and not report.dry_run:
+            report.applied(conn.executemany("""INSERT INTO users (username, api_key, credits, expiry_date, expiry_ts, is_active,
+                                                                  created_at, created_ts, plan, assigned_api_key)
+                                               VALUES (?, ?, ?, ?, ?, 1, ?, ?, ?, ?) ON CONFLICT(username) DO NOTHING""", values).rowcount)
+            conn.commit()
+    conn.close()
+    return report
+
+def bulk_adjust_credits(rows, report):
+    """Add a signed delta per user from CSV rows (username, delta). A row that would leave
+    negative credits is rejected, checked again at write time against concurrent spending."""
+    seen = set()
+    total = 0
+    conn = get_db()
+    for chunk in chunked(rows, BULK_CHUNK_SIZE):
+        parsed = []
+        for line, row in chunk:
+            username = row.get('username', '')
+            if not username:
+                report.error(line, username, 'username is required')
+                continue
+            if username in seen:
+                report.error(line, username, 'duplicate username in file')
+                continue
+            seen.add(username)
+            try:
+                parsed.append((line, username, int(row.get('delta') or row.get('credits') or '')))
+            except ValueError:
+                report.error(line, username, 'delta must be an integer')
+        if not parsed:
+            continue
+        names = [p[1] for p in parsed]
+        current = {r[0]: r[1] for r in conn.execute(f"SELECT username, credits FROM users WHERE username IN ({','.join('?' * len(names))})", names)}
+        values = []
+        for line, username, delta in parsed:
+            if username not in current:
+                report.error(line, username, 'unknown user')
+            elif (current[username] or 0) + delta < 0:
+                report.error(line, username, f"would leave {(current[username] or 0) + delta} credits")
+            else:
+                report.ok(line, username, credits_before=current[username], credits_after=(current[username] or 0) + delta)
+                values.append((delta, username, delta))
+                total += delta
+        if values and not report.dry_run:
+            report.applied(conn.executemany("UPDATE users SET credits = credits + ? WHERE username = ? AND credits + ? >= 0", values).rowcount)
+            conn.commit()
+    if report.counts['applied']:
+        record_log(conn, 'SYSTEM', f"BULK_CREDITS: {report.counts['applied']} users, {total:+d} credits", 0, 'Admin')
+        conn.commit()
+    conn.close()
+    return report
+
+def user_filter(form):
+    """WHERE clause and params from the bulk update filter fields. Expiry filters use
+    expiry_ts (run `flask backfill-timestamps` on older DBs so every row has one)."""
+    clauses, params = [], []
+    if form.get('plan'):
+        clauses.append("plan = ?")
+        params.append(normalize_plan(form['plan']) or form['plan'])
+    if form.get('status'):
+        if form['status'] not in USER_STATUSES:
+            raise ValueError(f"status must be one of {', '.join(USER_STATUSES)}")
+        clauses.append("is_active = ?")
+        params.append(USER_STATUSES[form['status']])
+    for field, op in (('expires_before', '<'), ('expires_after', '>=')):
+        if form.get(field):
+            ts = date_epoch(form[field])
+            if ts is None:
+                raise ValueError(f"{field} must be YYYY-MM-DD")
+            clauses.append(f"expiry_ts {op} ?")
+            params.append(ts)
+    if form.get('username_prefix'):
+        clauses.append("username LIKE ? ESCAPE '\\'")
+        params.append(re.sub(r'([\\%_])', r'\\\1', form['username_prefix']) + '%')
+    if not clauses and form.get('all') != '1':
+        raise ValueError('choose at least one filter, or tick "all users"')
+    return " AND ".join(clauses) or "1", params
+
+def bulk_update_users(form, report):
+    """Apply plan / expiry / credit changes to every user matching user_filter(form).
+    Rows are walked in rowid order, BULK_CHUNK_SIZE per transaction."""
+    where, params = user_filter(form)
+    new_plan = None
+    if form.get('set_plan'):
+        new_plan = normalize_plan(form['set_plan'])
+        if not new_plan:
+            raise ValueError(f"set_plan must be one of {', '.join(PLANS)}")
+    set_expiry = form.get('set_expiry') or None
+    if set_expiry and date_epoch(set_expiry) is None:
+        raise ValueError("set_expiry must be YYYY-MM-DD")
+    try:
+        extend_days = int(form.get('extend_days') or 0)
+        delta = int(form.get('credit_delta') or 0)
+    except ValueError:
+        raise ValueError("extend_days and credit_delta must be integers")
+    if not (new_plan or set_expiry or extend_days or delta):
+        raise ValueError("nothing to change: set a plan, an expiry, extend_days or credit_delta")
+
+    today = datetime.now().strftime("%Y-%m-%d")
+    conn = get_db()
+    last, n = 0, 0
+    while True:
+        rows = conn.execute(f"SELECT rowid, username, plan, credits, expiry_date FROM users WHERE rowid > ? AND {where} ORDER BY rowid LIMIT ?",
+                            (last, *params, BULK_CHUNK_SIZE)).fetchall()
+        if not rows:
+            break
+        last = rows[-1]['rowid']
+        values = []
+        for n, r in enumerate(rows, n + 1):
+            expiry = set_expiry or r['expiry_date']
+            if extend_days:
+                # Extend from the current expiry, or from today for users already expired
+                base = expiry if date_epoch(expiry) is not None and expiry > today else today
+                expiry = (datetime.strptime(base, "%Y-%m-%d") + timedelta(days=extend_days)).strftime("%Y-%m-%d")
+            credits = (r['credits'] or 0) + delta
+            if credits < 0:
+                report.error(n, r['username'], f"would leave {credits} credits")
+                continue
+            report.ok(n, r['username'], plan_before=r['plan'], plan_after=new_plan or r['plan'],
+                      expiry_before=r['expiry_date'], expiry_after=expiry, credits_before=r['credits'], credits_after=credits)
+            values.append((new_plan or r['plan'], expiry, date_epoch(expiry), delta, r['rowid'], delta))
+        if values and not report.dry_run:
+            report.applied(conn.executemany("""UPDATE users SET plan = ?, expiry_date = ?, expiry_ts = ?, credits = credits + ?
+                                               WHERE rowid = ? AND credits + ? >= 0""", values).rowcount)
+            conn.commit()
+    if report.counts['applied']:
+        changes = ", ".join(f"{k}={form[k]}" for k in ('set_plan', 'set_expiry', 'extend_days', 'credit_delta') if form.get(k))
+        record_log(conn, 'SYSTEM', f"BULK_UPDATE: {report.counts['applied']} users ({changes})", 0, 'Admin')
+        conn.commit()
+    conn.close()
+    return report
+
 # --- DASHBOARD HTML ---
 MODERN_DASHBOARD_HTML = """
 <!DOCTYPE html>
@@ -243,9 +2657,13 @@ MODERN_DASHBOARD_HTML = """
         <nav class="flex-1 overflow-y-auto py-6 px-3 space-y-1">
             <a href="/dashboard" class="sidebar-link flex items-center px-3 py-2.5 text-slate-600 rounded-lg hover:bg-slate-50 transition {{ 'active' if page == 'users' else '' }}"><i class="fas fa-users w-8 text-center"></i> <span class="font-medium">អ្នកប្រើប្រាស់</span></a>
             <a href="/vouchers" class="sidebar-link flex items-center px-3 py-2.5 text-slate-600 rounded-lg hover:bg-slate-50 transition {{ 'active' if page == 'vouchers' else '' }}"><i class="fas fa-ticket-alt w-8 text-center"></i> <span class="font-medium">ប័ណ្ណបញ្ចូនលុយ</span></a>
+            <a href="/bulk" class="sidebar-link flex items-center px-3 py-2.5 text-slate-600 rounded-lg hover:bg-slate-50 transition {{ 'active' if page == 'bulk' else '' }}"><i class="fas fa-layer-group w-8 text-center"></i> <span class="font-medium">Bulk</span></a>
             <a href="/api_keys" class="sidebar-link flex items-center px-3 py-2.5 text-slate-600 rounded-lg hover:bg-slate-50 transition {{ 'active' if page == 'api_keys' else '' }}"><i class="fas fa-key w-8 text-center"></i> <span class="font-medium">API Keys</span></a>
             <a href="/logs" class="sidebar-link flex items-center px-3 py-2.5 text-slate-600 rounded-lg hover:bg-slate-50 transition {{ 'active' if page == 'logs' else '' }}"><i class="fas fa-list-alt w-8 text-center"></i> <span class="font-medium">កំណត់ត្រា</span></a>
+            <a href="/analytics" class="sidebar-link flex items-center px-3 py-2.5 text-slate-600 rounded-lg hover:bg-slate-50 transition {{ 'active' if page == 'analytics' else '' }}"><i class="fas fa-chart-line w-8 text-center"></i> <span class="font-medium">Analytics</span></a>
             <a href="/settings" class="sidebar-link flex items-center px-3 py-2.5 text-slate-600 rounded-lg hover:bg-slate-50 transition {{ 'active' if page == 'settings' else '' }}"><i class="fas fa-cogs w-8 text-center"></i> <span class="font-medium">ការកំណត់</span></a>
+            <a href="/profiles" class="sidebar-link flex items-center px-3 py-2.5 text-slate-600 rounded-lg hover:bg-slate-50 transition {{ 'active' if page == 'profiles' else '' }}"><i class="fas fa-stopwatch w-8 text-center"></i> <span class="font-medium">Profiles</span></a>
+            <a href="/backups" class="sidebar-link flex items-center px-3 py-2.5 text-slate-600 rounded-lg hover:bg-slate-50 transition {{ 'active' if page == 'backups' else '' }}"><i class="fas fa-database w-8 text-center"></i> <span class="font-medium">Backups</span></a>
         </nav>
         <div class="p-4 border-t border-slate-100">
             <a href="/logout" class="flex items-center justify-center w-full px-4 py-2 bg-red-50 text-red-600 rounded-lg font-bold hover:bg-red-100 transition"><i class="fas fa-sign-out-alt mr-2"></i> ចាកចេញ</a>
@@ -265,9 +2683,13 @@ MODERN_DASHBOARD_HTML = """
             
             <h2 class="text-lg md:text-xl font-bold text-slate-800 ml-2 md:ml-0">
                 {% if page == 'users' %}👥 គ្រប់គ្រងអ្នកប្រើប្រាស់ (User Management)
+                {% elif page == 'bulk' %}🗂️ Bulk Operations
                 {% elif page == 'vouchers' %}🎫 ប័ណ្ណបញ្ចូនលុយ (Vouchers)
                 {% elif page == 'api_keys' %}🔑 គ្រប់គ្រង API Keys
                 {% elif page == 'logs' %}📜 កំណត់ត្រាសកម្មភាព
+                {% elif page == 'profiles' %}⏱️ Request Profiles
+                {% elif page == 'backups' %}💾 Backups
+                {% elif page == 'analytics' %}📈 Analytics
                 {% else %}⚙️ ការកំណត់ប្រព័ន្ធ{% endif %}
             </h2>
             <div class="flex items-center gap-3"><span class="h-2 w-2 rounded-full bg-emerald-500 animate-pulse"></span><span class="text-xs font-bold text-emerald-600">System Live</span></div>
@@ -295,6 +2717,12 @@ MODERN_DASHBOARD_HTML = """
                     <h3 class="text-2xl font-bold text-slate-800">{{ stats.Mini }} <span class="text-xs font-normal text-slate-400">users</span></h3>
                 </div>
             </div>
+            <div class="flex flex-wrap gap-4 -mt-4 mb-8 text-xs text-slate-500">
+                <span><span class="font-bold text-emerald-600">{{ statuses.get('1', 0) }}</span> active</span>
+                <span><span class="font-bold text-amber-600">{{ statuses.get('2', 0) }}</span> suspended</span>
+                <span><span class="font-bold text-red-600">{{ statuses.get('0', 0) }}</span> banned</span>
+                <span><span class="font-bold text-slate-700">{{ pending_tasks }}</span> pending tasks</span>
+            </div>
 
             <!-- Add User Form -->
             <div class="bg-white rounded-xl shadow-sm border border-slate-200 p-4 md:p-6 mb-8">
@@ -318,6 +2746,10 @@ MODERN_DASHBOARD_HTML = """
                 </form>
             </div>
 
+            <div class="flex justify-end mb-2">
+                <a href="/usage_report?format=csv" class="text-xs font-bold text-primary hover:underline"><i class="fas fa-file-csv mr-1"></i>Export usage (last 30 days)</a>
+            </div>
+
             <!-- Users Table -->
             <div class="bg-white rounded-xl shadow-sm border border-slate-200 overflow-hidden">
                 <div class="overflow-x-auto">
@@ -358,6 +2790,10 @@ MODERN_DASHBOARD_HTML = """
                     </table>
                 </div>
             </div>
+            <div class="flex justify-between mt-4 text-xs font-bold">
+                <span>{% if not first_page %}<a href="/dashboard" class="text-primary hover:underline"><i class="fas fa-angles-left mr-1"></i>Newest</a>{% endif %}</span>
+                <span>{% if next_page %}<a href="/dashboard?after={{ next_page }}" class="text-primary hover:underline">Older users<i class="fas fa-angle-right ml-1"></i></a>{% endif %}</span>
+            </div>
 
             {% elif page == 'vouchers' %}
             <div class="bg-white rounded-xl shadow-sm border border-slate-200 p-4 md:p-6 mb-8">
@@ -392,17 +2828,26 @@ MODERN_DASHBOARD_HTML = """
             {% elif page == 'api_keys' %}
             <div class="grid grid-cols-1 md:grid-cols-3 gap-6">
                 <div class="md:col-span-2 bg-white rounded-xl shadow-sm border border-slate-200 p-4 md:p-6">
-                    <h3 class="font-bold text-slate-700 mb-4">API Keys Pool</h3>
+                    <div class="flex justify-between items-center mb-4">
+                        <h3 class="font-bold text-slate-700">API Keys Pool <span class="text-xs font-normal text-slate-400">(429 rate over {{ throttle_window // 60 }} min, this worker)</span></h3>
+                        <form action="/api_keys/probe" method="POST"><button class="text-xs bg-slate-100 text-slate-600 px-3 py-1.5 rounded-lg hover:bg-slate-200"><i class="fas fa-sync-alt mr-1"></i> Probe Balances</button></form>
+                    </div>
                     <div class="overflow-x-auto">
                         <table class="w-full text-sm text-left">
-                            <thead class="bg-slate-50 text-slate-500 text-xs uppercase"><tr><th class="px-4 py-3">Label</th><th class="px-4 py-3">Key</th><th class="px-4 py-3">Status</th><th class="px-4 py-3">Errors</th><th class="px-4 py-3">Action</th></tr></thead>
+                            <thead class="bg-slate-50 text-slate-500 text-xs uppercase"><tr><th class="px-4 py-3">Label</th><th class="px-4 py-3">Key</th><th class="px-4 py-3">Provider</th><th class="px-4 py-3">Status</th><th class="px-4 py-3">Tasks</th><th class="px-4 py-3">Requests</th><th class="px-4 py-3">Credits Used</th><th class="px-4 py-3">Balance</th><th class="px-4 py-3">429 Rate</th><th class="px-4 py-3">Failures</th><th class="px-4 py-3">Action</th></tr></thead>
                             <tbody class="divide-y divide-slate-100">
-                                {% for k in api_keys %}
+                                {% for k in api_keys %}{% set u = key_live[k.key_value] %}
                                 <tr>
                                     <td class="px-4 py-3 font-bold">{{ k.label }}</td>
                                     <td class="px-4 py-3 font-mono text-xs">{{ k.key_value[:15] }}...</td>
-                                    <td class="px-4 py-3">{% if k.is_active %}<span class="text-emerald-500 text-xs font-bold">Active</span>{% else %}<span class="text-red-500">Inactive</span>{% endif %}</td>
-                                    <td class="px-4 py-3">{{ k.error_count }}</td>
+                                    <td class="px-4 py-3 text-xs">{{ k.provider or 'any' }}</td>
+                                    <td class="px-4 py-3">{% if not k.is_active %}<span class="text-red-500">Inactive</span>{% elif u.strained %}<span class="text-amber-500 text-xs font-bold">Strained</span>{% else %}<span class="text-emerald-500 text-xs font-bold">Active</span>{% endif %}</td>
+                                    <td class="px-4 py-3">{{ key_tasks.get(k.key_value, 0) }}</td>
+                                    <td class="px-4 py-3">{{ k.requests_total or 0 }}</td>
+                                    <td class="px-4 py-3">{{ '%g' % (k.credits_used or 0) }}</td>
+                                    <td class="px-4 py-3">{% if u.estimated_balance is not none %}{{ '%g' % u.estimated_balance }}{% else %}<span class="text-slate-400">-</span>{% endif %}</td>
+                                    <td class="px-4 py-3">{{ '%.0f' % (u.throttle_rate * 100) }}% <span class="text-xs text-slate-400">/ {{ u.window_calls }}</span></td>
+                                    <td class="px-4 py-3" title="{{ k.last_failure_at or '' }}">{{ k.error_count }}{% if k.last_failure %}<div class="text-xs text-red-400 truncate max-w-[12rem]">{{ k.last_failure }}</div>{% endif %}</td>
                                     <td class="px-4 py-3"><a href="/delete_key/{{ k.key_value }}" class="text-red-400"><i class="fas fa-trash"></i></a></td>
                                 </tr>
                                 {% endfor %}
@@ -415,9 +2860,32 @@ MODERN_DASHBOARD_HTML = """
                     <form action="/add_api_key" method="POST" class="space-y-3">
                         <input type="text" name="label" placeholder="Label Name" class="w-full px-3 py-2 bg-slate-50 border rounded-lg" required>
                         <input type="text" name="key_value" placeholder="sk-..." class="w-full px-3 py-2 bg-slate-50 border rounded-lg" required>
+                        <select name="provider" class="w-full px-3 py-2 bg-slate-50 border rounded-lg">
+                            <option value="">Any provider</option>
+                            {% for p in providers %}<option value="{{ p.name }}">{{ p.name }}</option>{% endfor %}
+                        </select>
                         <button class="w-full bg-emerald-500 text-white font-bold py-2 rounded-lg hover:bg-emerald-600">Add Key</button>
                     </form>
                 </div>
+                <div class="md:col-span-3 bg-white rounded-xl shadow-sm border border-slate-200 p-4 md:p-6">
+                    <h3 class="font-bold text-slate-700 mb-4">Upstream Providers <span class="text-xs font-normal text-slate-400">(policy: {{ provider_policy }})</span></h3>
+                    <div class="overflow-x-auto">
+                        <table class="w-full text-sm text-left">
+                            <thead class="bg-slate-50 text-slate-500 text-xs uppercase"><tr><th class="px-4 py-3">Name</th><th class="px-4 py-3">Endpoint</th><th class="px-4 py-3">Priority</th><th class="px-4 py-3">Latency</th><th class="px-4 py-3">State</th></tr></thead>
+                            <tbody class="divide-y divide-slate-100">
+                                {% for p in providers %}
+                                <tr>
+                                    <td class="px-4 py-3 font-bold">{{ p.name }}</td>
+                                    <td class="px-4 py-3 font-mono text-xs">{{ p.base_url }}</td>
+                                    <td class="px-4 py-3">{{ p.priority }}</td>
+                                    <td class="px-4 py-3">{{ (p.latency_ms | round | int ~ 'ms') if p.latency_ms is not none else '-' }}</td>
+                                    <td class="px-4 py-3 text-xs font-bold">{% if not p.enabled %}<span class="text-slate-400">Disabled</span>{% elif not p.is_available() %}<span class="text-red-500">Benched</span>{% else %}<span class="text-emerald-500">Healthy</span>{% endif %}</td>
+                                </tr>
+                                {% endfor %}
+                            </tbody>
+                        </table>
+                    </div>
+                </div>
             </div>
 
             {% elif page == 'logs' %}
@@ -515,6 +2983,184 @@ MODERN_DASHBOARD_HTML = """
                      </form>
                 </div>
             </div>
+
+            {% elif page == 'analytics' %}
+            <div class="flex items-center gap-2 mb-6">
+                {% for d in [1, 7, 30, 90] %}
+                <button onclick="loadAnalytics({{ d }})" class="range-btn px-3 py-1.5 rounded-lg border bg-white text-sm font-bold text-slate-600 hover:bg-slate-100" data-days="{{ d }}">{{ d }}d</button>
+                {% endfor %}
+                <span id="analyticsMeta" class="text-xs text-slate-400 ml-auto"></span>
+            </div>
+            <div class="grid grid-cols-1 md:grid-cols-4 gap-4 mb-6">
+                <div class="bg-white p-4 rounded-xl shadow-sm border border-l-4 border-indigo-500"><p class="text-xs text-slate-400 font-bold uppercase mb-1">Generations</p><h3 id="kpiGenerations" class="text-2xl font-bold text-slate-800">-</h3></div>
+                <div class="bg-white p-4 rounded-xl shadow-sm border border-l-4 border-amber-500"><p class="text-xs text-slate-400 font-bold uppercase mb-1">Credit Burn</p><h3 id="kpiCredits" class="text-2xl font-bold text-slate-800">-</h3></div>
+                <div class="bg-white p-4 rounded-xl shadow-sm border border-l-4 border-red-500"><p class="text-xs text-slate-400 font-bold uppercase mb-1">Refund Ratio</p><h3 id="kpiRefund" class="text-2xl font-bold text-slate-800">-</h3></div>
+                <div class="bg-white p-4 rounded-xl shadow-sm border border-l-4 border-emerald-500"><p class="text-xs text-slate-400 font-bold uppercase mb-1">Peak Active Users</p><h3 id="kpiActive" class="text-2xl font-bold text-slate-800">-</h3></div>
+            </div>
+            <div class="grid grid-cols-1 md:grid-cols-2 gap-6 mb-6">
+                <div class="bg-white rounded-xl shadow-sm border border-slate-200 p-4"><h4 class="font-bold text-slate-700 mb-2 text-sm">Generations</h4><canvas id="chartGenerations" height="160"></canvas></div>
+                <div class="bg-white rounded-xl shadow-sm border border-slate-200 p-4"><h4 class="font-bold text-slate-700 mb-2 text-sm">Credit Burn</h4><canvas id="chartCredits" height="160"></canvas></div>
+                <div class="bg-white rounded-xl shadow-sm border border-slate-200 p-4"><h4 class="font-bold text-slate-700 mb-2 text-sm">Active Users</h4><canvas id="chartActive" height="160"></canvas></div>
+                <div class="bg-white rounded-xl shadow-sm border border-slate-200 p-4">
+                    <h4 class="font-bold text-slate-700 mb-2 text-sm">Refund Ratio per Model</h4>
+                    <table class="w-full text-sm text-left"><thead class="bg-slate-50 text-slate-500 text-xs uppercase"><tr><th class="px-3 py-2">Model</th><th class="px-3 py-2">Generations</th><th class="px-3 py-2">Refunds</th><th class="px-3 py-2">Ratio</th></tr></thead><tbody id="modelTable" class="divide-y divide-slate-100"></tbody></table>
+                    <h4 class="font-bold text-slate-700 mt-6 mb-2 text-sm">Upstream Failure Rate per Key</h4>
+                    <table class="w-full text-sm text-left"><thead class="bg-slate-50 text-slate-500 text-xs uppercase"><tr><th class="px-3 py-2">Key</th><th class="px-3 py-2">Requests</th><th class="px-3 py-2">Failures</th><th class="px-3 py-2">Rate</th></tr></thead><tbody id="keyTable" class="divide-y divide-slate-100"></tbody></table>
+                </div>
+            </div>
+            <script src="https://cdn.jsdelivr.net/npm/chart.js@4.4.0/dist/chart.umd.min.js"></script>
+            <script>
+                const charts = {};
+                function drawChart(id, labels, datasets, type) {
+                    if (charts[id]) charts[id].destroy();
+                    charts[id] = new Chart(document.getElementById(id), { type: type || 'line', data: { labels: labels, datasets: datasets },
+                        options: { animation: false, plugins: { legend: { display: datasets.length > 1 } }, scales: { x: { ticks: { maxTicksLimit: 12 } } } } });
+                }
+                function pct(x) { return (x * 100).toFixed(1) + '%'; }
+                function loadAnalytics(days) {
+                    document.querySelectorAll('.range-btn').forEach(b => b.classList.toggle('bg-indigo-100', b.dataset.days == days));
+                    fetch('/analytics/data?days=' + days).then(r => r.json()).then(d => {
+                        const models = Object.keys(d.models);
+                        drawChart('chartGenerations', d.buckets, models.map(m => ({ label: m, data: d.series.generations[m] || [] })), 'bar');
+                        drawChart('chartCredits', d.buckets, [{ label: 'credits', data: d.series.credits_spent, borderColor: '#f59e0b' }]);
+                        drawChart('chartActive', d.buckets, [{ label: 'users', data: d.series.active_users, borderColor: '#10b981' }]);
+                        document.getElementById('kpiGenerations').innerText = d.totals.generations;
+                        document.getElementById('kpiCredits').innerText = d.totals.credits_spent;
+                        document.getElementById('kpiRefund').innerText = pct(d.totals.refund_ratio);
+                        document.getElementById('kpiActive').innerText = d.totals.peak_active_users;
+                        document.getElementById('modelTable').innerHTML = models.map(m => '<tr><td class="px-3 py-2 font-bold">' + m + '</td><td class="px-3 py-2">' + d.models[m].generations + '</td><td class="px-3 py-2">' + d.models[m].refunds + '</td><td class="px-3 py-2">' + pct(d.models[m].refund_ratio) + '</td></tr>').join('');
+                        document.getElementById('keyTable').innerHTML = d.keys.map(k => '<tr><td class="px-3 py-2 font-bold">' + k.label + '</td><td class="px-3 py-2">' + k.requests + '</td><td class="px-3 py-2">' + k.failures + '</td><td class="px-3 py-2 ' + (k.failure_rate > 0.1 ? 'text-red-500 font-bold' : '') + '">' + pct(k.failure_rate) + '</td></tr>').join('');
+                        document.getElementById('analyticsMeta').innerText = d.granularity + ' rollups, ' + d.query_ms + 'ms';
+                    });
+                }
+                loadAnalytics(7);
+            </script>
+
+            {% elif page == 'profiles' %}
+            <div class="bg-white rounded-xl shadow-sm border border-slate-200 p-4 md:p-6 mb-6 text-sm text-slate-600">
+                {% if profile_enabled %}
+                Profiling is <span class="font-bold text-emerald-600">ON</span>: requests slower than <b>{{ slow_ms }}ms</b> and a <b>{{ sample_rate }}</b> sampled fraction are captured (last {{ keep }} kept).
+                {% else %}
+                Profiling is <span class="font-bold text-red-500">OFF</span>. Start the server with <code class="bg-slate-100 px-1 rounded">PROFILE_ENABLED=1</code> to capture slow or sampled requests.
+                {% endif %}
+            </div>
+            <div class="bg-white rounded-xl shadow-sm border border-slate-200 overflow-hidden">
+                <div class="overflow-x-auto">
+                    <table class="w-full text-sm text-left">
+                        <thead class="bg-slate-50 text-slate-500 text-xs uppercase"><tr><th class="px-4 md:px-6 py-3">Captured</th><th class="px-4 md:px-6 py-3">Request</th><th class="px-4 md:px-6 py-3">Time</th><th class="px-4 md:px-6 py-3">SQL</th><th class="px-4 md:px-6 py-3">Reason</th><th class="px-4 md:px-6 py-3">Download</th></tr></thead>
+                        <tbody class="divide-y divide-slate-100">
+                            {% for p in profiles %}
+                            <tr>
+                                <td class="px-4 md:px-6 py-3 text-xs text-slate-400 font-mono">{{ p.captured_at }}</td>
+                                <td class="px-4 md:px-6 py-3 font-mono text-xs">{{ p.method }} {{ p.path }} <span class="text-slate-400">({{ p.status }})</span></td>
+                                <td class="px-4 md:px-6 py-3 font-bold {{ 'text-red-500' if p.elapsed_ms >= slow_ms else '' }}">{{ p.elapsed_ms }}ms</td>
+                                <td class="px-4 md:px-6 py-3 text-xs">{{ p.sql_count }} queries / {{ p.sql_ms }}ms</td>
+                                <td class="px-4 md:px-6 py-3 text-xs">{{ p.reason }}</td>
+                                <td class="px-4 md:px-6 py-3 text-xs space-x-2">
+                                    <a href="/profiles/{{ p.name }}.json" class="text-primary font-bold">JSON</a>
+                                    {% if p.has_prof %}<a href="/profiles/{{ p.name }}.prof" class="text-primary font-bold">.prof</a>{% endif %}
+                                </td>
+                            </tr>
+                            {% endfor %}
+                        </tbody>
+                    </table>
+                </div>
+            </div>
+
+            {% elif page == 'bulk' %}
+            <div class="bg-white rounded-xl shadow-sm border border-slate-200 p-4 md:p-6 mb-6 text-sm text-slate-600">
+                <p>Changes are written in transactions of <b>{{ bulk_chunk }}</b> rows. Use <b>Preview</b> first: it validates every row and reports what would change without writing anything. Tick <b>CSV report</b> to download one line per row (imports include the generated API keys).</p>
+            </div>
+            <div class="grid grid-cols-1 lg:grid-cols-3 gap-6 mb-6">
+                <form action="/bulk/import_users" method="POST" enctype="multipart/form-data" class="bulk-form bg-white rounded-xl shadow-sm border border-slate-200 p-4 md:p-6 space-y-3">
+                    <h3 class="font-bold text-slate-700"><i class="fas fa-file-import text-primary mr-2"></i>Import users (CSV)</h3>
+                    <p class="text-xs text-slate-400">Columns: <code>username</code>, optional <code>credits, plan, expiry, api_key, assigned_key</code>. Existing users are skipped.</p>
+                    <input type="file" name="file" accept=".csv,text/csv" class="w-full text-xs" required>
+                    <div class="grid grid-cols-3 gap-2">
+                        <div><label class="text-xs font-bold text-slate-500">Credits</label><input type="number" name="credits" value="100" class="w-full mt-1 px-2 py-1.5 bg-slate-50 border rounded-lg"></div>
+                        <div><label class="text-xs font-bold text-slate-500">Plan</label><select name="plan" class="w-full mt-1 px-2 py-1.5 bg-slate-50 border rounded-lg">{% for p in plans %}<option value="{{ p }}" {{ 'selected' if p == 'Standard' else '' }}>{{ p }}</option>{% endfor %}</select></div>
+                        <div><label class="text-xs font-bold text-slate-500">Expiry</label><input type="date" name="expiry" class="w-full mt-1 px-2 py-1.5 bg-slate-50 border rounded-lg"></div>
+                    </div>
+                    <label class="text-xs text-slate-500 flex items-center gap-2"><input type="checkbox" name="format" value="csv"> CSV report</label>
+                    <div class="flex gap-2"><button name="dry_run" value="1" class="flex-1 bg-slate-100 text-slate-700 font-bold py-2 rounded-lg">Preview</button><button name="dry_run" value="0" class="flex-1 bg-primary text-white font-bold py-2 rounded-lg" onclick="return confirm('Import these users?')">Import</button></div>
+                </form>
+                <form action="/bulk/credits" method="POST" enctype="multipart/form-data" class="bulk-form bg-white rounded-xl shadow-sm border border-slate-200 p-4 md:p-6 space-y-3">
+                    <h3 class="font-bold text-slate-700"><i class="fas fa-coins text-primary mr-2"></i>Adjust credits (CSV)</h3>
+                    <p class="text-xs text-slate-400">Columns: <code>username, delta</code> (signed). Rows that would leave a user below 0 credits are rejected.</p>
+                    <input type="file" name="file" accept=".csv,text/csv" class="w-full text-xs" required>
+                    <label class="text-xs text-slate-500 flex items-center gap-2"><input type="checkbox" name="format" value="csv"> CSV report</label>
+                    <div class="flex gap-2"><button name="dry_run" value="1" class="flex-1 bg-slate-100 text-slate-700 font-bold py-2 rounded-lg">Preview</button><button name="dry_run" value="0" class="flex-1 bg-primary text-white font-bold py-2 rounded-lg" onclick="return confirm('Apply these credit changes?')">Apply</button></div>
+                </form>
+                <form action="/bulk/update" method="POST" class="bulk-form bg-white rounded-xl shadow-sm border border-slate-200 p-4 md:p-6 space-y-3">
+                    <h3 class="font-bold text-slate-700"><i class="fas fa-users-cog text-primary mr-2"></i>Update users by filter</h3>
+                    <div class="grid grid-cols-2 gap-2">
+                        <div><label class="text-xs font-bold text-slate-500">Plan is</label><select name="plan" class="w-full mt-1 px-2 py-1.5 bg-slate-50 border rounded-lg"><option value="">any</option>{% for p in plans %}<option value="{{ p }}">{{ p }}</option>{% endfor %}</select></div>
+                        <div><label class="text-xs font-bold text-slate-500">Status is</label><select name="status" class="w-full mt-1 px-2 py-1.5 bg-slate-50 border rounded-lg"><option value="">any</option>{% for s in statuses %}<option value="{{ s }}">{{ s }}</option>{% endfor %}</select></div>
+                        <div><label class="text-xs font-bold text-slate-500">Expires before</label><input type="date" name="expires_before" class="w-full mt-1 px-2 py-1.5 bg-slate-50 border rounded-lg"></div>
+                        <div><label class="text-xs font-bold text-slate-500">Expires on/after</label><input type="date" name="expires_after" class="w-full mt-1 px-2 py-1.5 bg-slate-50 border rounded-lg"></div>
+                        <div class="col-span-2"><label class="text-xs font-bold text-slate-500">Username starts with</label><input type="text" name="username_prefix" class="w-full mt-1 px-2 py-1.5 bg-slate-50 border rounded-lg"></div>
+                    </div>
+                    <label class="text-xs text-slate-500 flex items-center gap-2"><input type="checkbox" name="all" value="1"> All users (no filter)</label>
+                    <div class="grid grid-cols-2 gap-2 pt-2 border-t">
+                        <div><label class="text-xs font-bold text-slate-500">Set plan</label><select name="set_plan" class="w-full mt-1 px-2 py-1.5 bg-slate-50 border rounded-lg"><option value="">unchanged</option>{% for p in plans %}<option value="{{ p }}">{{ p }}</option>{% endfor %}</select></div>
+                        <div><label class="text-xs font-bold text-slate-500">Set expiry</label><input type="date" name="set_expiry" class="w-full mt-1 px-2 py-1.5 bg-slate-50 border rounded-lg"></div>
+                        <div><label class="text-xs font-bold text-slate-500">Extend (days)</label><input type="number" name="extend_days" class="w-full mt-1 px-2 py-1.5 bg-slate-50 border rounded-lg"></div>
+                        <div><label class="text-xs font-bold text-slate-500">Credits +/-</label><input type="number" name="credit_delta" class="w-full mt-1 px-2 py-1.5 bg-slate-50 border rounded-lg"></div>
+                    </div>
+                    <label class="text-xs text-slate-500 flex items-center gap-2"><input type="checkbox" name="format" value="csv"> CSV report</label>
+                    <div class="flex gap-2"><button name="dry_run" value="1" class="flex-1 bg-slate-100 text-slate-700 font-bold py-2 rounded-lg">Preview</button><button name="dry_run" value="0" class="flex-1 bg-primary text-white font-bold py-2 rounded-lg" onclick="return confirm('Update all matching users?')">Apply</button></div>
+                </form>
+            </div>
+            <pre id="bulkResult" class="hidden bg-slate-900 text-slate-100 text-xs rounded-xl p-4 overflow-x-auto max-h-[60vh]"></pre>
+            <script>
+                // JSON reports are shown inline; CSV reports are left to the browser as a download
+                document.querySelectorAll('.bulk-form').forEach(form => {
+                    form.addEventListener('submit', (e) => {
+                        if (form.querySelector('input[name=format]').checked) return;
+                        e.preventDefault();
+                        const data = new FormData(form);
+                        if (e.submitter) data.set(e.submitter.name, e.submitter.value);
+                        const out = document.getElementById('bulkResult');
+                        out.classList.remove('hidden');
+                        out.textContent = 'Working…';
+                        fetch(form.action, { method: 'POST', body: data })
+                            .then(r => r.json())
+                            .then(j => { out.textContent = JSON.stringify(j, null, 2); if (!j.error && !j.dry_run) showToast(j.applied + ' users updated'); })
+                            .catch(err => { out.textContent = 'Request failed: ' + err; });
+                    });
+                });
+            </script>
+            {% elif page == 'backups' %}
+            <div class="bg-white rounded-xl shadow-sm border border-slate-200 p-4 md:p-6 mb-6 text-sm text-slate-600 flex flex-col md:flex-row md:items-center gap-4">
+                <div class="flex-1 space-y-1">
+                    <p>Scheduled backups are {% if backup_enabled %}<span class="font-bold text-emerald-600">ON</span> every <b>{{ backup_interval // 3600 }}h</b>{% else %}<span class="font-bold text-red-500">OFF</span>{% endif %}, last {{ backup_keep }} kept per file in <code class="bg-slate-100 px-1 rounded">{{ backup_dir }}</code>.</p>
+                    <p>Last run: <b>{{ backup.last_finished or 'never' }}</b>{% if backup.last_duration_s is not none %} ({{ backup.last_duration_s }}s){% endif %}{% if backup.running %} <span class="font-bold text-amber-600">running…</span>{% endif %}</p>
+                    {% if backup.last_error %}<p class="text-red-500 font-bold">Error: {{ backup.last_error }}</p>{% endif %}
+                    <p>Report snapshot: <b>{{ snapshot_at or 'none yet' }}</b></p>
+                </div>
+                <form action="/backups/run" method="POST"><button class="bg-primary text-white font-bold px-6 py-2 rounded" {{ 'disabled' if backup.running else '' }}><i class="fas fa-play mr-2"></i>Backup now</button></form>
+            </div>
+            <div class="bg-white rounded-xl shadow-sm border border-slate-200 overflow-hidden">
+                <div class="overflow-x-auto">
+                    <table class="w-full text-sm text-left">
+                        <thead class="bg-slate-50 text-slate-500 text-xs uppercase"><tr><th class="px-4 md:px-6 py-3">Created</th><th class="px-4 md:px-6 py-3">File</th><th class="px-4 md:px-6 py-3">Size</th><th class="px-4 md:px-6 py-3">SHA-256</th><th class="px-4 md:px-6 py-3">Download</th></tr></thead>
+                        <tbody class="divide-y divide-slate-100">
+                            {% for b in backups %}
+                            <tr>
+                                <td class="px-4 md:px-6 py-3 text-xs text-slate-400 font-mono">{{ b.created }}</td>
+                                <td class="px-4 md:px-6 py-3 font-mono text-xs">{{ b.name }}</td>
+                                <td class="px-4 md:px-6 py-3 text-xs">{{ '%.1f' % (b.size / 1048576) }} MB</td>
+                                <td class="px-4 md:px-6 py-3 font-mono text-xs text-slate-400" title="{{ b.sha256 }}">{{ b.sha256[:16] }}…</td>
+                                <td class="px-4 md:px-6 py-3 text-xs space-x-2">
+                                    <a href="/backups/{{ b.name }}" class="text-primary font-bold">.gz</a>
+                                    <a href="/backups/{{ b.name }}.sha256" class="text-primary font-bold">.sha256</a>
+                                </td>
+                            </tr>
+                            {% endfor %}
+                        </tbody>
+                    </table>
+                </div>
+            </div>
             {% endif %}
         </div>
     </main>
@@ -677,6 +3323,17 @@ MODERN_DASHBOARD_HTML = """
 """
 
 # --- AUTH & ROUTES ---
+_dashboard_template = None
+
+def render_dashboard(**context):
+    """Render MODERN_DASHBOARD_HTML, compiled by Jinja on first use instead of on every page view."""
+    global _dashboard_template
+    if _dashboard_template is None:
+        t0 = time.perf_counter()
+        _dashboard_template = app.jinja_env.from_string(MODERN_DASHBOARD_HTML)
+        startup_timings["lazy_dashboard_template"] = round((time.perf_counter() - t0) * 1000, 1)
+    return render_template(_dashboard_template, **context)
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -706,28 +3363,33 @@ def logout():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    conn = get_db()
+    after = request.args.get('after', type=int)
+    conn = get_read_db()
     api_keys = conn.execute("SELECT key_value, label FROM api_keys WHERE is_active=1").fetchall()
-    users_raw = conn.execute("SELECT * FROM users ORDER BY created_at DESC").fetchall()
-    users = [dict(u) for u in users_raw]
+    # One page of users, newest first; ?after= is the rowid of the previous page's last row
+    users_raw = conn.execute("SELECT rowid, * FROM users WHERE rowid < ? ORDER BY rowid DESC LIMIT ?",
+                             (after if after is not None else sys.maxsize, DASHBOARD_PAGE + 1)).fetchall()
+    users = [dict(u) for u in users_raw[:DASHBOARD_PAGE]]
+    next_page = users[-1]['rowid'] if len(users_raw) > DASHBOARD_PAGE else None
     
-    stats = {'Premium': 0, 'Standard': 0, 'Basic': 0, 'Mini': 0}
-    for u in users:
-        p = u.get('plan', 'Standard')
-        if p in stats: 
-            stats[p] += 1
+    # Header totals come from the trigger-maintained counters, not from the rows above
+    plans = get_counters(conn, 'users_plan')
+    stats = {p: plans.get(p, 0) for p in ('Premium', 'Standard', 'Basic', 'Mini')}
+    statuses = get_counters(conn, 'users_status')
+    pending_tasks = get_counters(conn, 'tasks_status').get('pending', 0)
             
     conn.close()
-    return render_template_string(MODERN_DASHBOARD_HTML, page='users', users=users, api_keys=api_keys, stats=stats)
+    return render_dashboard(page='users', users=users, api_keys=api_keys, stats=stats,
+                            statuses=statuses, pending_tasks=pending_tasks, next_page=next_page, first_page=after is None)
 
 @app.route('/vouchers')
 @login_required
 def vouchers():
     try:
-        conn = get_db()
+        conn = get_read_db()
         v = conn.execute("SELECT code, amount, max_uses, current_uses, expiry_date FROM vouchers ORDER BY created_at DESC").fetchall()
         conn.close()
-        return render_template_string(MODERN_DASHBOARD_HTML, page='vouchers', vouchers=v)
+        return render_dashboard(page='vouchers', vouchers=v)
     except Exception as e: 
         return f"DB Error: {e}", 500
 
@@ -735,18 +3397,42 @@ def vouchers():
 @login_required
 def view_keys():
     try:
-        conn = get_db()
-        keys = conn.execute("SELECT key_value, label, is_active, error_count FROM api_keys").fetchall()
+        key_usage.flush()
+        conn = get_read_db()
+        keys = conn.execute("""SELECT key_value, label, is_active, error_count, provider, requests_total, credits_used,
+                               last_failure, last_failure_at, balance, balance_checked_ts FROM api_keys""").fetchall()
+        key_tasks = get_counters(conn, 'tasks_key')
         conn.close()
-        return render_template_string(MODERN_DASHBOARD_HTML, page='api_keys', api_keys=keys)
+        providers.reload_if_changed()
+        return render_dashboard(page='api_keys', api_keys=keys, key_tasks=key_tasks,
+                                key_live=key_usage.status(keys), throttle_window=KEY_THROTTLE_WINDOW,
+                                providers=list(providers.providers.values()), provider_policy=providers.policy)
     except Exception as e: 
         return f"DB Error: {e}", 500
 
+@app.route('/api_keys/status')
+@login_required
+def key_usage_status():
+    key_usage.flush()
+    conn = get_read_db()
+    keys = conn.execute("""SELECT key_value, label, is_active, error_count, requests_total, throttled_total, credits_used,
+                           last_failure, last_failure_at, balance, balance_checked_ts FROM api_keys""").fetchall()
+    conn.close()
+    live = key_usage.status(keys)
+    return jsonify({k['key_value'][:15] + '...': dict({c: k[c] for c in k.keys() if c != 'key_value'}, **live[k['key_value']])
+                    for k in keys})
+
+@app.route('/api_keys/probe', methods=['POST'])
+@login_required
+def key_balance_probe():
+    probe_key_balances()
+    return redirect('/api_keys')
+
 @app.route('/logs')
 @login_required
 def view_logs():
     try:
-        conn = get_db()
+        conn = get_read_db()
         # Check if task_id column exists
         try:
             l = conn.execute("SELECT timestamp, username, action, cost, status, task_id FROM logs ORDER BY id DESC LIMIT 100").fetchall()
@@ -760,10 +3446,132 @@ def view_logs():
                 raise e
         
         conn.close()
-        return render_template_string(MODERN_DASHBOARD_HTML, page='logs', logs=l)
+        return render_dashboard(page='logs', logs=l)
     except Exception as e: 
         return f"DB Error: {e}", 500
 
+@app.route('/usage_report')
+@login_required
+def usage_report():
+    """Per-user usage between two days, read from the usage_daily rollups (CSV with ?format=csv).
+    ?source=snapshot reads the latest backup snapshot instead of the live DB."""
+    today = datetime.now().strftime("%Y-%m-%d")
+    day_from = request.args.get('from') or (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d")
+    day_to = request.args.get('to') or today
+    username = request.args.get('username')
+    conn = get_snapshot_db() if request.args.get('source') == 'snapshot' else get_read_db()
+    if conn is None:
+        return jsonify({"error": "No snapshot yet, run a backup first"}), 404
+    rows = conn.execute(f"""SELECT username, SUM(generations) AS generations, SUM(credits_spent) AS credits_spent,
+                                   SUM(refunds) AS refunds, SUM(credits_refunded) AS credits_refunded,
+                                   SUM(session_minutes) AS session_minutes, COUNT(*) AS active_days
+                            FROM usage_daily WHERE day BETWEEN ? AND ? {'AND username = ?' if username else ''}
+                            GROUP BY username ORDER BY credits_spent DESC""",
+                        (day_from, day_to, username) if username else (day_from, day_to)).fetchall()
+    conn.close()
+    rows = [dict(r) for r in rows]
+    if request.args.get('format') == 'csv':
+        cols = ['username', 'generations', 'credits_spent', 'refunds', 'credits_refunded', 'session_minutes', 'active_days']
+        lines = [",".join(cols)] + [",".join(str(r[c]) for c in cols) for r in rows]
+        return "\n".join(lines) + "\n", 200, {
+            'Content-Type': 'text/csv',
+            'Content-Disposition': f'attachment; filename=usage_{day_from}_{day_to}.csv'}
+    return jsonify({"from": day_from, "to": day_to, "users": rows})
+
+@app.route('/analytics')
+@login_required
+def view_analytics():
+    return render_dashboard(page='analytics')
+
+@app.route('/analytics/data')
+@login_required
+def analytics_data():
+    """Time series for the analytics page, read only from the stats_hourly/stats_daily rollups."""
+    t0 = time.perf_counter()
+    days = max(1, min(request.args.get('days', 7, type=int), 365))
+    granularity = request.args.get('granularity') or ('hour' if days <= 7 else 'day')
+    if days > 14:
+        granularity = 'day'  # hourly series beyond two weeks are too large to be useful
+    table, fmt, step = ('stats_hourly', "%Y-%m-%d %H", timedelta(hours=1)) if granularity == 'hour' else ('stats_daily', "%Y-%m-%d", timedelta(days=1))
+    analytics.flush()  # include this worker's pending counters
+
+    now = datetime.now()
+    start = now - timedelta(days=days) + step
+    buckets = []
+    b = start
+    while b <= now:
+        buckets.append(b.strftime(fmt))
+        b += step
+    index = {bucket: i for i, bucket in enumerate(buckets)}
+
+    conn = get_read_db()
+    rows = conn.execute(f"SELECT bucket, metric, dim, value FROM {table} WHERE bucket >= ?", (buckets[0],)).fetchall()
+    labels = {k['key_value']: k['label'] for k in conn.execute("SELECT key_value, label FROM api_keys").fetchall()}
+    conn.close()
+
+    series = {'generations': {}, 'credits_spent': [0] * len(buckets), 'active_users': [0] * len(buckets)}
+    models, keys = {}, {}
+    for bucket, metric, dim, value in rows:
+        i = index.get(bucket)
+        if i is None:
+            continue
+        if metric in ('generations', 'refunds', 'credits_spent', 'credits_refunded'):
+            m = models.setdefault(dim or 'unknown', {'generations': 0, 'refunds': 0, 'credits_spent': 0, 'credits_refunded': 0})
+            m[metric] += value
+            if metric == 'generations':
+                series['generations'].setdefault(dim or 'unknown', [0] * len(buckets))[i] += value
+            elif metric == 'credits_spent':
+                series['credits_spent'][i] += value
+        elif metric in ('upstream_requests', 'upstream_failures'):
+            k = keys.setdefault(dim, {'label': labels.get(dim, dim[:10] + '...'), 'requests': 0, 'failures': 0})
+            k['requests' if metric == 'upstream_requests' else 'failures'] += value
+        elif metric == 'active_users':
+            series['active_users'][i] += value
+
+    for m in models.values():
+        m['refund_ratio'] = round(m['refunds'] / m['generations'], 4) if m['generations'] else 0
+    for k in keys.values():
+        k['failure_rate'] = round(k['failures'] / k['requests'], 4) if k['requests'] else 0
+    total_gen = sum(m['generations'] for m in models.values())
+    return jsonify({
+        "granularity": granularity, "buckets": buckets, "series": series, "models": models,
+        "keys": sorted(keys.values(), key=lambda k: -k['requests']),
+        "totals": {
+            "generations": total_gen,
+            "credits_spent": sum(m['credits_spent'] for m in models.values()),
+            "refund_ratio": round(sum(m['refunds'] for m in models.values()) / total_gen, 4) if total_gen else 0,
+            "peak_active_users": max(series['active_users'] or [0]),
+        },
+        "query_ms": round((time.perf_counter() - t0) * 1000, 2),
+    })
+
+@app.route('/reaper/status')
+@login_required
+def reaper_status():
+    conn = get_read_db()
+    pending = conn.execute("SELECT COUNT(*) FROM tasks WHERE status = 'pending' AND created_at < ?",
+                           (str(datetime.now() - timedelta(seconds=REAPER_MIN_AGE)),)).fetchone()[0]
+    conn.close()
+    return jsonify(dict(reaper_stats, stale_pending=pending, enabled=REAPER_ENABLED, interval_s=REAPER_INTERVAL))
+
+@app.route('/dispatcher/status')
+@login_required
+def dispatcher_status():
+    return jsonify(dispatcher.status())
+
+@app.route('/hedge/status')
+@login_required
+def hedge_status():
+    return jsonify(hedger.status())
+
+@app.route('/reaper/run', methods=['POST'])
+@login_required
+def reaper_run():
+    if reaper_stats["running"]:
+        return jsonify({"started": False, "message": "Reaper already running"}), 409
+    threading.Thread(target=reap_stale_tasks, name="reaper-manual", daemon=True).start()
+    return jsonify({"started": True}), 202
+
 @app.route('/settings')
 @login_required
 def settings():
@@ -775,10 +3583,62 @@ def settings():
     broadcast_color = get_setting('broadcast_color', '#FF0000')
     costs = {'sora_2': get_setting('cost_sora_2', 25), 'sora_2_pro': get_setting('cost_sora_2_pro', 35)}
     
-    return render_template_string(MODERN_DASHBOARD_HTML, page='settings', costs=costs,
-                                  latest_version=latest_ver, update_desc=update_desc,
-                                  update_is_live=update_is_live, update_url=update_url,
-                                  broadcast_msg=broadcast_msg, broadcast_color=broadcast_color)
+    return render_dashboard(page='settings', costs=costs,
+                            latest_version=latest_ver, update_desc=update_desc,
+                            update_is_live=update_is_live, update_url=update_url,
+                            broadcast_msg=broadcast_msg, broadcast_color=broadcast_color)
+
+@app.route('/profiles')
+@login_required
+def view_profiles():
+    profiles = []
+    if os.path.isdir(PROFILE_DIR):
+        for n in sorted(os.listdir(PROFILE_DIR), reverse=True):
+            if not n.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(PROFILE_DIR, n)) as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                continue
+            meta['name'] = n[:-5]
+            meta['has_prof'] = os.path.exists(os.path.join(PROFILE_DIR, n[:-5] + ".prof"))
+            profiles.append(meta)
+    return render_dashboard(page='profiles', profiles=profiles,
+                            profile_enabled=PROFILE_ENABLED, slow_ms=PROFILE_SLOW_MS,
+                            sample_rate=PROFILE_SAMPLE_RATE, keep=PROFILE_KEEP)
+
+@app.route('/profiles/<name>')
+@login_required
+def download_profile(name):
+    path = os.path.join(PROFILE_DIR, secure_filename(name))
+    if not name.endswith((".json", ".prof")) or not os.path.isfile(path):
+        abort(404)
+    return send_file(os.path.abspath(path), as_attachment=True)
+
+@app.route('/backups')
+@login_required
+def view_backups():
+    snapshot = snapshot_path(DB_PATH)
+    snapshot_at = str(datetime.fromtimestamp(os.path.getmtime(snapshot)))[:19] if os.path.exists(snapshot) else None
+    return render_dashboard(page='backups', backups=list_backups(), backup=backup_stats,
+                            snapshot_at=snapshot_at, backup_enabled=BACKUP_ENABLED, backup_interval=BACKUP_INTERVAL,
+                            backup_keep=BACKUP_KEEP, backup_dir=os.path.abspath(BACKUP_DIR))
+
+@app.route('/backups/run', methods=['POST'])
+@login_required
+def backup_run():
+    if not backup_stats["running"]:
+        threading.Thread(target=run_backup, name="backup-manual", daemon=True).start()
+    return redirect(url_for('view_backups'))
+
+@app.route('/backups/<name>')
+@login_required
+def download_backup(name):
+    path = os.path.join(BACKUP_DIR, secure_filename(name))
+    if not name.endswith((".db.gz", ".db.gz.sha256")) or not os.path.isfile(path):
+        abort(404)
+    return send_file(os.path.abspath(path), as_attachment=True)
 
 # --- ACTION ROUTES ---
 @app.route('/add_user', methods=['POST'])
@@ -787,8 +3647,9 @@ def add_user():
     try:
         assigned_key = request.form.get('assigned_key') or None
         conn = get_db()
-        conn.execute("INSERT INTO users (username, api_key, credits, expiry_date, is_active, created_at, plan, assigned_api_key) VALUES (?, ?, ?, ?, 1, ?, ?, ?)", 
-                     (request.form['username'], "SK-"+str(uuid.uuid4())[:12].upper(), int(request.form['credits']), request.form['expiry'], datetime.now().strftime("%Y-%m-%d"), request.form['plan'], assigned_key))
+        conn.execute("INSERT INTO users (username, api_key, credits, expiry_date, expiry_ts, is_active, created_at, created_ts, plan, assigned_api_key) VALUES (?, ?, ?, ?, ?, 1, ?, ?, ?, ?)", 
+                     (request.form['username'], "SK-"+str(uuid.uuid4())[:12].upper(), int(request.form['credits']), request.form['expiry'], date_epoch(request.form['expiry']),
+                      datetime.now().strftime("%Y-%m-%d"), int(time.time()), request.form['plan'], assigned_key))
         conn.commit()
         conn.close()
     except Exception as e: 
@@ -809,8 +3670,8 @@ def update_user_full():
     
     conn = get_db()
     # បន្ថែម expiry_date ក្នុង SQL UPDATE
-    conn.execute('''UPDATE users SET plan=?, expiry_date=?, custom_limit=?, custom_cost_2=?, custom_cost_pro=?, assigned_api_key=? WHERE username=?''', 
-                 (plan, expiry_date, cl, c2, cp, ak, u))
+    conn.execute('''UPDATE users SET plan=?, expiry_date=?, expiry_ts=?, custom_limit=?, custom_cost_2=?, custom_cost_pro=?, assigned_api_key=? WHERE username=?''', 
+                 (plan, expiry_date, date_epoch(expiry_date), cl, c2, cp, ak, u))
     
     if credit_adj:
         try: 
@@ -826,8 +3687,8 @@ def update_user_full():
 def add_api_key():
     try:
         conn = get_db()
-        conn.execute("INSERT INTO api_keys (key_value, label) VALUES (?, ?)", 
-                    (request.form['key_value'], request.form['label']))
+        conn.execute("INSERT INTO api_keys (key_value, label, provider) VALUES (?, ?, ?)", 
+                    (request.form['key_value'], request.form['label'], request.form.get('provider') or None))
         conn.commit()
         conn.close()
     except: 
@@ -861,6 +3722,63 @@ def delete_user(username):
     conn.close()
     return redirect('/dashboard')
 
+@app.route('/bulk')
+@login_required
+def view_bulk():
+    return render_dashboard(page='bulk', plans=PLANS, statuses=USER_STATUSES, bulk_chunk=BULK_CHUNK_SIZE)
+
+def bulk_response(report, error=None):
+    """JSON summary, or the per-row CSV report when the form asked for format=csv."""
+    if error:
+        return jsonify({"error": error, **report.summary()}), 400
+    if request.form.get('format') == 'csv':
+        name = f"bulk_{report.operation}{'_dry_run' if report.dry_run else ''}.csv"
+        return report.csv(), 200, {'Content-Type': 'text/csv', 'Content-Disposition': f'attachment; filename={name}'}
+    return jsonify(report.summary())
+
+def uploaded_csv():
+    """Rows of the uploaded CSV, decoded line by line from the spooled upload."""
+    f = request.files.get('file')
+    return read_csv_rows(codecs.iterdecode(f.stream, 'utf-8-sig')) if f and f.filename else None
+
+@app.route('/bulk/import_users', methods=['POST'])
+@login_required
+def bulk_import():
+    report = BulkReport('import_users', request.form.get('dry_run') == '1', request.form.get('format') == 'csv')
+    rows = uploaded_csv()
+    if rows is None:
+        return bulk_response(report, "upload a CSV file")
+    defaults = {'credits': request.form.get('credits') or '0', 'plan': request.form.get('plan') or 'Standard',
+                'expiry': request.form.get('expiry') or ''}
+    try:
+        bulk_import_users(rows, defaults, report)
+    except (csv.Error, UnicodeDecodeError) as e:
+        return bulk_response(report, f"unreadable CSV: {e}")
+    return bulk_response(report)
+
+@app.route('/bulk/credits', methods=['POST'])
+@login_required
+def bulk_credits():
+    report = BulkReport('credits', request.form.get('dry_run') == '1', request.form.get('format') == 'csv')
+    rows = uploaded_csv()
+    if rows is None:
+        return bulk_response(report, "upload a CSV file")
+    try:
+        bulk_adjust_credits(rows, report)
+    except (csv.Error, UnicodeDecodeError) as e:
+        return bulk_response(report, f"unreadable CSV: {e}")
+    return bulk_response(report)
+
+@app.route('/bulk/update', methods=['POST'])
+@login_required
+def bulk_update():
+    report = BulkReport('update', request.form.get('dry_run') == '1', request.form.get('format') == 'csv')
+    try:
+        bulk_update_users(request.form, report)
+    except ValueError as e:
+        return bulk_response(report, str(e))
+    return bulk_response(report)
+
 @app.route('/generate_vouchers', methods=['POST'])
 @login_required
 def generate_vouchers():
@@ -870,8 +3788,8 @@ def generate_vouchers():
     expiry = request.form.get('expiry') or None
     conn = get_db()
     for _ in range(qty): 
-        conn.execute("INSERT INTO vouchers (code, amount, max_uses, expiry_date, created_at) VALUES (?, ?, ?, ?, ?)", 
-                    (generate_voucher_code(amt), amt, max_uses, expiry, str(datetime.now())))
+        conn.execute("INSERT INTO vouchers (code, amount, max_uses, expiry_date, expiry_ts, created_at, created_ts) VALUES (?, ?, ?, ?, ?, ?, ?)", 
+                    (generate_voucher_code(amt), amt, max_uses, expiry, date_epoch(expiry), *now_stamp()))
     conn.commit()
     conn.close()
     return redirect('/vouchers')
@@ -907,8 +3825,7 @@ def update_settings():
     
     # បង្កើត log សម្រាប់ការអាប់ដេត
     conn = get_db()
-    conn.execute("INSERT INTO logs (username, action, cost, timestamp, status) VALUES (?, ?, ?, ?, ?)", 
-                 ('SYSTEM', f'UPDATE_PUSH: v{form.get("latest_version", "")} enabled', 0, str(datetime.now()), 'Update'))
+    record_log(conn, 'SYSTEM', f'UPDATE_PUSH: v{form.get("latest_version", "")} enabled', 0, 'Update')
     conn.commit()
     conn.close()
     
@@ -930,29 +3847,42 @@ def clear_broadcast():
 # --- API ---
 @app.route('/api/verify', methods=['POST'])
 def verify_user():
-    d = request.json
+    d = request.get_json(silent=True) or {}
+    result = verify_credentials(d.get('username'), d.get('api_key'), request.headers.get('If-None-Match', ''))
+    resp = jsonify(result)
+    if result["valid"]:
+        resp.headers['Cache-Control'] = 'no-store'
+    return resp
+
+def verify_credentials(username, api_key, if_none_match=''):
+    """Body of an /api/verify reply (shared with the async tier)."""
     conn = get_db()
-    u = conn.execute("SELECT credits, expiry_date, is_active, plan, custom_limit, custom_cost_2, custom_cost_pro FROM users WHERE username=? AND api_key=?", 
-                     (d.get('username'), d.get('api_key'))).fetchone()
+    u = conn.execute("SELECT credits, expiry_date, expiry_ts, is_active, plan, custom_limit, custom_cost_2, custom_cost_pro FROM users WHERE username=? AND api_key=?", 
+                     (username, api_key)).fetchone()
     if not u: 
         conn.close()
-        return jsonify({"valid": False, "message": "Invalid Credentials"})
+        return {"valid": False, "message": "Invalid Credentials"}
     
     if u['is_active'] == 0: 
         conn.close()
-        return jsonify({"valid": False, "message": "Banned"})
+        return {"valid": False, "message": "Banned"}
     
     if u['is_active'] == 2: 
         conn.close()
-        return jsonify({"valid": False, "message": "Suspended"})
+        return {"valid": False, "message": "Suspended"}
     
-    if datetime.now() > datetime.strptime(u['expiry_date'], "%Y-%m-%d"): 
+    # expiry_ts is parsed once when expiry_date is written; rows not yet backfilled parse the text
+    expiry_ts = u['expiry_ts'] if u['expiry_ts'] is not None else date_epoch(u['expiry_date'])
+    now = datetime.now()
+    if expiry_ts is None or now.timestamp() > expiry_ts: 
         conn.close()
-        return jsonify({"valid": False, "message": "Expired"})
+        return {"valid": False, "message": "Expired"}
     
-    conn.execute("UPDATE users SET last_seen = ? WHERE username=?", 
-                 (str(datetime.now().strftime("%Y-%m-%d %H:%M:%S")), d.get('username')))
+    conn.execute("UPDATE users SET last_seen = ?, last_seen_ts = ? WHERE username=?", 
+                 (now.strftime("%Y-%m-%d %H:%M:%S"), int(now.timestamp()), username))
     conn.commit()
+    conn.close()
+    analytics.mark_active(username)
     
     limit = u['custom_limit'] if u['custom_limit'] else int(get_setting(f"limit_{u['plan'].lower()}", 3))
     
@@ -960,56 +3890,87 @@ def verify_user():
     custom_cost_2 = u['custom_cost_2'] if u['custom_cost_2'] is not None else int(get_setting('cost_sora_2', 25))
     custom_cost_pro = u['custom_cost_pro'] if u['custom_cost_pro'] is not None else int(get_setting('cost_sora_2_pro', 35))
     
-    return jsonify({
+    result = {
         "valid": True, 
         "credits": u['credits'], 
         "expiry": u['expiry_date'], 
         "plan": u['plan'], 
         "concurrency_limit": limit,
-        "broadcast": get_setting('broadcast_msg', ''), 
-        "broadcast_color": get_setting('broadcast_color', '#FF0000'),
-        "latest_version": get_setting('latest_version', '1.0.0'), 
-        "update_desc": get_setting('update_desc', ''), 
-        "update_is_live": get_setting('update_is_live', '0') == '1', 
-        "download_url": get_setting('update_url', ''),
         # បន្ថែមតម្លៃ Custom Costs
         "custom_cost_2": custom_cost_2,
         "custom_cost_pro": custom_cost_pro,
         # រក្សាទុកតម្លៃ default ផងដែរ
         "default_cost_sora_2": int(get_setting('cost_sora_2', 25)),
         "default_cost_sora_2_pro": int(get_setting('cost_sora_2_pro', 35))
-    })
+    }
+    # Broadcast/update block: clients that send back settings_etag in If-None-Match skip it while unchanged
+    block, etag = settings_cache.derive('verify_block', _verify_settings_block)
+    result["settings_etag"] = etag
+    if etag in if_none_match:
+        result["settings_unchanged"] = True
+    else:
+        result.update(block)
+    return result
     
+def _update_block(values):
+    block = {
+        "latest_version": values.get('latest_version', '1.0.0'),
+        "update_is_live": values.get('update_is_live', '0') == '1',
+        "update_desc": values.get('update_desc', ''),
+        "download_url": values.get('update_url', ''),
+        # Time the update was pushed, so the body (and ETag) only changes with the settings
+        "timestamp": values.get('update_timestamp', ''),
+    }
+    return block, payload_etag(block)
+
+def _verify_settings_block(values):
+    block = {
+        "broadcast": values.get('broadcast_msg', ''), 
+        "broadcast_color": values.get('broadcast_color', '#FF0000'),
+        "latest_version": values.get('latest_version', '1.0.0'), 
+        "update_desc": values.get('update_desc', ''), 
+        "update_is_live": values.get('update_is_live', '0') == '1', 
+        "download_url": values.get('update_url', ''),
+    }
+    return block, payload_etag(block)
+
 @app.route('/api/check-update-status', methods=['GET'])
 def check_update_status():
     """API សម្រាប់ client ពិនិត្យស្ថានភាពអាប់ដេតថ្មី"""
-    return jsonify({
-        "latest_version": get_setting('latest_version', '1.0.0'),
-        "update_is_live": get_setting('update_is_live', '0') == '1',
-        "update_desc": get_setting('update_desc', ''),
-        "download_url": get_setting('update_url', ''),
-        "timestamp": datetime.now().isoformat()
-    })
+    block, etag = settings_cache.derive('update_block', _update_block)
+    if etag in request.headers.get('If-None-Match', ''):
+        resp = app.response_class(status=304)
+    else:
+        resp = jsonify(block)
+    resp.headers['ETag'] = etag
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
 
 @app.route('/api/heartbeat', methods=['POST'])
 def heartbeat():
-    d = request.json
-    u = d.get('username')
-    k = d.get('api_key')
+    d = request.get_json(silent=True) or {}
+    record_heartbeat(d.get('username'), d.get('api_key'))
+    return jsonify({"status": "ok"})
+
+def record_heartbeat(u, k):
+    """Count one session minute for valid credentials (shared with the async tier)."""
     if u and k:
         conn = get_db()
-        conn.execute("UPDATE users SET session_minutes = session_minutes + 1 WHERE username=? AND api_key=?", (u, k))
+        cur = conn.execute("UPDATE users SET session_minutes = session_minutes + 1 WHERE username=? AND api_key=?", (u, k))
+        if cur.rowcount:
+            record_usage(conn, u, session_minutes=1)
         conn.commit()
         conn.close()
-    return jsonify({"status": "ok"})
+        if cur.rowcount:
+            analytics.mark_active(u)
 
 @app.route('/api/redeem', methods=['POST'])
 def redeem():
-    d = request.json
+    d = request.get_json(silent=True) or {}
     code = d.get('code')
     username = d.get('username')
     conn = get_db()
-    v = conn.execute("SELECT amount, max_uses, current_uses, expiry_date FROM vouchers WHERE code=?", (code,)).fetchone()
+    v = conn.execute("SELECT amount, max_uses, current_uses, expiry_date, expiry_ts FROM vouchers WHERE code=?", (code,)).fetchone()
     if not v: 
         conn.close()
         return jsonify({"success": False, "message": "Invalid Code"})
@@ -1018,7 +3979,8 @@ def redeem():
         conn.close()
         return jsonify({"success": False, "message": "Fully Used"})
     
-    if v['expiry_date'] and datetime.now() > datetime.strptime(v['expiry_date'], "%Y-%m-%d"): 
+    expiry_ts = v['expiry_ts'] if v['expiry_ts'] is not None else date_epoch(v['expiry_date'])
+    if v['expiry_date'] and (expiry_ts is None or time.time() > expiry_ts): 
         conn.close()
         return jsonify({"success": False, "message": "Expired"})
     
@@ -1028,7 +3990,7 @@ def redeem():
     
     conn.execute("UPDATE users SET credits=credits+? WHERE username=?", (v['amount'], username))
     conn.execute("UPDATE vouchers SET current_uses=current_uses+1 WHERE code=?", (code,))
-    conn.execute("INSERT INTO voucher_usage (code, username, used_at) VALUES (?, ?, ?)", (code, username, str(datetime.now())))
+    conn.execute("INSERT INTO voucher_usage (code, username, used_at, used_ts) VALUES (?, ?, ?, ?)", (code, username, *now_stamp()))
     conn.commit()
     conn.close()
     return jsonify({"success": True, "message": f"Added {v['amount']} Credits"})
@@ -1039,163 +4001,274 @@ def proxy_gen():
     if ":" not in auth: 
         return jsonify({"code":-1}), 401
     
-    u_name, u_key = auth.split(":")
+    u_name, u_key = auth.split(":", 1)
+    client_data = request.get_json(silent=True) or {}
     conn = get_db()
-    user = conn.execute("SELECT credits, is_active, custom_cost_2, custom_cost_pro FROM users WHERE username=? AND api_key=?", (u_name, u_key)).fetchone()
-    
-    if not user or user['is_active'] != 1: 
+    user, cost, refused = authorize_generation(conn, u_name, u_key, client_data)
+    if refused:
         conn.close()
-        return jsonify({"code":-1}), 403
-    
-    client_data = request.json
-    client_model = client_data.get('model', '')
-    
-    # Determine cost based on custom costs or default
-    if "pro" in client_model and user['custom_cost_pro']:
-        cost = user['custom_cost_pro']
-    elif user['custom_cost_2']:
-        cost = user['custom_cost_2']
-    else:
-        cost = int(get_setting('cost_sora_2_pro' if "pro" in client_model else 'cost_sora_2', 25))
+        return jsonify(refused[0]), refused[1]
     
-    if user['credits'] < cost: 
-        conn.close()
-        return jsonify({"code":-1, "message": "Insufficient Credits"}), 402
+    # Clients may send Idempotency-Key so a retried request never creates a second paid task
+    idem_key = request.headers.get("Idempotency-Key")
+    if idem_key:
+        claimed = claim_idempotency_key(u_name, idem_key)
+        if claimed == 'busy':
+            conn.close()
+            return jsonify({"code":-1, "message": "Request already in progress"}), 409
+        if claimed is not None:
+            conn.close()
+            return jsonify(claimed[0]), claimed[1]
     
-    real_key = get_active_api_key(u_name)
-    if not real_key: 
+    try:
+        body, status = _generate_for_user(conn, u_name, user, client_data, cost, idem_key or uuid.uuid4().hex)
+    finally: 
         conn.close()
-        return jsonify({"code":-1, "message": "System Busy"}), 503
-    
+    if idem_key:
+        finish_idempotency_key(u_name, idem_key, body, status)
+    return jsonify(body), status
+
+def authorize_generation(conn, u_name, u_key, client_data):
+    """Look up the caller and price the request. Returns (user, cost, None) or (None, None, (body, status))."""
+    user = conn.execute("SELECT credits, is_active, plan, custom_cost_2, custom_cost_pro FROM users WHERE username=? AND api_key=?", (u_name, u_key)).fetchone()
+    if not user or user['is_active'] != 1: 
+        return None, None, ({"code":-1}, 403)
+    cost = generation_cost(user, client_data.get('model', ''))
+    if user['credits'] < cost: 
+        return None, None, ({"code":-1, "message": "Insufficient Credits"}, 402)
+    return user, cost, None
+
+def generation_cost(user, model):
+    """Credits for one generation: the user's custom cost if set, else the model's default."""
+    if "pro" in model and user['custom_cost_pro']:
+        return user['custom_cost_pro']
+    elif user['custom_cost_2']:
+        return user['custom_cost_2']
+    return int(get_setting('cost_sora_2_pro' if "pro" in model else 'cost_sora_2', 25))
+
+def record_generation(conn, u_name, tid, cost, model, provider_name, api_key=None):
+    """Insert the task, log and usage rows for an accepted generation (credits are handled by the caller)."""
+    created_at, created_ts = now_stamp()
+    if tid: 
+        conn.execute("INSERT INTO tasks (task_id, username, cost, status, created_at, created_ts, model, provider, api_key) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", 
+                   (tid, u_name, cost, 'pending', created_at, created_ts, model, provider_name, api_key))
+    record_log(conn, u_name, "generate", cost, 'Pending', tid or '', stamp=(created_at, created_ts))
+    record_usage(conn, u_name, generations=1, credits_spent=cost)
+    provider = providers.get(provider_name)
+    if api_key and provider:
+        key_usage.success(api_key, provider.cost(model))
+
+def _generate_for_user(conn, u_name, user, client_data, cost, request_key):
     try:
-        # ✅ បម្លែង model ពី client ទៅកាន់ API model
-        model_map = {
-            "sora-2": "sora-2-text-to-video",
-            "sora-2-pro": "sora-2-text-to-video"
-        }
-        
-        api_model = model_map.get(client_model, "sora-2-text-to-video")
-        
-        # ✅ បម្លែង aspect ratio
-        aspect_ratio = client_data.get('aspectRatio', '16:9')
-        if aspect_ratio == '9:16':
-            api_aspect_ratio = 'portrait'
-        else:
-            api_aspect_ratio = 'landscape'
-        
-        # ✅ បង្កើត payload សម្រាប់ API
-        api_payload = {
-            "model": api_model,
-            "prompt": client_data.get('prompt', ''),
-            "aspectRatio": api_aspect_ratio,
-            "removeWatermark": True
-        }
-        
-        # ✅ បន្ថែម nFrames និង size សម្រាប់ Pro model
-        if "pro" in client_model:
-            api_payload["nFrames"] = "15"  # Default for Pro
-        else:
-            api_payload["nFrames"] = "10"  # Default for non-Pro
-        
-        api_endpoint = "https://freesoragenerator.com/api/v1/video/sora-pro"
-        
-        print(f"[DEBUG] API Call to: {api_endpoint}")
-        print(f"[DEBUG] API Model: {api_model}")
-        print(f"[DEBUG] API Payload: {api_payload}")
-        print(f"[DEBUG] Using API Key: {real_key[:15]}...")
-        
-        r = requests.post(api_endpoint, 
-                         json=api_payload, 
-                         headers={
-                             "Authorization": f"Bearer {real_key}",
-                             "Content-Type": "application/json",
-                             "User-Agent": "Mozilla/5.0"
-                         }, 
-                         timeout=120)
-        
-        print(f"[DEBUG] Response status: {r.status_code}")
-        print(f"[DEBUG] Response: {r.text[:500]}")
-        
-        if r.status_code == 200:
-            data = r.json()
-            
-            if data.get("code") == 0:
-                task_data = data.get('data', {})
-                tid = task_data.get('taskId')
-                
-                print(f"[DEBUG] Task ID received: {tid}")
-                
-                if tid: 
-                    conn.execute("INSERT INTO tasks (task_id, username, cost, status, created_at, model) VALUES (?, ?, ?, ?, ?, ?)", 
-                               (tid, u_name, cost, 'pending', str(datetime.now()), client_model))
-                
-                # Deduct credits immediately
-                conn.execute("UPDATE users SET credits=credits-? WHERE username=?", (cost, u_name))
-                
-                # Log the generation with task_id
-                conn.execute("INSERT INTO logs (username, action, cost, timestamp, status, task_id) VALUES (?, ?, ?, ?, ?, ?)", 
-                            (u_name, "generate", cost, str(datetime.now()), 'Pending', tid or ''))
-                
-                conn.commit()
-                
-                # Return response in expected format
-                response_data = {
-                    "code": 0,
-                    "message": "ok",
-                    "data": {
-                        "taskId": tid
-                    },
-                    "user_balance": user['credits'] - cost
-                }
-                return jsonify(response_data), 200
-            else:
-                # If API returns error, refund credits
-                conn.execute("UPDATE users SET credits=credits+? WHERE username=?", (cost, u_name))
-                conn.commit()
-                error_msg = data.get('message', 'API Error')
-                print(f"[ERROR] API returned error: {error_msg}")
-                return jsonify({
-                    "code": -1,
-                    "message": error_msg
-                }), 400
-        
-        # Handle other status codes
-        print(f"[ERROR] API returned status {r.status_code}: {r.text}")
-        return jsonify({"code":-1, "message": f"API Error: {r.status_code}"}), r.status_code
-    
-    except requests.exceptions.Timeout:
-        print(f"[ERROR] Request timeout for user: {u_name}")
-        return jsonify({"code":-1, "message": "Request timeout"}), 504
-        
+        try:
+            with dispatcher.slot(u_name, user['plan']):
+                provider, real_key, r, error = dispatch_generate(u_name, client_data, request_key)
+        except DispatchTimeout:
+            print(f"[DISPATCH] {u_name} timed out waiting for an upstream slot")
+            return {"code":-1, "message": "System Busy"}, 503
+        return settle_generate_response(conn, u_name, user, client_data.get('model', ''), cost, provider, real_key, r, error)
     except Exception as e: 
         print(f"[ERROR] in proxy_gen: {e}")
         import traceback
         traceback.print_exc()
-        return jsonify({"code":-1, "message": str(e)}), 500
+        return {"code":-1, "message": str(e)}, 500
+
+def settle_generate_response(conn, u_name, user, client_model, cost, provider, real_key, r, error):
+    """Charge and record an accepted generation, or map the upstream failure to a client reply.
+    r only needs status_code/json()/text, so the async tier passes its httpx responses here too."""
+    if r is None:
+        print(f"[ERROR] Generate failed for user {u_name}: {error[0]}")
+        return {"code":-1, "message": error[0]}, error[1]
     
-    finally: 
+    print(f"[DEBUG] Response status: {r.status_code}")
+    print(f"[DEBUG] Response: {r.text[:500]}")
+    
+    if r.status_code == 200:
+        data = r.json()
+        
+        if data.get("code") == 0:
+            task_data = data.get('data', {})
+            tid = task_data.get('taskId')
+            
+            print(f"[DEBUG] Task ID received: {tid}")
+            
+            # Deduct credits immediately
+            conn.execute("UPDATE users SET credits=credits-? WHERE username=?", (cost, u_name))
+            
+            # Task, log (with task_id) and usage rows
+            record_generation(conn, u_name, tid, cost, client_model, provider.name, real_key)
+            
+            conn.commit()
+            analytics.add('generations', client_model)
+            analytics.add('credits_spent', client_model, cost)
+            analytics.mark_active(u_name)
+            
+            # Return response in expected format
+            response_data = {
+                "code": 0,
+                "message": "ok",
+                "data": {
+                    "taskId": tid
+                },
+                "user_balance": user['credits'] - cost
+            }
+            return response_data, 200
+        else:
+            # Nothing was deducted yet, so there is nothing to refund
+            error_msg = data.get('message', 'API Error')
+            print(f"[ERROR] API returned error: {error_msg}")
+            key_usage.rejected(real_key, error_msg)
+            return {
+                "code": -1,
+                "message": error_msg
+            }, 400
+    
+    # Handle other status codes
+    print(f"[ERROR] API returned status {r.status_code}: {r.text}")
+    return {"code":-1, "message": f"API Error: {r.status_code}"}, r.status_code
+
+@app.route('/api/proxy/generate-batch', methods=['POST'])
+def proxy_gen_batch():
+    """Submit up to BATCH_GENERATE_MAX generations in one request.
+
+    The whole batch is priced with the user's costs and reserved in a single
+    conditional UPDATE, items are dispatched at most concurrency_limit at a time, and
+    the cost of every item that did not produce a task is given back at the end.
+    Results come back in request order, one entry per item."""
+    auth = request.headers.get("Client-Auth", "")
+    if ":" not in auth: 
+        return jsonify({"code":-1}), 401
+    u_name, u_key = auth.split(":", 1)
+    items = (request.get_json(silent=True) or {}).get('items')
+    if not isinstance(items, list) or not items or not all(isinstance(i, dict) for i in items):
+        return jsonify({"code":-1, "message": "Missing items"}), 400
+    if len(items) > BATCH_GENERATE_MAX:
+        return jsonify({"code":-1, "message": f"At most {BATCH_GENERATE_MAX} items per request"}), 400
+
+    conn = get_db()
+    user = conn.execute("SELECT credits, is_active, plan, custom_limit, custom_cost_2, custom_cost_pro FROM users WHERE username=? AND api_key=?",
+                        (u_name, u_key)).fetchone()
+    if not user or user['is_active'] != 1: 
+        conn.close()
+        return jsonify({"code":-1}), 403
+    costs = [generation_cost(user, item.get('model', '')) for item in items]
+    total = sum(costs)
+
+    idem_key = request.headers.get("Idempotency-Key")
+    if idem_key:
+        claimed = claim_idempotency_key(u_name, idem_key)
+        if claimed == 'busy':
+            conn.close()
+            return jsonify({"code":-1, "message": "Request already in progress"}), 409
+        if claimed is not None:
+            conn.close()
+            return jsonify(claimed[0]), claimed[1]
+
+    # Reserve the whole batch up front so concurrent requests cannot overspend
+    reserved = conn.execute("UPDATE users SET credits = credits - ? WHERE username = ? AND credits >= ? RETURNING credits",
+                            (total, u_name, total)).fetchone()
+    conn.commit()
+    if reserved is None:
+        conn.close()
+        body, status = {"code":-1, "message": "Insufficient Credits", "required": total}, 402
+        if idem_key:
+            finish_idempotency_key(u_name, idem_key, body, status)
+        return jsonify(body), status
+
+    limit = user['custom_limit'] if user['custom_limit'] else int(get_setting(f"limit_{(user['plan'] or 'Standard').lower()}", 3))
+    request_key = idem_key or uuid.uuid4().hex
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(limit, len(items)))) as pool:
+            outcomes = list(pool.map(_dispatch_batch_item, [u_name] * len(items), [user['plan']] * len(items), items,
+                                     [f"{request_key}:{i}" for i in range(len(items))]))
+    except Exception as e:
+        # Items catch their own errors, so no outcome came back and there is nothing to record
+        conn.execute("UPDATE users SET credits = credits + ? WHERE username = ?", (total, u_name))
+        conn.commit()
         conn.close()
+        print(f"[ERROR] in proxy_gen_batch: {e}")
+        body = {"code":-1, "message": str(e)}
+        if idem_key:
+            finish_idempotency_key(u_name, idem_key, body, 500)
+        return jsonify(body), 500
+
+    # Tasks created upstream exist whatever happens next: record them (and keep their cost)
+    # in their own commit, falling back to one commit per task, so the reaper can settle them
+    accepted = [(item, cost, outcome) for item, cost, outcome in zip(items, costs, outcomes) if outcome[2]]
+    try:
+        for item, cost, (provider_name, api_key, tid, _) in accepted:
+            record_generation(conn, u_name, tid, cost, item.get('model', ''), provider_name, api_key)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"[ERROR] in proxy_gen_batch, recording tasks one by one: {e}")
+        for item, cost, (provider_name, api_key, tid, _) in accepted:
+            try:
+                record_generation(conn, u_name, tid, cost, item.get('model', ''), provider_name, api_key)
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"[ERROR] Task {tid} for {u_name} was created upstream but not recorded: {e}")
+
+    results, refund = [], 0
+    for i, (item, cost, (provider_name, api_key, tid, error)) in enumerate(zip(items, costs, outcomes)):
+        if not tid:
+            refund += cost
+            results.append({"index": i, "code": -1, "message": error})
+            continue
+        analytics.add('generations', item.get('model', ''))
+        analytics.add('credits_spent', item.get('model', ''), cost)
+        results.append({"index": i, "code": 0, "message": "ok", "data": {"taskId": tid}})
+    if refund:
+        # Only the items that produced no task are given back
+        conn.execute("UPDATE users SET credits = credits + ? WHERE username = ?", (refund, u_name))
+        conn.commit()
+    conn.close()
+    analytics.mark_active(u_name)
+
+    body = {"code": 0, "results": results, "charged": total - refund, "refunded": refund,
+            "user_balance": reserved['credits'] + refund}
+    if idem_key:
+        finish_idempotency_key(u_name, idem_key, body, 200)
+    return jsonify(body), 200
+
+def _dispatch_batch_item(u_name, plan, client_data, request_key):
+    """Returns (provider_name, api_key, task_id, error) for one batch item."""
+    try:
+        with dispatcher.slot(u_name, plan):
+            provider, real_key, r, error = dispatch_generate(u_name, client_data, request_key)
+        if r is None:
+            return None, None, None, error[0]
+        if r.status_code != 200:
+            return provider.name, real_key, None, f"API Error: {r.status_code}"
+        data = r.json()
+        tid = (data.get('data') or {}).get('taskId')
+        if data.get("code") != 0 or not tid:
+            key_usage.rejected(real_key, data.get('message'))
+            return provider.name, real_key, None, data.get('message', 'API Error')
+        return provider.name, real_key, tid, None
+    except DispatchTimeout:
+        return None, None, None, "System Busy"
+    except Exception as e:
+        print(f"[ERROR] Batch item for {u_name} failed: {e}")
+        return None, None, None, str(e)
 
 @app.route('/api/proxy/check-result', methods=['POST'])
 def proxy_chk():
     try:
-        real_key = get_active_api_key()
-        task_id = request.json.get('taskId')
+        task_id = (request.get_json(silent=True) or {}).get('taskId')
 
         if not task_id:
             return jsonify({"code": -1, "message": "Missing taskId"}), 400
 
+        conn = get_db()
+        task = conn.execute("SELECT task_id, username, cost, status, model, provider FROM tasks WHERE task_id=?", (task_id,)).fetchone()
+        conn.close()
+
         print(f"[DEBUG] Checking result for taskId: {task_id}")
-        print(f"[DEBUG] Using API Key: {real_key[:15]}...")
-        
-        # Call the actual API
-        r = requests.post("https://freesoragenerator.com/api/video-generations/check-result", 
-                         json={"taskId": task_id}, 
-                         headers={
-                             "Authorization": f"Bearer {real_key}",
-                             "Content-Type": "application/json"
-                         }, 
-                         timeout=60)
+        r = fetch_task_result(task_id, task['provider'] if task else None)
+        if r is None:
+            return jsonify({"code": -1, "message": "System Busy"}), 503
 
         print(f"[DEBUG] Check result response: {r.status_code}")
         print(f"[DEBUG] Response data: {r.text[:500]}")
@@ -1209,47 +4282,364 @@ def proxy_chk():
         data = r.json()
         
         # Update our database based on task status
-        conn = get_db()
-        task = conn.execute("SELECT username, cost, status FROM tasks WHERE task_id=?", (task_id,)).fetchone()
-        
         if task:
-            data_info = data.get('data', {})
-            status = data_info.get('status')
-            current_status = task['status']
-            
-            # If task failed and not already refunded, refund credits
-            if status == 'failed' and current_status != 'refunded':
-                conn.execute("UPDATE users SET credits = credits + ? WHERE username = ?", 
-                           (task['cost'], task['username']))
-                
-                conn.execute("UPDATE tasks SET status = 'refunded' WHERE task_id = ?", (task_id,))
-                
-                conn.execute("INSERT INTO logs (username, action, cost, timestamp, status, task_id) VALUES (?, ?, ?, ?, ?, ?)", 
-                           (task['username'], f"Refund {task_id}", task['cost'], str(datetime.now()), 'Refunded', task_id))
-                
-                # Update the response to indicate refund
-                if 'data' in data:
-                    data['data']['credits_refunded'] = True
-                else:
-                    data['data'] = {'credits_refunded': True}
-                
-                conn.commit()
-                
-            # If task succeeded, update status
-            elif status == 'succeeded' and current_status != 'succeeded':
-                conn.execute("UPDATE tasks SET status = 'succeeded' WHERE task_id = ?", (task_id,))
-                
-                conn.execute("INSERT INTO logs (username, action, cost, timestamp, status, task_id) VALUES (?, ?, ?, ?, ?, ?)", 
-                           (task['username'], f"Success {task_id}", task['cost'], str(datetime.now()), 'Success', task_id))
-                
-                conn.commit()
+            record_check_result(task, data)
         
-        conn.close()
         return jsonify(data), 200
     
     except Exception as e:
         print(f"[ERROR] in proxy_chk: {e}")
         return jsonify({"code":-1, "message": str(e)}), 500
 
+def record_check_result(task, data):
+    """Settle a task from a check-result body and flag a refund in it (shared with the async tier)."""
+    conn = get_db()
+    outcome = settle_task(conn, task, (data.get('data') or {}).get('status'), result=data.get('data'))
+    conn.commit()
+    conn.close()
+    
+    # Update the response to indicate refund
+    if outcome == 'refunded':
+        if 'data' in data:
+            data['data']['credits_refunded'] = True
+        else:
+            data['data'] = {'credits_refunded': True}
+    return data
+
+check_pool = ThreadPoolExecutor(max_workers=BATCH_CHECK_CONCURRENCY, thread_name_prefix="check")
+
+@app.route('/api/proxy/check-results', methods=['POST'])
+def proxy_chk_batch():
+    """Poll up to BATCH_CHECK_MAX of the caller's tasks in one request.
+
+    Tasks already settled with a stored result are answered from the tasks table; the
+    rest are checked upstream in parallel and settled together in one transaction.
+    Results come back in request order, one entry per taskId."""
+    auth = request.headers.get("Client-Auth", "")
+    if ":" not in auth: 
+        return jsonify({"code":-1}), 401
+    u_name, u_key = auth.split(":", 1)
+    task_ids = (request.get_json(silent=True) or {}).get('taskIds')
+    if not isinstance(task_ids, list) or not task_ids:
+        return jsonify({"code":-1, "message": "Missing taskIds"}), 400
+    task_ids = list(dict.fromkeys(str(t) for t in task_ids))
+    if len(task_ids) > BATCH_CHECK_MAX:
+        return jsonify({"code":-1, "message": f"At most {BATCH_CHECK_MAX} taskIds per request"}), 400
+
+    conn = get_db()
+    user = conn.execute("SELECT is_active FROM users WHERE username=? AND api_key=?", (u_name, u_key)).fetchone()
+    if not user or user['is_active'] != 1:
+        conn.close()
+        return jsonify({"code":-1}), 403
+    rows = conn.execute(f"""SELECT task_id, username, cost, status, model, provider, result_json FROM tasks
+                            WHERE username = ? AND task_id IN ({','.join('?' * len(task_ids))})""", (u_name, *task_ids)).fetchall()
+    conn.close()
+    tasks = {row['task_id']: row for row in rows}
+
+    results = {}
+    pending = []
+    for tid in task_ids:
+        task = tasks.get(tid)
+        if task is None:
+            results[tid] = {"taskId": tid, "code": -1, "message": "Task not found"}
+        elif task['status'] in TERMINAL_TASK_STATUSES and (task['result_json'] or task['status'] == 'refunded'):
+            data = json.loads(task['result_json']) if task['result_json'] else {"taskId": tid, "status": "failed"}
+            if task['status'] == 'refunded':
+                data['credits_refunded'] = True
+            results[tid] = {"taskId": tid, "code": 0, "message": "ok", "data": data, "cached": True}
+        else:
+            pending.append(task)
+
+    if pending:
+        checked = list(check_pool.map(check_task_upstream, pending))
+        conn = get_db()
+        for task, body, error in checked:
+            tid = task['task_id']
+            if error:
+                results[tid] = {"taskId": tid, "code": -1, "message": error}
+                continue
+            data = body.get('data') or {}
+            status = data.get('status')
+            outcome = settle_task(conn, task, status, result=data if status in ('succeeded', 'failed') else None)
+            if outcome is None and status in ('succeeded', 'failed') and not task['result_json']:
+                # Settled earlier without a stored result (single check-result or older rows)
+                conn.execute("UPDATE tasks SET result_json = ? WHERE task_id = ? AND result_json IS NULL", (json.dumps(data), tid))
+            if outcome == 'refunded':
+                data['credits_refunded'] = True
+            results[tid] = dict(body, taskId=tid, data=data)
+        conn.commit()
+        conn.close()
+
+    return jsonify({"code": 0, "results": [results[tid] for tid in task_ids]}), 200
+
+def encode_task_cursor(created_at, task_id):
+    return base64.urlsafe_b64encode(json.dumps([created_at, task_id]).encode()).decode().rstrip('=')
+
+def decode_task_cursor(cursor):
+    try:
+        created_at, task_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        return None
+    return (created_at, task_id) if isinstance(created_at, str) and isinstance(task_id, str) else None
+
+@app.route('/api/tasks', methods=['GET'])
+def task_history():
+    """The caller's tasks, newest first, from the tasks table only.
+
+    Query: limit (default TASK_HISTORY_PAGE, at most TASK_HISTORY_MAX), status (comma
+    separated pending/succeeded/refunded) and cursor (next_cursor of the previous page).
+    Pages are keyset-paginated on (created_at, task_id), so deep pages cost the same as
+    the first. Settled tasks carry their stored result; pending ones are left to check-result."""
+    auth = request.headers.get("Client-Auth", "")
+    if ":" not in auth: 
+        return jsonify({"code":-1}), 401
+    u_name, u_key = auth.split(":", 1)
+    try:
+        limit = min(max(int(request.args.get('limit', TASK_HISTORY_PAGE)), 1), TASK_HISTORY_MAX)
+    except ValueError:
+        return jsonify({"code":-1, "message": "Invalid limit"}), 400
+    statuses = [x for x in request.args.get('status', '').split(',') if x]
+    if any(x not in ('pending',) + TERMINAL_TASK_STATUSES for x in statuses):
+        return jsonify({"code":-1, "message": "Invalid status"}), 400
+    cursor = None
+    if request.args.get('cursor'):
+        cursor = decode_task_cursor(request.args['cursor'])
+        if cursor is None:
+            return jsonify({"code":-1, "message": "Invalid cursor"}), 400
+
+    conn = get_read_db()
+    user = conn.execute("SELECT is_active FROM users WHERE username=? AND api_key=?", (u_name, u_key)).fetchone()
+    if not user or user['is_active'] != 1:
+        conn.close()
+        return jsonify({"code":-1}), 403
+    where, args = ["username = ?"], [u_name]
+    if statuses:
+        where.append(f"status IN ({','.join('?' * len(statuses))})")
+        args += statuses
+    if cursor:
+        where.append("(created_at, task_id) < (?, ?)")
+        args += cursor
+    rows = conn.execute(f"""SELECT task_id, status, model, cost, created_at, result_json FROM tasks
+                            WHERE {' AND '.join(where)} ORDER BY created_at DESC, task_id DESC LIMIT ?""",
+                        (*args, limit + 1)).fetchall()
+    conn.close()
+
+    items = []
+    for row in rows[:limit]:
+        result = json.loads(row['result_json']) if row['result_json'] else None
+        if row['status'] == 'refunded':
+            result = dict(result or {"taskId": row['task_id'], "status": "failed"}, credits_refunded=True)
+        items.append({"taskId": row['task_id'], "status": row['status'], "model": row['model'], "cost": row['cost'],
+                      "createdAt": row['created_at'], "result": result})
+    next_cursor = encode_task_cursor(rows[limit - 1]['created_at'], rows[limit - 1]['task_id']) if len(rows) > limit else None
+    return jsonify({"code": 0, "tasks": items, "next_cursor": next_cursor}), 200
+
+# --- CLI COMMANDS ---
+# Run with: flask --app proxy_server <command>
+@app.cli.command("backfill-usage")
+@click.option("--since", default=None, help="First day to rebuild (YYYY-MM-DD), default: all history")
+@click.option("--include-today", is_flag=True, help="Also rebuild today's rows (may race with live traffic)")
+def backfill_usage(since, include_today):
+    """Rebuild usage_daily generation/refund counters from the logs table."""
+    until = datetime.now().strftime("%Y-%m-%d")
+    conn = get_db()
+    t0 = time.time()
+    rows = conn.execute(f"""SELECT username, substr(timestamp, 1, 10) AS day,
+                                   SUM(action = 'generate') AS generations,
+                                   SUM(CASE WHEN action = 'generate' THEN cost ELSE 0 END) AS credits_spent,
+                                   SUM(action LIKE 'Refund %') AS refunds,
+                                   SUM(CASE WHEN action LIKE 'Refund %' THEN cost ELSE 0 END) AS credits_refunded
+                            FROM logs
+                            WHERE (action = 'generate' OR action LIKE 'Refund %') AND username != 'SYSTEM'
+                              AND substr(timestamp, 1, 10) {'<=' if include_today else '<'} ? {'AND substr(timestamp, 1, 10) >= ?' if since else ''}
+                            GROUP BY username, day""", (until, since) if since else (until,)).fetchall()
+    # Overwrite the log-derived counters (idempotent); session_minutes is never in logs and is kept
+    total = 0
+    for i in range(0, len(rows), 5000):
+        chunk = [tuple(r) for r in rows[i:i + 5000]]
+        conn.executemany("""INSERT INTO usage_daily (username, day, generations, credits_spent, refunds, credits_refunded)
+                            VALUES (?, ?, ?, ?, ?, ?)
+                            ON CONFLICT(username, day) DO UPDATE SET generations = excluded.generations,
+                                credits_spent = excluded.credits_spent, refunds = excluded.refunds,
+                                credits_refunded = excluded.credits_refunded""", chunk)
+        conn.commit()
+        total += len(chunk)
+    conn.close()
+    click.echo(f"Backfilled {total} user-day rows in {time.time() - t0:.1f}s")
+
+@app.cli.command("repair-counters")
+@click.option("--check", is_flag=True, help="Only report drift, change nothing")
+def repair_counters_command(check):
+    """Recount the dashboard counters from users/tasks (same as the scheduled job)."""
+    if check:
+        conn = get_read_db()
+        conn.execute("BEGIN")
+        drift = rebuild_counters(conn, fix=False)
+        conn.rollback()
+        conn.close()
+    else:
+        drift = repair_counters()
+    for (name, dim), (stored, actual) in sorted(drift.items()):
+        click.echo(f"{name}[{dim}]: {stored} -> {actual}")
+    click.echo(f"{len(drift)} counters {'drifted' if check else 'repaired'}")
+
+@app.cli.command("reap-tasks")
+@click.option("--limit", type=int, default=None, help="Stop after checking this many tasks")
+def reap_tasks_command(limit):
+    """Check and settle stale pending tasks once (for cron instead of the in-process job)."""
+    stats = reap_stale_tasks(limit)
+    click.echo(json.dumps({k: v for k, v in stats.items() if k != 'current_run'}, indent=1))
+
+@app.cli.command("import-users")
+@click.argument("csv_path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--plan", default="Standard", help="Plan for rows without a plan column")
+@click.option("--credits", default="0", help="Credits for rows without a credits column")
+@click.option("--expiry", default="", help="Expiry (YYYY-MM-DD) for rows without an expiry column")
+@click.option("--dry-run", is_flag=True, help="Validate and report without creating users")
+@click.option("--report", "report_path", default=None, help="Write the per-row CSV report (with generated api keys) here")
+def import_users_command(csv_path, plan, credits, expiry, dry_run, report_path):
+    """Create users from a CSV file, same rules as the admin bulk import."""
+    report = BulkReport('import_users', dry_run, keep_rows=bool(report_path))
+    with open(csv_path, newline='', encoding='utf-8-sig') as f:
+        bulk_import_users(read_csv_rows(f), {'credits': credits, 'plan': plan, 'expiry': expiry}, report)
+    if report_path:
+        with open(report_path, 'w', newline='') as f:
+            f.write(report.csv())
+    summary = report.summary()
+    summary.pop('sample')
+    click.echo(json.dumps(summary, indent=1))
+
+# (table, epoch column, text column it is derived from)
+TIMESTAMP_COLUMNS = [
+    ("users", "expiry_ts", "expiry_date"), ("users", "created_ts", "created_at"), ("users", "last_seen_ts", "last_seen"),
+    ("logs", "ts", "timestamp"), ("tasks", "created_ts", "created_at"),
+    ("vouchers", "expiry_ts", "expiry_date"), ("vouchers", "created_ts", "created_at"),
+    ("voucher_usage", "used_ts", "used_at"), ("banned_ips", "banned_ts", "banned_at"),
+]
+
+@app.cli.command("backfill-timestamps")
+@click.option("--batch", default=20000, help="Rows per transaction")
+def backfill_timestamps(batch):
+    """Fill the *_ts epoch columns from the old text columns for rows written before they existed."""
+    conn = get_db()
+    for table, ts_col, text_col in TIMESTAMP_COLUMNS:
+        t0 = time.time()
+        hi = conn.execute(f"SELECT MAX(rowid) FROM {table}").fetchone()[0] or 0
+        filled = 0
+        for lo in range(0, hi + 1, batch):
+            # Text values are local time, as written by str(datetime.now()) / strftime
+            filled += conn.execute(f"""UPDATE {table} SET {ts_col} = CAST(strftime('%s', {text_col}, 'utc') AS INTEGER)
+                                       WHERE rowid >= ? AND rowid < ? AND {ts_col} IS NULL AND {text_col} IS NOT NULL AND {text_col} != ''""",
+                                    (lo, lo + batch)).rowcount
+            conn.commit()
+        click.echo(f"{table}.{ts_col}: {filled} rows in {time.time() - t0:.1f}s")
+    conn.close()
+
+@app.cli.command("prune-logs")
+@click.option("--older-than-days", type=int, required=True, help="Delete log rows older than this")
+@click.option("--batch", default=5000, help="Rows deleted per transaction")
+@click.option("--dry-run", is_flag=True, help="Only count the rows that would be deleted")
+def prune_logs(older_than_days, batch, dry_run):
+    """Delete old log rows in small batches through idx_logs_ts (run backfill-timestamps first)."""
+    cutoff = int(time.time()) - older_than_days * 86400
+    conn = get_db()
+    if dry_run:
+        n = conn.execute("SELECT COUNT(*) FROM logs WHERE ts < ?", (cutoff,)).fetchone()[0]
+        click.echo(f"Would delete {n} log rows older than {datetime.fromtimestamp(cutoff)}")
+        conn.close()
+        return
+    total = 0
+    while True:
+        n = conn.execute("DELETE FROM logs WHERE rowid IN (SELECT rowid FROM logs WHERE ts < ? LIMIT ?)", (cutoff, batch)).rowcount
+        conn.commit()
+        total += n
+        if n < batch:
+            break
+        time.sleep(0.01)  # let live writers in between batches
+    conn.close()
+    click.echo(f"Deleted {total} log rows older than {datetime.fromtimestamp(cutoff)}")
+
+@app.cli.command("backup-db")
+def backup_db_command():
+    """Take a backup now (same as the scheduled job) and print the files written."""
+    stats = run_backup()
+    click.echo(json.dumps(stats["last_files"], indent=1))
+
+@app.cli.command("split-storage")
+@click.option("--vacuum", is_flag=True, help="VACUUM the main DB afterwards to give the freed pages back")
+def split_storage(vacuum):
+    """Move the history tables out of DATABASE_PATH into HISTORY_DB_PATH (stop the app first).
+
+    Safe to re-run: rows are copied and verified before the originals are dropped,
+    and a partially copied history DB is rebuilt from scratch."""
+    if STORAGE_LAYOUT != 'split':
+        raise click.ClickException("Set STORAGE_LAYOUT=split (and optionally HISTORY_DB_PATH) first")
+    conn = get_db()
+    conn.isolation_level = None
+    placeholders = ','.join('?' * len(HISTORY_TABLES + HISTORY_VIEWS))
+    objects = conn.execute(f"""SELECT type, name, sql FROM main.sqlite_master
+                               WHERE tbl_name IN ({placeholders}) AND sql IS NOT NULL
+                               ORDER BY CASE type WHEN 'table' THEN 0 WHEN 'index' THEN 1 ELSE 2 END""",
+                           HISTORY_TABLES + HISTORY_VIEWS).fetchall()
+    tables = [o['name'] for o in objects if o['type'] == 'table']
+    if not tables:
+        click.echo(f"Nothing to move: {DB_PATH} holds no history tables")
+        return
+    conn.execute("PRAGMA history.journal_mode=WAL")
+
+    # 1. Copy into the history DB, replacing whatever an interrupted run left behind
+    t0 = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    for obj in reversed(objects):
+        conn.execute(f"DROP {obj['type'].upper()} IF EXISTS history.{obj['name']}")
+    for obj in objects:
+        conn.execute(re.sub(r'^(CREATE\s+(?:UNIQUE\s+)?(?:TABLE|INDEX|VIEW)\s+(?:IF\s+NOT\s+EXISTS\s+)?)', r'\1history.', obj['sql'], count=1))
+        if obj['type'] == 'table':
+            conn.execute(f"INSERT INTO history.{obj['name']} SELECT * FROM main.{obj['name']}")
+    conn.execute("COMMIT")
+    for table in tables:
+        src = conn.execute(f"SELECT COUNT(*) FROM main.{table}").fetchone()[0]
+        dst = conn.execute(f"SELECT COUNT(*) FROM history.{table}").fetchone()[0]
+        if src != dst:
+            raise click.ClickException(f"{table}: copied {dst} of {src} rows, main DB left untouched")
+        click.echo(f"{table}: {src} rows")
+
+    # 2. Drop the originals; until this commits, main's copies shadow the history ones
+    conn.execute("BEGIN IMMEDIATE")
+    for obj in objects:
+        if obj['type'] == 'view':
+            conn.execute(f"DROP VIEW main.{obj['name']}")
+    for table in tables:
+        conn.execute(f"DROP TABLE main.{table}")
+    conn.execute("COMMIT")
+    if vacuum:
+        conn.execute("VACUUM main")
+    conn.close()
+    click.echo(f"Moved {len(tables)} tables to {HISTORY_DB_PATH} in {time.time() - t0:.1f}s")
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Create missing tables, columns, indexes and triggers (what DB_INIT_ON_IMPORT does at import)."""
+    t0 = time.time()
+    if not DB_INIT_ON_IMPORT:
+        init_and_migrate_db()
+    click.echo(f"Database {DB_PATH} is up to date ({time.time() - t0:.2f}s)")
+
+# --- FORK SAFETY ---
+def reset_after_fork():
+    """Runs in every forked child (gunicorn workers with preload_app). SQLite connections must not
+    cross a fork: drop the per-thread rate-limit connection inherited from the parent, and make
+    the caches reload in the child. get_db() opens a fresh connection per call already."""
+    rate_limit_store.local = threading.local()
+    read_pool.reset()
+    settings_cache.loaded_at = 0
+    banned_ips.loaded_at = 0
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+startup_mark("routes")
+print(f"[STARTUP] pid {os.getpid()} ready in {(time.perf_counter() - BOOT_STARTED) * 1000:.0f}ms: "
+      + ", ".join(f"{k} {v:g}ms" for k, v in startup_timings.items()))
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,35 @@
+"""Routes that read through the read-only pool keep working with the profiler on."""
+import os
+import sys
+import tempfile
+
+WORKDIR = tempfile.mkdtemp(prefix="proxy-test-")
+os.environ.update(DATABASE_PATH=os.path.join(WORKDIR, "test.db"), PROFILE_ENABLED="1", PROFILE_SLOW_MS="0",
+                  PROFILE_DIR=os.path.join(WORKDIR, "profiles"), RATE_LIMIT_ENABLED="0", CAPTURE_ENABLED="0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import proxy_server  # noqa: E402
+
+
+def setup_module():
+    conn = proxy_server.get_db()
+    conn.execute("INSERT INTO users (username, api_key, credits, expiry_date, is_active, created_at, plan) "
+                 "VALUES ('alice', 'K1', 100, '2099-01-01', 1, '2026-01-01', 'Premium')")
+    conn.execute("INSERT INTO tasks (task_id, username, cost, status, created_at) VALUES ('t1', 'alice', 25, 'pending', '2026-01-01')")
+    conn.commit()
+    conn.close()
+
+
+def test_task_history_with_profiling():
+    r = proxy_server.app.test_client().get("/api/tasks", headers={"Client-Auth": "alice:K1"})
+    assert r.status_code == 200
+    assert [t["taskId"] for t in r.get_json()["tasks"]] == ["t1"]
+
+
+def test_admin_pages_with_profiling():
+    client = proxy_server.app.test_client()
+    with client.session_transaction() as s:
+        s["logged_in"] = True
+    for path in ("/dashboard", "/logs", "/api_keys/status", "/reaper/status"):
+        assert client.get(path).status_code == 200, path
+    assert os.listdir(os.path.join(WORKDIR, "profiles"))